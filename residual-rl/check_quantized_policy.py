@@ -0,0 +1,138 @@
+"""
+Action error and latency of the int8 diffusion policy (--quantize-policy) against the fp32 one, on demo windows.
+
+    python check_quantized_policy.py --ckpt output/.../checkpoints/best_eval_success_rate.pt
+
+The policy config (horizons, UNet dims, demos) is read from the args.json of the checkpoint's run. The obs windows
+come from the trajectories the policy was not trained on (after --num-demo-traj of the run) when there are any.
+Both policies denoise the same noise, the error is reported in the normalized action space (the diffusion output)
+and in the env action space, for the whole predicted sequence and for the executed actions only.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from os.path import dirname as up
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from nets.diffusion_policy.conditional_unet1d_colab import ConditionalUnet1D
+from nets.diffusion_policy.diffusion_sampler import make_sampler
+from utils.ms_data import expand_demo_paths, load_traj_hdf5, order_traj_keys, TARGET_KEY_TO_SOURCE_KEY
+from utils.torch_utils import quantize_int8
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", type=str, required=True,
+        help="checkpoint of offline/diffusion_policy_unet_maniskill2.py (state obs)")
+    parser.add_argument("--demo-path", type=str, default=None,
+        help="default: the --demo-path of the checkpoint's run")
+    parser.add_argument("--sampler", type=str, choices=['ddpm', 'ddim', 'dpmpp'], default='ddim')
+    parser.add_argument("--steps", type=int, default=4,
+        help="number of denoising steps, 4 DDIM steps is the default of the online scripts")
+    parser.add_argument("--num-windows", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=16,
+        help="number of obs windows per policy query, e.g. the number of envs")
+    parser.add_argument("--num-threads", type=int, default=1,
+        help="torch CPU threads, the online scripts run with OMP_NUM_THREADS=1")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def get_obs_windows(observations, obs_horizon):
+    # obs windows of every step of a trajectory, padded with the first obs like in the training datasets
+    L = observations.shape[0] - 1
+    idx = np.arange(L)[:, None] + np.arange(-obs_horizon + 1, 1)[None]
+    return observations[np.maximum(idx, 0)]
+
+def denoise(net, sampler, obs_cond, noisy_action_seq):
+    prepared_cond = net.prepare_conditioning(obs_cond)
+    solver_state = {}
+    for i in range(sampler.num_steps):
+        noise_pred = net(noisy_action_seq, sampler.timesteps[i], prepared_cond=prepared_cond,
+                         step_index=net.inference_step_indices[i])
+        noisy_action_seq = sampler.step(i, noise_pred, noisy_action_seq, solver_state)
+    return noisy_action_seq
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    with open(os.path.join(up(up(args.ckpt)), 'args.json'), 'r') as f:
+        run_args = json.load(f)
+    demo_path = args.demo_path or run_args['demo_path']
+    assert len(expand_demo_paths(demo_path)) == 1, 'Only a single demo file is supported'
+    raw_data = load_traj_hdf5(demo_path, keys=[TARGET_KEY_TO_SOURCE_KEY['observations']])
+    # training used the first num_demo_traj trajectories in index order (traj_0, traj_1, traj_2, ...)
+    traj_keys = order_traj_keys(list(raw_data.keys()), num_traj=len(raw_data))
+    num_train_traj = run_args.get('num_demo_traj')
+    if args.demo_path is None and num_train_traj is not None and num_train_traj < len(traj_keys):
+        traj_keys = traj_keys[num_train_traj:]
+        print(f'{len(traj_keys)} held-out trajectories')
+    else:
+        print(f'[WARN] No held-out trajectories, using the {len(traj_keys)} trajectories of {demo_path}')
+    trajectories = [raw_data[k][TARGET_KEY_TO_SOURCE_KEY['observations']] for k in traj_keys]
+    obs_horizon, pred_horizon, act_horizon = run_args['obs_horizon'], run_args['pred_horizon'], run_args['act_horizon']
+    obs_windows = np.concatenate([get_obs_windows(obs, obs_horizon) for obs in trajectories])
+    obs_windows = obs_windows[rng.permutation(len(obs_windows))[:args.num_windows]]
+    obs_windows = torch.as_tensor(obs_windows, dtype=torch.float32)
+    print(f'{len(obs_windows)} obs windows')
+
+    ckpt = torch.load(args.ckpt, map_location='cpu')
+    state_dict = ckpt['ema_agent'] if 'ema_agent' in ckpt else ckpt['agent']
+    net_state_dict = {k[len('noise_pred_net.'):]: v for k, v in state_dict.items() if k.startswith('noise_pred_net.')}
+    act_dim = state_dict['action_std'].shape[0]
+    nets = {}
+    for name in ['fp32', 'int8']:
+        net = ConditionalUnet1D(
+            input_dim=act_dim,
+            global_cond_dim=obs_horizon * obs_windows.shape[-1],
+            diffusion_step_embed_dim=run_args['diffusion_step_embed_dim'],
+            down_dims=run_args['unet_dims'],
+            n_groups=run_args['n_groups'],
+        )
+        net.load_state_dict(net_state_dict)
+        net.eval()
+        if name == 'int8':
+            quantize_int8(net)
+        nets[name] = net
+    noise_scheduler = DDPMScheduler(
+        num_train_timesteps=100,
+        beta_schedule='squaredcos_cap_v2',
+        clip_sample=True,
+        prediction_type='epsilon',
+    )
+    sampler = make_sampler(noise_scheduler, args.sampler, args.steps)
+    for net in nets.values():
+        net.set_inference_timesteps(sampler.timesteps)
+
+    actions = {name: [] for name in nets}
+    latency = {name: [] for name in nets}
+    with torch.no_grad():
+        for obs_seq in torch.split(obs_windows, args.batch_size):
+            obs_cond = obs_seq.flatten(start_dim=1)
+            noise = torch.randn((len(obs_seq), pred_horizon, act_dim))
+            for name, net in nets.items():
+                start = time.perf_counter()
+                actions[name].append(denoise(net, sampler, obs_cond, noise))
+                latency[name].append((time.perf_counter() - start) * 1000)
+    actions = {name: torch.cat(v) for name, v in actions.items()}
+
+    err = actions['int8'] - actions['fp32']
+    env_err = err * state_dict['action_std'] # denormalized, the mean cancels out
+    executed = slice(obs_horizon - 1, obs_horizon - 1 + act_horizon)
+    print(f'{args.sampler} sampler, {sampler.num_steps} steps, batch size {args.batch_size}, {args.num_threads} threads')
+    print(f'action MSE (normalized): {err.pow(2).mean():.3e}, executed actions: {err[:, executed].pow(2).mean():.3e}, '
+          f'max abs error: {err.abs().max():.3e}, fp32 action power: {actions["fp32"].pow(2).mean():.3e}')
+    print(f'action MSE (env space): {env_err.pow(2).mean():.3e}, executed actions: {env_err[:, executed].pow(2).mean():.3e}')
+    # the first queries include the warmup of both models
+    ms = {name: np.median(v[1:] if len(v) > 1 else v) for name, v in latency.items()}
+    print(f'latency per query (median): fp32 {ms["fp32"]:.2f} ms, int8 {ms["int8"]:.2f} ms, speedup {ms["fp32"] / ms["int8"]:.2f}x')
@@ -6,8 +6,10 @@ The main difference with the github repo code is in `class ConditionalUnet1D` --
 
 from typing import Union
 
+import itertools
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import math
 
 class SinusoidalPosEmb(nn.Module):
@@ -41,6 +43,13 @@ class Upsample1d(nn.Module):
     def forward(self, x):
         return self.conv(x)
 
+class GroupNorm32(nn.GroupNorm):
+    # always normalizes in fp32, also under bf16 autocast (where GroupNorm would run in bf16 on CPU),
+    # so the Mish after it runs in fp32 too. Same parameters as nn.GroupNorm.
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return F.group_norm(x.float(), self.num_groups, self.weight.float(), self.bias.float(), self.eps)
+
 class Conv1dBlock(nn.Module):
     '''
         Conv1d --> GroupNorm --> Mish
@@ -51,7 +60,7 @@ class Conv1dBlock(nn.Module):
 
         self.block = nn.Sequential(
             nn.Conv1d(inp_channels, out_channels, kernel_size, padding=kernel_size // 2),
-            nn.GroupNorm(n_groups, out_channels),
+            GroupNorm32(n_groups, out_channels),
             nn.Mish(),
         )
 
@@ -87,16 +96,32 @@ class ConditionalResidualBlock1D(nn.Module):
         self.residual_conv = nn.Conv1d(in_channels, out_channels, 1) \
             if in_channels != out_channels else nn.Identity()
 
-    def forward(self, x, cond):
+    def prepare_cond(self, global_cond):
+        '''
+            global_cond : [ batch_size x global_cond_dim ]
+
+            returns the global_cond part of the FiLM projection (bias included):
+            since Mish is elementwise, Linear(Mish(cat([t, c]))) = W_t Mish(t) + W_c Mish(c) + b
+        '''
+        linear = self.cond_encoder[1]
+        return F.linear(F.mish(global_cond), linear.weight[:, -global_cond.shape[-1]:], linear.bias)
+
+    def forward(self, x, cond, prepared_cond=None):
         '''
             x : [ batch_size x in_channels x horizon ]
-            cond : [ batch_size x cond_dim]
+            cond : [ batch_size x cond_dim], or only the diffusion step embedding if prepared_cond is given
+            prepared_cond : output of `prepare_cond`
 
             returns:
             out : [ batch_size x out_channels x horizon ]
         '''
         out = self.blocks[0](x)
-        embed = self.cond_encoder(cond)
+        if prepared_cond is None:
+            embed = self.cond_encoder(cond)
+        else:
+            linear = self.cond_encoder[1]
+            embed = F.linear(F.mish(cond), linear.weight[:, :cond.shape[-1]]) + prepared_cond
+            embed = self.cond_encoder[2](embed)
 
         embed = embed.reshape(
             embed.shape[0], 2, self.out_channels, 1)
@@ -190,18 +215,58 @@ class ConditionalUnet1D(nn.Module):
         self.up_modules = up_modules
         self.down_modules = down_modules
         self.final_conv = final_conv
+        # inference mode, see set_inference_timesteps
+        self.register_buffer('timestep_embedding_table', None, persistent=False)
+        self.register_buffer('inference_step_indices', None, persistent=False)
 
         n_params = sum(p.numel() for p in self.parameters())
         print(f"number of parameters: {n_params / 1e6:.2f}M")
 
+    def cond_blocks(self):
+        # all ConditionalResidualBlock1D, in the order they are called in forward
+        for resnet, resnet2, _ in self.down_modules:
+            yield resnet
+            yield resnet2
+        yield from self.mid_modules
+        for resnet, resnet2, _ in self.up_modules:
+            yield resnet
+            yield resnet2
+
+    def prepare_conditioning(self, global_cond):
+        """
+        global_cond: (B,global_cond_dim)
+        output: the global_cond part of the FiLM conditioning of every residual block.
+        It does not depend on the diffusion step, so compute it once per action query and pass it
+        to forward as `prepared_cond` (instead of global_cond) at every denoising step.
+        """
+        return [block.prepare_cond(global_cond) for block in self.cond_blocks()]
+
+    def set_inference_timesteps(self, timesteps):
+        """
+        timesteps: the fixed inference timesteps, e.g. noise_scheduler.timesteps
+        Precomputes their diffusion step embeddings, so that forward can take `step_index`
+        (the position in `timesteps`, as a device tensor, e.g. inference_step_indices[i]) instead of `timestep`:
+        no embedding MLP and no tensor creation per call.
+        The table depends on the weights, call it again after they change.
+        """
+        device = self.diffusion_step_encoder[1].weight.device # not final_conv, it may be quantized
+        timesteps = torch.as_tensor(timesteps, dtype=torch.long).to(device)
+        with torch.no_grad():
+            self.timestep_embedding_table = self.diffusion_step_encoder(timesteps) # (num_steps, dsed)
+        self.inference_step_indices = torch.arange(len(timesteps), device=device)
+
     def forward(self,
             sample: torch.Tensor,
             timestep: Union[torch.Tensor, float, int],
-            global_cond=None):
+            global_cond=None,
+            prepared_cond=None,
+            step_index=None):
         """
         x: (B,T,input_dim)
         timestep: (B,) or int, diffusion step
         global_cond: (B,global_cond_dim)
+        prepared_cond: output of `prepare_conditioning`, replaces global_cond
+        step_index: () long tensor on the device, replaces timestep (see `set_inference_timesteps`)
         output: (B,T,input_dim)
         """
         # (B,T,C)
@@ -209,37 +274,44 @@ class ConditionalUnet1D(nn.Module):
         # (B,C,T)
 
         # 1. time
-        timesteps = timestep
-        if not torch.is_tensor(timesteps):
-            # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
-            timesteps = torch.tensor([timesteps], dtype=torch.long, device=sample.device)
-        elif torch.is_tensor(timesteps) and len(timesteps.shape) == 0:
-            timesteps = timesteps[None].to(sample.device)
-        # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-        timesteps = timesteps.expand(sample.shape[0])
-
-        global_feature = self.diffusion_step_encoder(timesteps)
-
-        if global_cond is not None:
+        if step_index is not None:
+            # index_select instead of [] indexing, which would read the 0-dim index back to the host
+            global_feature = self.timestep_embedding_table.index_select(0, step_index.reshape(1))
+            global_feature = global_feature.expand(sample.shape[0], -1)
+        else:
+            timesteps = timestep
+            if not torch.is_tensor(timesteps):
+                # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
+                timesteps = torch.tensor([timesteps], dtype=torch.long, device=sample.device)
+            elif torch.is_tensor(timesteps) and len(timesteps.shape) == 0:
+                timesteps = timesteps[None].to(sample.device)
+            # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
+            timesteps = timesteps.expand(sample.shape[0])
+
+            global_feature = self.diffusion_step_encoder(timesteps)
+
+        if global_cond is not None and prepared_cond is None:
             global_feature = torch.cat([
                 global_feature, global_cond
             ], axis=-1)
+        # per block obs conditioning, in the order of cond_blocks
+        block_conds = iter(prepared_cond) if prepared_cond is not None else itertools.repeat(None)
 
         x = sample
         h = []
         for idx, (resnet, resnet2, downsample) in enumerate(self.down_modules):
-            x = resnet(x, global_feature)
-            x = resnet2(x, global_feature)
+            x = resnet(x, global_feature, next(block_conds))
+            x = resnet2(x, global_feature, next(block_conds))
             h.append(x)
             x = downsample(x)
 
         for mid_module in self.mid_modules:
-            x = mid_module(x, global_feature)
+            x = mid_module(x, global_feature, next(block_conds))
 
         for idx, (resnet, resnet2, upsample) in enumerate(self.up_modules):
             x = torch.cat((x, h.pop()), dim=1)
-            x = resnet(x, global_feature)
-            x = resnet2(x, global_feature)
+            x = resnet(x, global_feature, next(block_conds))
+            x = resnet2(x, global_feature, next(block_conds))
             x = upsample(x)
 
         x = self.final_conv(x)
@@ -248,4 +320,3 @@ class ConditionalUnet1D(nn.Module):
         x = x.moveaxis(-1,-2)
         # (B,T,C)
         return x
-
@@ -0,0 +1,285 @@
+"""
+Native DDPM / DDIM sampler for inference, a drop-in replacement of the diffusers `scheduler.step` loop,
+plus DPM-Solver++ (2M) for few-step sampling.
+
+All per-step coefficients are computed once (for DDPM / DDIM with the same float32 ops as diffusers, so the results
+are bit-compatible) and kept on the device, so a denoising step is just a few elementwise ops:
+no index lookups, no output dataclass, no host/device sync.
+Only `prediction_type='epsilon'` without thresholding is supported, as used by all the diffusion policies here.
+"""
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def _dpm_lambda(alphas_cumprod, t):
+    # half log-SNR, log(alpha_t / sigma_t)
+    if t is None or t < 0:
+        return None
+    alpha_prod_t = float(alphas_cumprod[int(t)])
+    return 0.5 * (math.log(alpha_prod_t) - math.log(1 - alpha_prod_t))
+
+
+class DiffusionSampler(nn.Module):
+    def __init__(self, alphas_cumprod, timesteps, prev_timesteps, mode='ddim', eta=0.0,
+                 clip_sample=True, clip_sample_range=1.0, final_alpha_cumprod=1.0):
+        """
+        alphas_cumprod: (num_train_timesteps,) float32, from the training scheduler
+        timesteps / prev_timesteps: the inference timesteps and the previous timestep of each (-1 for the last one)
+        mode: 'ddpm' (ancestral sampling, fixed_small variance), 'ddim' (with `eta`, 0 is deterministic)
+            or 'dpmpp' (DPM-Solver++ 2M, first order at the first and the last step, clip_sample applies to its x0)
+        final_alpha_cumprod: alpha_cumprod used when the previous timestep is -1 (DDIM only, DDPM and DPM-Solver++ use 1)
+        """
+        super().__init__()
+        assert mode in ['ddpm', 'ddim', 'dpmpp'], f'Unknown sampler mode {mode}'
+        self.mode = mode
+        self.eta = eta
+        self.clip_sample = clip_sample
+        self.clip_sample_range = clip_sample_range
+        self.num_steps = len(timesteps)
+        # everything but the training schedule, e.g. to save the sampler a policy was distilled for
+        self.config = dict(
+            timesteps=[int(t) for t in timesteps], prev_timesteps=[int(t) for t in prev_timesteps], mode=mode, eta=eta,
+            clip_sample=clip_sample, clip_sample_range=clip_sample_range, final_alpha_cumprod=float(final_alpha_cumprod),
+        )
+
+        alphas_cumprod = torch.as_tensor(alphas_cumprod, dtype=torch.float32).cpu()
+        final_alpha_cumprod = torch.as_tensor(final_alpha_cumprod, dtype=torch.float32).cpu()
+        # per step: sqrt(1 - a_t), sqrt(a_t), coef of x0, coef of eps (ddim) / x_t (ddpm, dpmpp), std of the added noise,
+        # weight of the x0 difference with the previous step (dpmpp, 0 for first order steps)
+        coefs, step_adds_noise = [], []
+        for i, (t, prev_t) in enumerate(zip(timesteps, prev_timesteps)):
+            t, prev_t = int(t), int(prev_t)
+            alpha_prod_t = alphas_cumprod[t]
+            beta_prod_t = 1 - alpha_prod_t
+            multistep_coef = torch.tensor(0.0)
+            if mode == 'dpmpp':
+                # x_s = sigma_s / sigma_t * x_t - alpha_s * expm1(-h) * D, with lambda = log(alpha / sigma) and h = lambda_s - lambda_t
+                # D = x0 (first order) or x0 + (x0 - x0_prev) / (2 r), r = h_prev / h (2M, midpoint)
+                lambdas = [_dpm_lambda(alphas_cumprod, tt) for tt in (timesteps[i-1] if i > 0 else None, t, prev_t)]
+                if prev_t < 0: # to the clean sample (sigma = 0): x_s = x0
+                    x0_coef, other_coef = torch.tensor(1.0), torch.tensor(0.0)
+                else:
+                    h = lambdas[2] - lambdas[1]
+                    alpha_prod_s = float(alphas_cumprod[prev_t])
+                    x0_coef = torch.tensor(-math.sqrt(alpha_prod_s) * math.expm1(-h))
+                    other_coef = torch.tensor(math.sqrt(1 - alpha_prod_s) / math.sqrt(1 - float(alpha_prod_t)))
+                    if i > 0:
+                        r = (lambdas[1] - lambdas[0]) / h
+                        multistep_coef = torch.tensor(0.5 / r)
+                std = torch.tensor(0.0)
+                step_adds_noise.append(False)
+            elif mode == 'ddim':
+                alpha_prod_t_prev = alphas_cumprod[prev_t] if prev_t >= 0 else final_alpha_cumprod
+                beta_prod_t_prev = 1 - alpha_prod_t_prev
+                variance = (beta_prod_t_prev / beta_prod_t) * (1 - alpha_prod_t / alpha_prod_t_prev)
+                std = eta * variance ** (0.5)
+                x0_coef = alpha_prod_t_prev ** (0.5)
+                other_coef = (1 - alpha_prod_t_prev - std**2) ** (0.5) # "direction pointing to x_t", times eps
+                step_adds_noise.append(eta > 0)
+            else:
+                alpha_prod_t_prev = alphas_cumprod[prev_t] if prev_t >= 0 else torch.tensor(1.0)
+                beta_prod_t_prev = 1 - alpha_prod_t_prev
+                current_alpha_t = alpha_prod_t / alpha_prod_t_prev
+                current_beta_t = 1 - current_alpha_t
+                x0_coef = (alpha_prod_t_prev ** (0.5) * current_beta_t) / beta_prod_t
+                other_coef = current_alpha_t ** (0.5) * beta_prod_t_prev / beta_prod_t # times x_t
+                variance = (1 - alpha_prod_t_prev) / (1 - alpha_prod_t) * (1 - alpha_prod_t / alpha_prod_t_prev)
+                std = torch.clamp(variance, min=1e-20) ** 0.5
+                step_adds_noise.append(t > 0)
+            coefs.append(torch.stack([
+                beta_prod_t ** (0.5), alpha_prod_t ** (0.5), x0_coef, other_coef, std, multistep_coef,
+            ]).float())
+        self.step_adds_noise = step_adds_noise
+        self.alphas_cumprod = alphas_cumprod
+        self.register_buffer('coefs', torch.stack(coefs), persistent=False) # (num_steps, 6)
+        self.register_buffer('timesteps', torch.as_tensor(timesteps, dtype=torch.long).cpu(), persistent=False)
+
+    @classmethod
+    def from_scheduler(cls, scheduler, mode, eta=0.0):
+        # sampler with the schedule and the inference timesteps of a diffusers DDPMScheduler / DDIMScheduler
+        config = scheduler.config
+        assert config.prediction_type == 'epsilon' and not config.thresholding
+        timesteps = scheduler.timesteps.tolist()
+        if mode == 'ddim':
+            # same as DDIMScheduler.step
+            prev_timesteps = [t - config.num_train_timesteps // scheduler.num_inference_steps for t in timesteps]
+            final_alpha_cumprod = scheduler.final_alpha_cumprod
+        else:
+            # same as DDPMScheduler.previous_timestep: the next inference timestep
+            prev_timesteps = timesteps[1:] + [-1]
+            final_alpha_cumprod = 1.0
+        return cls(
+            scheduler.alphas_cumprod, timesteps, prev_timesteps, mode=mode, eta=eta,
+            clip_sample=config.clip_sample, clip_sample_range=config.clip_sample_range,
+            final_alpha_cumprod=final_alpha_cumprod,
+        )
+
+    @classmethod
+    def from_config(cls, alphas_cumprod, config):
+        return cls(alphas_cumprod, **config)
+
+    def distillation_student(self):
+        """
+        Sampler of a progressive distillation student of this (teacher) sampler: deterministic DDIM with every other
+        timestep, each student step goes to the timestep the teacher reaches after two steps.
+        """
+        assert self.mode == 'ddim' and self.eta == 0, 'progressive distillation needs a deterministic DDIM teacher'
+        assert self.num_steps % 2 == 0
+        config = dict(self.config, timesteps=self.config['timesteps'][::2], prev_timesteps=self.config['prev_timesteps'][1::2])
+        return DiffusionSampler.from_config(self.alphas_cumprod, config)
+
+    def add_noise(self, original_sample, noise, i):
+        # forward diffusion of a clean sample to timesteps[i], e.g. to start denoising from it at step i
+        sqrt_beta_prod_t, sqrt_alpha_prod_t = self.coefs[i, 0], self.coefs[i, 1]
+        return sqrt_alpha_prod_t * original_sample + sqrt_beta_prod_t * noise
+
+    def pred_original_sample(self, i, model_output, sample):
+        # predicted clean sample (x0) at step i, clipped like in `step`
+        sqrt_beta_prod_t, sqrt_alpha_prod_t = self.coefs[i, 0], self.coefs[i, 1]
+        pred_original_sample = (sample - sqrt_beta_prod_t * model_output) / sqrt_alpha_prod_t
+        if self.clip_sample:
+            pred_original_sample = pred_original_sample.clamp(-self.clip_sample_range, self.clip_sample_range)
+        return pred_original_sample
+
+    def step(self, i, model_output, sample, solver_state=None):
+        """
+        i: index of the step (python int), i.e. the position of the timestep in `timesteps`
+        model_output: predicted noise at timesteps[i]
+        sample: x_t
+        solver_state: a dict shared by the steps of one sampling run, needed by the multistep solver (dpmpp)
+        returns x_{prev_t}, same as scheduler.step(model_output, timesteps[i], sample).prev_sample
+        """
+        x0_coef, other_coef, std, multistep_coef = self.coefs[i, 2:]
+        pred_original_sample = self.pred_original_sample(i, model_output, sample)
+        if self.mode == 'dpmpp':
+            assert solver_state is not None, 'dpmpp needs a solver_state'
+            D = pred_original_sample
+            if 'prev_x0' in solver_state:
+                D = D + multistep_coef * (pred_original_sample - solver_state['prev_x0'])
+            solver_state['prev_x0'] = pred_original_sample
+            prev_sample = x0_coef * D + other_coef * sample
+        elif self.mode == 'ddim':
+            prev_sample = x0_coef * pred_original_sample + other_coef * model_output
+        else:
+            prev_sample = x0_coef * pred_original_sample + other_coef * sample
+        if self.step_adds_noise[i]:
+            noise = torch.randn(model_output.shape, device=model_output.device, dtype=model_output.dtype)
+            prev_sample = prev_sample + std * noise
+        return prev_sample
+
+
+class WarmStart(object):
+    """
+    Per-env state for warm-started denoising. Consecutive action chunks overlap (only `shift` = act_horizon of the
+    pred_horizon actions are executed), so the next query of an env starts from the unexecuted tail of its previous
+    chunk, shifted forward and noised to an intermediate timestep, and only runs the last `num_steps` denoising steps.
+    Envs without a previous chunk (first query of an episode) start from pure noise and run all the steps.
+    """
+    def __init__(self, num_envs, shift, num_steps):
+        self.shift = shift
+        self.num_steps = num_steps
+        self.chunks = None # (num_envs, pred_horizon, act_dim), last denoised chunk of each env
+        self.valid = np.zeros(num_envs, dtype=bool)
+
+    def reset(self, done):
+        # call after every env step with terminations | truncations, the envs that were reset start from noise again
+        self.valid[done] = False
+
+    def initial_guess(self):
+        # previous chunks shifted forward by `shift`, the last action is repeated at the end
+        tail = self.chunks[:, self.shift:]
+        return torch.cat([tail, tail[:, -1:].expand(-1, self.shift, -1)], dim=1)
+
+    def update(self, chunks):
+        self.chunks = chunks
+        self.valid[:] = True
+
+
+def warm_start_sample(denoise_fn, sampler, obs_cond, noise, warm_start, fixed_batch=False):
+    """
+    Samples at step first_step = sampler.num_steps - warm_start.num_steps of a warm-started query: envs with a previous
+    chunk start from it, noised to that step, the others run the steps [0, first_step) from `noise`.
+    denoise_fn(obs_cond, x, first_step, last_step): denoising loop of the policy (`denoise` or its compiled version)
+    fixed_batch: run these first steps on the whole batch and pick the cold envs with torch.where, so that a compiled
+    denoise_fn always sees the same batch size; otherwise they only run on the cold envs.
+    Returns the samples of all envs at first_step, first_step, and the number of steps the UNet ran for each env
+    before first_step (int64 numpy array, for logging the actual cost).
+    """
+    first_step = sampler.num_steps - warm_start.num_steps
+    x = sampler.add_noise(warm_start.initial_guess(), noise, first_step)
+    cold = ~warm_start.valid
+    if not cold.any():
+        return x, first_step, np.zeros(len(cold), dtype=np.int64)
+    if fixed_batch:
+        mask = torch.from_numpy(cold).to(x.device).view((-1,) + (1,) * (x.dim() - 1))
+        x = torch.where(mask, denoise_fn(obs_cond, noise, 0, first_step), x)
+        return x, first_step, np.full(len(cold), first_step, dtype=np.int64)
+    idx = torch.from_numpy(np.flatnonzero(cold)).to(x.device)
+    x = x.index_copy(0, idx, denoise_fn(obs_cond.index_select(0, idx), noise.index_select(0, idx), 0, first_step))
+    return x, first_step, np.where(cold, first_step, 0)
+
+
+def denoise_early_exit(noise_pred_net, sampler, obs_cond, sample, tol, first_step=0):
+    """
+    Denoising loop with early exit, runs the steps [first_step, sampler.num_steps).
+    A sample is done once its predicted clean sample (x0) changes by less than `tol` (max abs difference) between two
+    consecutive steps: its result is this x0 prediction, and the next steps only run the UNet on the samples
+    that are still active. The batch shrinks, so this runs eagerly (one host sync per step).
+    noise_pred_net: ConditionalUnet1D with the inference timesteps of `sampler` set (`set_inference_timesteps`)
+    Returns the denoised samples and the number of steps run for each of them (int64 numpy array).
+    """
+    B = sample.shape[0]
+    out = torch.empty_like(sample)
+    num_steps = torch.full((B,), sampler.num_steps - first_step, dtype=torch.long, device=sample.device)
+    active = torch.arange(B, device=sample.device) # rows of `out` of the samples still being denoised
+    prepared_cond = noise_pred_net.prepare_conditioning(obs_cond)
+    solver_state = {}
+    prev_x0 = None
+    for i in range(first_step, sampler.num_steps):
+        noise_pred = noise_pred_net(
+            sample=sample,
+            timestep=sampler.timesteps[i],
+            prepared_cond=prepared_cond,
+            step_index=noise_pred_net.inference_step_indices[i],
+        )
+        x0 = sampler.pred_original_sample(i, noise_pred, sample)
+        sample = sampler.step(i, noise_pred, sample, solver_state)
+        if prev_x0 is not None and i < sampler.num_steps - 1:
+            done = (x0 - prev_x0).abs().flatten(start_dim=1).amax(dim=1) < tol
+            if done.any():
+                out[active[done]] = x0[done]
+                num_steps[active[done]] = i + 1 - first_step
+                keep = ~done
+                active, sample, x0 = active[keep], sample[keep], x0[keep]
+                prepared_cond = [c[keep] for c in prepared_cond]
+                solver_state = {k: v[keep] for k, v in solver_state.items()}
+                if len(active) == 0:
+                    break
+        prev_x0 = x0
+    out[active] = sample
+    return out, num_steps.cpu().numpy()
+
+
+def make_sampler(noise_scheduler, name, num_steps=None, eta=0.0):
+    """
+    Sampler `name` ('ddpm', 'ddim' or 'dpmpp') with `num_steps` inference steps (default: all training timesteps)
+    for a model trained with `noise_scheduler`. The timesteps are the ones of the corresponding diffusers scheduler.
+    """
+    from diffusers.schedulers.scheduling_ddim import DDIMScheduler
+    from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+    config = noise_scheduler.config
+    num_steps = num_steps or config.num_train_timesteps
+    if name == 'dpmpp':
+        # timesteps of DPMSolverMultistepScheduler (linspace spacing), down to the clean sample
+        timesteps = np.linspace(0, config.num_train_timesteps - 1, num_steps + 1).round()[::-1][:-1].astype(np.int64)
+        timesteps = timesteps.tolist()
+        return DiffusionSampler(
+            noise_scheduler.alphas_cumprod, timesteps, timesteps[1:] + [-1], mode='dpmpp',
+            clip_sample=config.clip_sample, clip_sample_range=config.clip_sample_range,
+        )
+    scheduler_class = {'ddpm': DDPMScheduler, 'ddim': DDIMScheduler}[name]
+    scheduler = scheduler_class.from_config(config)
+    scheduler.set_timesteps(num_steps)
+    return DiffusionSampler.from_scheduler(scheduler, mode=name, eta=eta)
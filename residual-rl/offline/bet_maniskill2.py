@@ -13,10 +13,11 @@ import torch.nn.functional as F
 from torch.utils.tensorboard import SummaryWriter
 
 import datetime
+import itertools
 from collections import defaultdict
 from utils.profiling import NonOverlappingTimeProfiler
 
-from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataset import Dataset, IterableDataset
 from torch.utils.data.sampler import RandomSampler, BatchSampler
 from torch.utils.data.dataloader import DataLoader
 from utils.sampler import IterationBasedBatchSampler
@@ -74,10 +75,21 @@ def parse_args():
     parser.add_argument("--num-eval-envs", type=int, default=10) # NOTE: should not be too large, otherwise bias to short episodes
     parser.add_argument("--sync-venv", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True)
     parser.add_argument("--num-dataload-workers", type=int, default=0)
+    parser.add_argument("--demo-cache", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, convert the demo h5 into a flat .npy cache next to it on first use, and load from the cache afterwards")
+    parser.add_argument("--demo-shm", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, put the demo cache (implies --demo-cache) in /dev/shm, so that concurrent runs on the same demo share one copy in memory")
+    parser.add_argument("--batched-sampling", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, gather whole batches of windows on the device instead of using a DataLoader")
+    parser.add_argument("--demo-stream", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, stream windows shard by shard from --demo-path (e.g. a glob of many h5 files) instead of loading all demos")
+    parser.add_argument("--shuffle-buffer-size", type=int, default=100_000,
+        help="number of windows in the shuffle buffer of --demo-stream")
     parser.add_argument("--control-mode", type=str, default='pd_ee_delta_pose')
     parser.add_argument("--obj-ids", metavar='N', type=str, nargs='+', default=[])
 
     args = parser.parse_args()
+    args.demo_cache = args.demo_cache or args.demo_shm
     args.algo_name = ALGO_NAME
     args.script = __file__
     args.num_eval_envs = min(args.num_eval_envs, args.num_eval_episodes)
@@ -85,17 +97,14 @@ def parse_args():
     if args.num_eval_envs == 1:
         args.sync_venv = True
     if args.demo_path.endswith('.h5'):
-        import json
-        json_file = args.demo_path[:-2] + 'json'
-        with open(json_file, 'r') as f:
-            demo_info = json.load(f)
-            if 'control_mode' in demo_info['env_info']['env_kwargs']:
-                control_mode = demo_info['env_info']['env_kwargs']['control_mode']
-            elif 'control_mode' in demo_info['episodes'][0]:
-                control_mode = demo_info['episodes'][0]['control_mode']
-            else:
-                raise Exception('Control mode not found in json')
-            assert control_mode == args.control_mode, 'Control mode mismatched'
+        from utils.ms_data import expand_demo_paths
+        from utils.demo_manifest import load_demo_manifest
+        # all shards are assumed to share the env config
+        demo_manifest = load_demo_manifest(expand_demo_paths(args.demo_path)[0])
+        assert demo_manifest.control_mode == args.control_mode, 'Control mode mismatched'
+    assert not (args.demo_stream and args.demo_cache), '--demo-cache and --demo-stream are exclusive'
+    assert not (args.demo_stream and args.batched_sampling), '--batched-sampling and --demo-stream are exclusive'
+    assert not (args.demo_stream and args.num_demo_traj is not None), '--num-demo-traj is not supported with --demo-stream'
     # fmt: on
     return args
 
@@ -122,47 +131,142 @@ def make_env(env_id, seed, control_mode=None, video_dir=None, other_kwargs={}):
     return thunk
 
 class SmallDemoDataset_with_history(Dataset):
-    def __init__(self, data_path, device, history_len, num_traj):
-        from utils.ms_data import load_demo_dataset
-        trajectories = load_demo_dataset(data_path, num_traj=num_traj, concat=False)
+    def __init__(self, data_path, device, history_len, num_traj, cache=False):
+        from utils.ms_data import load_demo_dataset, expand_demo_paths
+        from utils.demo_manifest import load_demo_manifest
+        # the windows are read from the manifest, they are only computed here for sharded demos
+        manifest = load_demo_manifest(data_path) if len(expand_demo_paths(data_path)) == 1 else None
+        if cache: # trajectories are already tensors on device, views of one flat tensor per field
+            from utils.demo_cache import load_demo_cache, SHM_CACHE_ROOT
+            demo_cache = load_demo_cache(data_path, args.control_mode, root=SHM_CACHE_ROOT if args.demo_shm else None)
+            trajectories = demo_cache.load_trajectories(num_traj=num_traj, device=device)
+        else:
+            trajectories = load_demo_dataset(data_path, num_traj=num_traj, concat=False)
         # trajectories['observations'] is a list of np.ndarray (L+1, obs_dim)
         # trajectories['actions'] is a list of np.ndarray (L, act_dim)
         
-        for k, v in trajectories.items():
-            for i in range(len(v)):
-                trajectories[k][i] = torch.Tensor(v[i]).to(device)
-
-        self.slices = []
-        num_traj = len(trajectories['actions'])
+        self.history_len = history_len
+        lengths = [a.shape[0] for a in trajectories['actions']]
+        for obs_traj, L in zip(trajectories['observations'], lengths):
+            assert obs_traj.shape[0] == L + 1
+        if manifest is not None:
+            traj_keys = manifest.select_traj_keys(num_traj)
+            assert np.array_equal(manifest.lengths[manifest.traj_indices(traj_keys)], lengths)
+            slices = manifest.windows(('seq', history_len), traj_keys)
+            ignore_cnt = sum(L < history_len for L in lengths)
+            if ignore_cnt > 0:
+                print(f"Ignored {ignore_cnt} short trajectories out of {len(lengths)}. To include all, set window <= {min(lengths)}.")
+        else:
+            slices = self.get_slices(lengths)
+        print(f"Total transitions: {sum(lengths)}, Total obs sequences: {len(slices)}")
+
+        # one concatenated tensor per key, the windows are rows of a strided view of it (nothing is copied)
+        if cache:
+            self.obs_flat = torch.cat(trajectories['observations'], dim=0)
+            self.act_flat = torch.cat(trajectories['actions'], dim=0)
+        else:
+            self.obs_flat = torch.Tensor(np.concatenate(trajectories['observations'], axis=0)).to(device)
+            self.act_flat = torch.Tensor(np.concatenate(trajectories['actions'], axis=0)).to(device)
+        self.obs_windows = self.obs_flat.unfold(0, history_len, 1).transpose(1, 2) # (num_rows - history_len + 1, history_len, obs_dim)
+        self.act_windows = self.act_flat.unfold(0, history_len, 1).transpose(1, 2)
+        self.trajectories = { # per-trajectory views, e.g. to fit the kmeans
+            'observations': list(torch.split(self.obs_flat, [L + 1 for L in lengths])),
+            'actions': list(torch.split(self.act_flat, lengths)),
+        }
+        # a window is the start row of its obs / actions in the flat tensors, (N, 2) int32
+        lengths = torch.tensor(lengths, dtype=torch.int64)
+        slices = torch.as_tensor(np.asarray(slices, dtype=np.int64).reshape(-1, 3))
+        obs_offsets = torch.cumsum(lengths + 1, 0) - (lengths + 1)
+        act_offsets = torch.cumsum(lengths, 0) - lengths
+        window_starts = torch.stack([obs_offsets[slices[:, 0]], act_offsets[slices[:, 0]]], dim=1) + slices[:, 1:2]
+        index_dtype = torch.int32 if len(self.obs_flat) < 2**31 else torch.int64
+        self.window_starts = window_starts.to(index_dtype).to(self.obs_flat.device) # for get_batch / iter_batches
+        self.window_starts_cpu = window_starts.numpy() # for __getitem__, reading the device copy would sync for every sample
+
+    def get_slices(self, lengths):
+        history_len = self.history_len
+        slices = []
         min_traj_length = np.inf
         ignore_cnt = 0
-        total_transitions = 0
-        for i in range(num_traj):
-            L = trajectories['actions'][i].shape[0]
-            assert trajectories['observations'][i].shape[0] == L + 1
-            total_transitions += L
+        for i, L in enumerate(lengths):
             min_traj_length = min(L, min_traj_length)
             if L - history_len < 0:
                 print(f"Ignored short trajectory #{i}: len={L}, history={history_len}")
                 ignore_cnt += 1
             else:
-                self.slices += [
+                slices += [
                     (i, start, start + history_len) for start in range(L - history_len)
                 ]  # slice indices follow convention [start, end)
 
         if min_traj_length < history_len:
-            print(f"Ignored {ignore_cnt} short trajectories out of {num_traj}. To include all, set window <= {min_traj_length}.")
-        
-        print(f"Total transitions: {total_transitions}, Total obs sequences: {len(self.slices)}")
-
-        self.trajectories = trajectories
+            print(f"Ignored {ignore_cnt} short trajectories out of {len(lengths)}. To include all, set window <= {min_traj_length}.")
+        return slices
 
     def __getitem__(self, index):
-        i, start, end = self.slices[index]
-        return {k: v[i][start:end] for k, v in self.trajectories.items()}
+        obs_start, act_start = self.window_starts_cpu[index].tolist()
+        return {'observations': self.obs_windows[obs_start], 'actions': self.act_windows[act_start]}
+
+    def get_window(self, trajectories, i, start, end):
+        return {k: v[i][start:end] for k, v in trajectories.items()}
+
+    def get_batch(self, indices):
+        # the windows `indices` (a tensor on the device) as one batch, only the batch is copied
+        starts = self.window_starts[indices].long()
+        return {'observations': self.obs_windows[starts[:, 0]], 'actions': self.act_windows[starts[:, 1]]}
+
+    def iter_batches(self, batch_size, total_iters, seed):
+        # replaces the DataLoader: RandomSampler + BatchSampler(drop_last=True) + IterationBasedBatchSampler, on the device
+        n = len(self.window_starts)
+        assert n >= batch_size, f'{n} windows < batch size {batch_size}'
+        generator = torch.Generator(device=self.window_starts.device)
+        generator.manual_seed(seed)
+        iteration = 0
+        while True:
+            perm = torch.randperm(n, device=self.window_starts.device, generator=generator)
+            for i in range(n // batch_size):
+                if iteration >= total_iters:
+                    return
+                yield self.get_batch(perm[i*batch_size:(i+1)*batch_size])
+                iteration += 1
 
     def __len__(self):
-        return len(self.slices)
+        return len(self.window_starts)
+
+class StreamingDemoDataset_with_history(SmallDemoDataset_with_history, IterableDataset):
+    """
+    Same windows as SmallDemoDataset_with_history, but streamed from a (large) set of demo shards:
+    each dataloader worker only holds the shard it is reading plus the shuffle buffer. Yields CPU tensors, forever.
+    """
+    def __init__(self, data_path, history_len, shuffle_buffer_size, seed):
+        from utils.ms_data import expand_demo_paths, load_demo_dataset
+        self.paths = expand_demo_paths(data_path)
+        self.history_len = history_len
+        self.shuffle_buffer_size, self.seed = shuffle_buffer_size, seed
+        # the actions of all shards are kept (on CPU) to fit the kmeans of BeT
+        actions, num_windows = [], 0
+        for path in self.paths:
+            shard_actions = load_demo_dataset(path, keys=['actions'], concat=False)['actions']
+            actions += [torch.from_numpy(a).float() for a in shard_actions]
+            num_windows += len(self.get_slices([len(a) for a in shard_actions]))
+        self.trajectories = {'actions': actions}
+        self.num_windows = num_windows
+        print(f"Total transitions: {sum(len(a) for a in actions)}, Total obs sequences: {num_windows}, in {len(self.paths)} shards")
+
+    def make_windows(self, trajectories, rng):
+        trajectories = {k: [torch.from_numpy(t).float() for t in v] for k, v in trajectories.items()}
+        slices = self.get_slices([len(a) for a in trajectories['actions']])
+        for i in rng.permutation(len(slices)):
+            # copy, so that the shuffle buffer does not keep the shard alive
+            yield {k: v.clone() for k, v in self.get_window(trajectories, *slices[i]).items()}
+
+    def __iter__(self):
+        from utils.ms_data import stream_demo_windows
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        return stream_demo_windows(self.paths, self.make_windows, self.shuffle_buffer_size, self.seed, worker_id, num_workers)
+
+    def __len__(self): # windows per pass over all shards
+        return self.num_windows
 
 
 class Agent(nn.Module):
@@ -285,17 +389,33 @@ if __name__ == "__main__":
 
 
     # dataloader setup
-    dataset = SmallDemoDataset_with_history(args.demo_path, device, 
-                    history_len=args.context_window, num_traj=args.num_demo_traj)
-    sampler = RandomSampler(dataset, replacement=False)
-    batch_sampler = BatchSampler(sampler, batch_size=args.batch_size, drop_last=True)
-    batch_sampler = IterationBasedBatchSampler(batch_sampler, args.total_iters)
-    train_dataloader = DataLoader(
-        dataset,
-        batch_sampler=batch_sampler,
-        num_workers=args.num_dataload_workers,
-        worker_init_fn=lambda worker_id: worker_init_fn(worker_id, base_seed=args.seed),
-    )
+    if args.demo_stream: # the dataset is endless and shuffles itself
+        dataset = StreamingDemoDataset_with_history(args.demo_path, history_len=args.context_window,
+                        shuffle_buffer_size=args.shuffle_buffer_size, seed=args.seed)
+        train_dataloader = DataLoader(
+            dataset,
+            batch_size=args.batch_size,
+            num_workers=args.num_dataload_workers,
+            worker_init_fn=lambda worker_id: worker_init_fn(worker_id, base_seed=args.seed),
+            pin_memory=device.type == 'cuda',
+        )
+        train_dataloader = itertools.islice(train_dataloader, args.total_iters)
+    elif args.batched_sampling: # whole batches are gathered on the device, no DataLoader
+        dataset = SmallDemoDataset_with_history(args.demo_path, device, 
+                        history_len=args.context_window, num_traj=args.num_demo_traj, cache=args.demo_cache)
+        train_dataloader = dataset.iter_batches(args.batch_size, args.total_iters, seed=args.seed)
+    else:
+        dataset = SmallDemoDataset_with_history(args.demo_path, device, 
+                        history_len=args.context_window, num_traj=args.num_demo_traj, cache=args.demo_cache)
+        sampler = RandomSampler(dataset, replacement=False)
+        batch_sampler = BatchSampler(sampler, batch_size=args.batch_size, drop_last=True)
+        batch_sampler = IterationBasedBatchSampler(batch_sampler, args.total_iters)
+        train_dataloader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=args.num_dataload_workers,
+            worker_init_fn=lambda worker_id: worker_init_fn(worker_id, base_seed=args.seed),
+        )
 
     # agent setup
     agent = Agent(envs, args).to(device)
@@ -304,10 +424,7 @@ if __name__ == "__main__":
         learning_rate=args.lr,
         betas=[0.9, 0.999],
     )
-    action_dataset = []
-    for action_traj in dataset.trajectories['actions']:
-        action_dataset += action_traj
-    action_dataset = torch.stack(action_dataset, dim=0) # (N, act_dim)
+    action_dataset = torch.cat(dataset.trajectories['actions'], dim=0).to(device) # (N, act_dim)
     agent.net._fit_kmeans_from_action_dataset(action_dataset)
     model = agent
 
@@ -323,6 +440,8 @@ if __name__ == "__main__":
 
     for iteration, data_batch in enumerate(train_dataloader):
         cur_iter = iteration + 1
+        if args.demo_stream: # streaming dataset yields CPU tensors
+            data_batch = {k: v.to(device, non_blocking=True) for k, v in data_batch.items()}
         timer.end('data')
 
         # forward and compute loss
@@ -3,6 +3,7 @@ ALGO_NAME = 'Offline-DiffusionPolicy-UNet'
 import argparse
 import os
 import random
+import time
 from distutils.util import strtobool
 
 import gymnasium as gym
@@ -13,11 +14,13 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torch.utils.tensorboard import SummaryWriter
 
+import copy
 import datetime
+import itertools
 from collections import defaultdict
 from utils.profiling import NonOverlappingTimeProfiler
 
-from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataset import Dataset, IterableDataset
 from torch.utils.data.sampler import RandomSampler, BatchSampler
 from torch.utils.data.dataloader import DataLoader
 from utils.sampler import IterationBasedBatchSampler
@@ -27,6 +30,8 @@ from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
 from diffusers.training_utils import EMAModel
 from diffusers.optimization import get_scheduler
 from nets.diffusion_policy.conditional_unet1d_colab import ConditionalUnet1D
+from nets.diffusion_policy.diffusion_sampler import WarmStart, denoise_early_exit, make_sampler, warm_start_sample
+from utils.torch_utils import compile_inference_fn, quantize_int8
 
 
 def parse_args():
@@ -71,6 +76,20 @@ def parse_args():
     parser.add_argument("--diffusion-step-embed-dim", type=int, default=64) # not very important
     parser.add_argument("--unet-dims", metavar='N', type=int, nargs='+', default=[64, 128, 256]) # ~4.5M params
     parser.add_argument("--n-groups", type=int, default=8) # it seems 4 and 8 are similar
+    parser.add_argument("--eval-sampler", type=str, choices=['ddpm', 'ddim', 'dpmpp'], default='ddpm',
+        help="sampler used for evaluation, the policy is always trained with DDPM")
+    parser.add_argument("--eval-steps", type=int, default=None,
+        help="number of denoising steps of --eval-sampler, default: all training timesteps (100)")
+    parser.add_argument("--warm-start-steps", type=int, default=0,
+        help="if > 0, start each evaluation query from the previous action chunk of the env (shifted and noised) and only run this many of the --eval-steps denoising steps, the first query of an episode runs all of them")
+    parser.add_argument("--early-exit-tol", type=float, default=0.0,
+        help="if > 0, stop denoising a sample once its predicted clean action sequence changes by less than this (max abs, in the normalized action space) between two steps, the other samples continue in a smaller batch")
+    parser.add_argument("--compile-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, torch.compile the whole denoising loop of the evaluated policy (one graph per batch size, also on CPU)")
+    parser.add_argument("--quantize-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, run the UNet of the evaluated policy with dynamic int8 quantized convolutions (CPU only, see check_quantized_policy.py for the action error)")
+    parser.add_argument("--compile-cache-dir", type=str, default=None,
+        help="where to keep the compiled kernels across runs, default: $TORCHINDUCTOR_CACHE_DIR or /tmp/torchinductor_$USER")
 
     # Eval, logging, and others
     parser.add_argument("--output-dir", type=str, default='output')
@@ -81,12 +100,31 @@ def parse_args():
     parser.add_argument("--num-eval-envs", type=int, default=10) # NOTE: should not be too large, otherwise bias to short episodes
     parser.add_argument("--sync-venv", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True)
     parser.add_argument("--num-dataload-workers", type=int, default=0)
+    parser.add_argument("--lazy-demo", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, read demo windows lazily from the h5 file instead of loading everything into memory")
+    parser.add_argument("--demo-cache", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, convert the demo h5 into a flat .npy cache next to it on first use, and load from the cache afterwards")
+    parser.add_argument("--demo-shm", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, put the demo cache (implies --demo-cache) in /dev/shm, so that concurrent runs on the same demo share one copy in memory")
+    parser.add_argument("--demo-stream", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, stream windows shard by shard from --demo-path (e.g. a glob of many h5 files) instead of loading all demos")
+    parser.add_argument("--shuffle-buffer-size", type=int, default=100_000,
+        help="number of windows in the shuffle buffer of --demo-stream")
+    parser.add_argument("--batched-sampling", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, gather whole batches from pre-padded demo tensors on the device instead of using a DataLoader")
+    parser.add_argument("--num-demo-load-workers", type=int, default=0,
+        help="number of processes used to read the demo trajectories, 0 means in the main process")
     parser.add_argument("--control-mode", type=str, default='pd_ee_delta_pose')
     parser.add_argument("--obj-ids", metavar='N', type=str, nargs='+', default=[])
     parser.add_argument("--load-ckpt", type=str, default=None,
         help="path to a pretrained checkpoint to load before training")
+    parser.add_argument("--distill-from", type=str, default=None,
+        help="path to a trained checkpoint (the teacher): instead of training with the diffusion loss, distill its DDIM sampler into a one-step policy with progressive distillation, on the demos of --demo-path")
+    parser.add_argument("--distill-teacher-steps", type=int, default=8,
+        help="number of DDIM steps of the teacher, halved every distillation round down to 1, --total-iters is split evenly between the rounds")
 
     args = parser.parse_args()
+    args.demo_cache = args.demo_cache or args.demo_shm
     args.algo_name = ALGO_NAME
     args.script = __file__
     args.num_eval_envs = min(args.num_eval_envs, args.num_eval_episodes)
@@ -94,18 +132,20 @@ def parse_args():
     if args.num_eval_envs == 1:
         args.sync_venv = True
     if args.demo_path.endswith('.h5'):
-        import json
-        json_file = args.demo_path[:-2] + 'json'
-        with open(json_file, 'r') as f:
-            demo_info = json.load(f)
-            if 'control_mode' in demo_info['env_info']['env_kwargs']:
-                control_mode = demo_info['env_info']['env_kwargs']['control_mode']
-            elif 'control_mode' in demo_info['episodes'][0]:
-                control_mode = demo_info['episodes'][0]['control_mode']
-            else:
-                raise Exception('Control mode not found in json')
-            assert control_mode == args.control_mode, 'Control mode mismatched'
+        from utils.ms_data import expand_demo_paths
+        from utils.demo_manifest import load_demo_manifest
+        # all shards are assumed to share the env config
+        demo_manifest = load_demo_manifest(expand_demo_paths(args.demo_path)[0])
+        assert demo_manifest.control_mode == args.control_mode, 'Control mode mismatched'
+    assert args.lazy_demo + args.demo_cache + args.demo_stream <= 1, '--lazy-demo, --demo-cache and --demo-stream are exclusive'
+    assert not (args.demo_stream and args.num_demo_traj is not None), '--num-demo-traj is not supported with --demo-stream'
+    assert not (args.batched_sampling and (args.lazy_demo or args.demo_stream)), '--batched-sampling needs the demos in memory'
     assert args.obs_horizon + args.act_horizon - 1 <= args.pred_horizon
+    assert not (args.quantize_policy and args.compile_policy), '--quantize-policy and --compile-policy are exclusive'
+    if args.distill_from:
+        assert args.distill_teacher_steps > 1 and args.distill_teacher_steps & (args.distill_teacher_steps - 1) == 0, \
+            '--distill-teacher-steps should be a power of 2'
+        assert args.load_ckpt is None and args.warm_start_steps == 0
     assert args.obs_horizon >= 1 and args.act_horizon >= 1 and args.pred_horizon >= 1
     # fmt: on
     return args
@@ -181,23 +221,47 @@ def make_env(env_id, seed, control_mode=None, video_dir=None, other_kwargs={}):
     return thunk
 
 class SmallDemoDataset_DiffusionPolicy(Dataset): # Load everything into GPU memory
-    def __init__(self, data_path, device, num_traj):
-        from utils.ms_data import load_demo_dataset
-        trajectories = load_demo_dataset(data_path, num_traj=num_traj, concat=False)
+    def __init__(self, data_path, device, num_traj, lazy=False, cache=False, num_workers=0):
+        from utils.ms_data import load_demo_dataset, expand_demo_paths
+        from utils.demo_manifest import load_demo_manifest
+        # action stats and windows are read from the manifest, they are only computed here for sharded demos
+        manifest = load_demo_manifest(data_path) if len(expand_demo_paths(data_path)) == 1 else None
+        if cache: # trajectories are already tensors on device, views of one flat tensor per field
+            from utils.demo_cache import load_demo_cache, SHM_CACHE_ROOT
+            demo_cache = load_demo_cache(data_path, args.control_mode, root=SHM_CACHE_ROOT if args.demo_shm else None)
+            trajectories = demo_cache.load_trajectories(num_traj=num_traj, device=device)
+        else:
+            trajectories = load_demo_dataset(data_path, num_traj=num_traj, concat=False, lazy=lazy, num_workers=num_workers)
         # trajectories['observations'] is a list of np.ndarray (L+1, obs_dim)
         # trajectories['actions'] is a list of np.ndarray (L, act_dim)
+        # if lazy, trajectories is a TrajectoryStore, and only the windows in __getitem__ are read (on CPU)
+        self.lazy = lazy
+        if lazy:
+            self.store = trajectories
+            trajectories = {'actions': self.store.load('actions')} # actions are small, keep them in memory
+            device = torch.device('cpu')
 
         # Compute action statistics for normalization
-        all_actions = np.concatenate(trajectories['actions'], axis=0)
-        self.action_mean = torch.Tensor(all_actions.mean(axis=0)).to(device)
-        self.action_std = torch.Tensor(all_actions.std(axis=0)).to(device)
+        if manifest is not None:
+            traj_keys = manifest.select_traj_keys(num_traj)
+            action_stats = manifest.action_stats(traj_keys)
+            self.action_mean = torch.Tensor(action_stats['mean']).to(device)
+            self.action_std = torch.Tensor(action_stats['std']).to(device)
+        else:
+            if cache:
+                all_actions = torch.cat(trajectories['actions'], dim=0).cpu().numpy()
+            else:
+                all_actions = np.concatenate(trajectories['actions'], axis=0)
+            self.action_mean = torch.Tensor(all_actions.mean(axis=0)).to(device)
+            self.action_std = torch.Tensor(all_actions.std(axis=0)).to(device)
         self.action_std = torch.clamp(self.action_std, min=1e-6)  # avoid division by zero
         print(f'[ACTION STATS] mean: {self.action_mean.cpu().numpy()}')
         print(f'[ACTION STATS] std: {self.action_std.cpu().numpy()}')
 
-        for k, v in trajectories.items():
-            for i in range(len(v)):
-                trajectories[k][i] = torch.Tensor(v[i]).to(device)
+        if not cache:
+            for k, v in trajectories.items():
+                for i in range(len(v)):
+                    trajectories[k][i] = torch.Tensor(v[i]).to(device)
 
         # Pre-compute all possible (traj_idx, start, end) tuples, this is very specific to Diffusion Policy
         if 'delta_pos' in args.control_mode or args.control_mode == 'base_pd_joint_vel_arm_pd_joint_vel':
@@ -206,15 +270,25 @@ class SmallDemoDataset_DiffusionPolicy(Dataset): # Load everything into GPU memo
             # gripper action needs to be copied from the last action
         else:
             raise NotImplementedError(f'Control Mode {args.control_mode} not supported')
-        self.obs_horizon, self.pred_horizon = obs_horizon, pred_horizon = args.obs_horizon, args.pred_horizon
-        self.slices = []
-        num_traj = len(trajectories['actions'])
-        total_transitions = 0
-        for traj_idx in range(num_traj):
-            L = trajectories['actions'][traj_idx].shape[0]
-            assert trajectories['observations'][traj_idx].shape[0] == L + 1
-            total_transitions += L
+        self.obs_horizon, self.pred_horizon = args.obs_horizon, args.pred_horizon
+        lengths = [a.shape[0] for a in trajectories['actions']]
+        if not lazy:
+            for obs_traj, L in zip(trajectories['observations'], lengths):
+                assert obs_traj.shape[0] == L + 1
+        if manifest is not None:
+            assert np.array_equal(manifest.lengths[manifest.traj_indices(traj_keys)], lengths)
+            self.slices = manifest.windows(('dp', self.obs_horizon, self.pred_horizon), traj_keys)
+        else:
+            self.slices = self.get_slices(lengths)
+        print(f"Total transitions: {sum(lengths)}, Total obs sequences: {len(self.slices)}")
 
+        self.trajectories = trajectories
+
+    def get_slices(self, lengths):
+        # all (traj_idx, start, end) windows of trajectories with these lengths
+        obs_horizon, pred_horizon = self.obs_horizon, self.pred_horizon
+        slices = []
+        for traj_idx, L in enumerate(lengths):
             # |o|o|                             observations: 2
             # | |a|a|a|a|a|a|a|a|               actions executed: 8
             # |p|p|p|p|p|p|p|p|p|p|p|p|p|p|p|p| actions predicted: 16
@@ -224,21 +298,23 @@ class SmallDemoDataset_DiffusionPolicy(Dataset): # Load everything into GPU memo
             pad_after = pred_horizon - obs_horizon
             # Pad after the trajectory, so all the observations are utilized in training
             # Note that in the original code, pad_after = act_horizon - 1, but I think this is not the best choice
-            self.slices += [
+            slices += [
                 (traj_idx, start, start + pred_horizon) for start in range(-pad_before, L - pred_horizon + pad_after)
             ]  # slice indices follow convention [start, end)
-        
-        print(f"Total transitions: {total_transitions}, Total obs sequences: {len(self.slices)}")
-
-        self.trajectories = trajectories
+        return slices
 
     def __getitem__(self, index):
-        traj_idx, start, end = self.slices[index]
-        L, act_dim = self.trajectories['actions'][traj_idx].shape
+        return self.get_window(self.trajectories, *self.slices[index])
 
-        obs_seq = self.trajectories['observations'][traj_idx][max(0, start):start+self.obs_horizon]
+    def get_window(self, trajectories, traj_idx, start, end):
+        L, act_dim = trajectories['actions'][traj_idx].shape
+
+        if self.lazy:
+            obs_seq = torch.from_numpy(self.store.read(traj_idx, 'observations', max(0, start), start+self.obs_horizon)).float()
+        else:
+            obs_seq = trajectories['observations'][traj_idx][max(0, start):start+self.obs_horizon]
         # start+self.obs_horizon is at least 1
-        act_seq = self.trajectories['actions'][traj_idx][max(0, start):end]
+        act_seq = trajectories['actions'][traj_idx][max(0, start):end]
         if start < 0: # pad before the trajectory
             obs_seq = torch.cat([obs_seq[0].repeat(-start, 1), obs_seq], dim=0)
             act_seq = torch.cat([act_seq[0].repeat(-start, 1), act_seq], dim=0)
@@ -260,6 +336,110 @@ class SmallDemoDataset_DiffusionPolicy(Dataset): # Load everything into GPU memo
     def __len__(self):
         return len(self.slices)
 
+    def build_batched_storage(self):
+        """
+        Storage for `get_batch` / `iter_batches`: the trajectories pre-padded (as in `get_window`) and the actions
+        pre-normalized, concatenated in one tensor per key, and every window as the flat start rows of its
+        obs / actions in a compact (N, 2) int32 tensor, on the device of the data.
+        """
+        obs_trajs, act_trajs = self.trajectories['observations'], self.trajectories['actions']
+        device = act_trajs[0].device
+        slices = torch.as_tensor(np.asarray(self.slices, dtype=np.int64).reshape(-1, 3))
+        lengths = torch.tensor([len(a) for a in act_trajs])
+        pad_before = self.obs_horizon - 1
+        pad_after = max(int((slices[:, 2] - lengths[slices[:, 0]]).max()), 0)
+        obs_flat, act_flat = [], []
+        for obs_traj, act_traj in zip(obs_trajs, act_trajs):
+            obs_flat += [obs_traj[:1].repeat(pad_before, 1), obs_traj]
+            pad_action = torch.cat((self.pad_action_arm, act_traj[-1, -1:]), dim=0) # stay still, see get_window
+            act_seq = torch.cat([act_traj[:1].repeat(pad_before, 1), act_traj, pad_action.repeat(pad_after, 1)], dim=0)
+            act_flat.append((act_seq - self.action_mean) / self.action_std)
+        self.obs_flat, self.act_flat = torch.cat(obs_flat), torch.cat(act_flat)
+        obs_offsets = torch.cumsum(lengths + 1 + pad_before, 0) - (lengths + 1 + pad_before)
+        act_offsets = torch.cumsum(lengths + pad_before + pad_after, 0) - (lengths + pad_before + pad_after)
+        window_starts = torch.stack([obs_offsets[slices[:, 0]], act_offsets[slices[:, 0]]], dim=1) + pad_before + slices[:, 1:2]
+        index_dtype = torch.int32 if len(self.obs_flat) < 2**31 and len(self.act_flat) < 2**31 else torch.int64
+        self.window_starts = window_starts.to(index_dtype).to(device)
+        self.obs_arange = torch.arange(self.obs_horizon, device=device)
+        self.act_arange = torch.arange(self.pred_horizon, device=device)
+        print(f'Batched storage: {len(self.obs_flat)} obs rows, {len(self.act_flat)} action rows, {len(self.window_starts)} windows')
+
+    def get_batch(self, indices):
+        # the windows `indices` (a tensor on the device) as one batch, same values as stacking `self[i]`
+        starts = self.window_starts[indices].long()
+        return {
+            'observations': self.obs_flat[starts[:, :1] + self.obs_arange], # (B, obs_horizon, obs_dim)
+            'actions': self.act_flat[starts[:, 1:] + self.act_arange], # (B, pred_horizon, act_dim)
+        }
+
+    def iter_batches(self, batch_size, total_iters, seed):
+        # replaces the DataLoader: RandomSampler + BatchSampler(drop_last=True) + IterationBasedBatchSampler, on the device
+        n = len(self.window_starts)
+        assert n >= batch_size, f'{n} windows < batch size {batch_size}'
+        generator = torch.Generator(device=self.window_starts.device)
+        generator.manual_seed(seed)
+        iteration = 0
+        while True:
+            perm = torch.randperm(n, device=self.window_starts.device, generator=generator)
+            for i in range(n // batch_size):
+                if iteration >= total_iters:
+                    return
+                yield self.get_batch(perm[i*batch_size:(i+1)*batch_size])
+                iteration += 1
+
+class StreamingDemoDataset_DiffusionPolicy(SmallDemoDataset_DiffusionPolicy, IterableDataset):
+    """
+    Same windows as SmallDemoDataset_DiffusionPolicy, but streamed from a (large) set of demo shards:
+    each dataloader worker only holds the shard it is reading plus the shuffle buffer. Yields CPU tensors, forever.
+    """
+    def __init__(self, data_path, shuffle_buffer_size, seed):
+        from utils.ms_data import expand_demo_paths
+        from utils.demo_manifest import load_demo_manifest
+        self.paths = expand_demo_paths(data_path)
+        self.shuffle_buffer_size, self.seed = shuffle_buffer_size, seed
+        self.lazy = False
+        self.obs_horizon, self.pred_horizon = args.obs_horizon, args.pred_horizon
+
+        # Compute action statistics for normalization, from the manifests of all shards
+        n, act_sum, act_sq_sum, num_windows = 0, 0, 0, 0
+        for path in self.paths:
+            manifest = load_demo_manifest(path)
+            action_stats = manifest.action_stats()
+            n += action_stats['n']
+            act_sum = act_sum + action_stats['sum']
+            act_sq_sum = act_sq_sum + action_stats['sq_sum']
+            num_windows += len(manifest.windows(('dp', self.obs_horizon, self.pred_horizon)))
+        action_mean = act_sum / n
+        self.action_mean = torch.Tensor(action_mean)
+        self.action_std = torch.Tensor(np.sqrt(np.maximum(act_sq_sum / n - action_mean ** 2, 0)))
+        self.action_std = torch.clamp(self.action_std, min=1e-6)  # avoid division by zero
+        print(f'[ACTION STATS] mean: {self.action_mean.numpy()}')
+        print(f'[ACTION STATS] std: {self.action_std.numpy()}')
+        self.num_windows = num_windows
+        print(f"Total transitions: {n}, Total obs sequences: {num_windows}, in {len(self.paths)} shards")
+
+        if 'delta_pos' in args.control_mode or args.control_mode == 'base_pd_joint_vel_arm_pd_joint_vel':
+            self.pad_action_arm = torch.zeros((len(action_mean)-1,))
+        else:
+            raise NotImplementedError(f'Control Mode {args.control_mode} not supported')
+
+    def make_windows(self, trajectories, rng):
+        trajectories = {k: [torch.from_numpy(t).float() for t in v] for k, v in trajectories.items()}
+        slices = self.get_slices([len(a) for a in trajectories['actions']])
+        for i in rng.permutation(len(slices)):
+            window = self.get_window(trajectories, *slices[i])
+            window['observations'] = window['observations'].clone() # don't keep the shard alive in the shuffle buffer
+            yield window
+
+    def __iter__(self):
+        from utils.ms_data import stream_demo_windows
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        return stream_demo_windows(self.paths, self.make_windows, self.shuffle_buffer_size, self.seed, worker_id, num_workers)
+
+    def __len__(self): # windows per pass over all shards
+        return self.num_windows
+
 
 class Agent(nn.Module):
     def __init__(self, env, args, action_mean=None, action_std=None):
@@ -291,9 +471,18 @@ class Agent(nn.Module):
             clip_sample=True, # clip output to [-1,1] to improve stability
             prediction_type='epsilon' # predict noise (instead of denoised action)
         )
+        # sampler for inference (native, without the per-step overhead of noise_scheduler.step)
+        self.sampler = make_sampler(self.noise_scheduler, args.eval_sampler, args.eval_steps)
+        assert args.warm_start_steps <= self.sampler.num_steps
+        self.denoise_fn = self.denoise
+        self.early_exit_tol = args.early_exit_tol
 
         self.get_eval_action = self.get_action
 
+    def prepare_inference(self):
+        # precompute the diffusion step embeddings of the inference timesteps, call again after the weights change
+        self.noise_pred_net.set_inference_timesteps(self.sampler.timesteps)
+
     # def forward(self, obs_seq):
     #     raise NotImplementedError()
     
@@ -322,8 +511,67 @@ class Agent(nn.Module):
             noisy_action_seq, timesteps, global_cond=obs_cond)
 
         return F.mse_loss(noise_pred, noise)
+
+    def compute_distill_loss(self, teacher, obs_seq, action_seq):
+        # progressive distillation (Salimans & Ho, 2022): one DDIM step of this policy (self.sampler) should land
+        # where two DDIM steps of the teacher (teacher.sampler, twice as many steps) land from the same sample
+        B = obs_seq.shape[0]
+        obs_cond = obs_seq.flatten(start_dim=1) # (B, obs_horizon * obs_dim)
+        noise = torch.randn((B, self.pred_horizon, self.act_dim), device=device)
+        steps = torch.randint(0, self.sampler.num_steps, (B,), device=device)
+        sqrt_beta_prod_t = self.sampler.coefs[steps, 0].view(B, 1, 1)
+        sqrt_alpha_prod_t = self.sampler.coefs[steps, 1].view(B, 1, 1)
+        noisy_action_seq = sqrt_alpha_prod_t * action_seq + sqrt_beta_prod_t * noise
+        # the first step starts from pure noise, as at inference
+        noisy_action_seq = torch.where(steps.view(B, 1, 1) == 0, noise, noisy_action_seq)
+
+        # x0 target: the one that a DDIM step from noisy_action_seq turns into the result of the two teacher steps
+        target = torch.empty_like(noisy_action_seq)
+        with torch.no_grad():
+            for i in range(self.sampler.num_steps):
+                rows = torch.nonzero(steps == i).squeeze(1)
+                if len(rows) == 0:
+                    continue
+                x_t = noisy_action_seq[rows]
+                x_s = teacher.denoise(obs_cond[rows], x_t, 2 * i, 2 * i + 2)
+                sqrt_beta_t, sqrt_alpha_t, sqrt_alpha_s, sqrt_beta_s = self.sampler.coefs[i, :4]
+                ratio = sqrt_beta_s / sqrt_beta_t
+                target[rows] = (x_s - ratio * x_t) / (sqrt_alpha_s - ratio * sqrt_alpha_t)
+
+        noise_pred = self.noise_pred_net(
+            noisy_action_seq, self.sampler.timesteps[steps], global_cond=obs_cond)
+        pred_original_sample = (noisy_action_seq - sqrt_beta_prod_t * noise_pred) / sqrt_alpha_prod_t
+        # x0 error weighted by max(SNR, 1) ("truncated SNR" weighting)
+        weight = torch.clamp(sqrt_alpha_prod_t ** 2 / sqrt_beta_prod_t ** 2, min=1)
+        return (weight * (pred_original_sample - target) ** 2).mean()
+
+    def set_sampler(self, sampler):
+        self.sampler = sampler.to(self.action_mean.device)
+        self.prepare_inference()
     
-    def get_action(self, obs_seq):
+    def denoise(self, obs_cond, noisy_action_seq, first_step=0, last_step=None):
+        # the denoising loop, from Gaussian noise to the action sequence (one graph with --compile-policy)
+        # runs the steps [first_step, last_step), all of them by default
+        # obs part of the FiLM conditioning, the same for all denoising steps
+        prepared_cond = self.noise_pred_net.prepare_conditioning(obs_cond)
+        solver_state = {} # for multistep solvers (dpmpp)
+        for i in range(first_step, self.sampler.num_steps if last_step is None else last_step):
+            # predict noise
+            noise_pred = self.noise_pred_net(
+                sample=noisy_action_seq,
+                timestep=self.sampler.timesteps[i],
+                prepared_cond=prepared_cond,
+                step_index=self.noise_pred_net.inference_step_indices[i], # precomputed embedding of timesteps[i]
+            )
+
+            # inverse diffusion step (remove noise)
+            noisy_action_seq = self.sampler.step(i, noise_pred, noisy_action_seq, solver_state)
+        return noisy_action_seq
+
+    def compile_inference(self, cache_dir=None):
+        self.denoise_fn = compile_inference_fn(self.denoise, cache_dir)
+
+    def get_action(self, obs_seq, warm_start=None, denoise_steps=None):
         # init scheduler
         # self.noise_scheduler.set_timesteps(self.num_diffusion_iters)
         # set_timesteps will change noise_scheduler.timesteps is only used in noise_scheduler.step()
@@ -338,20 +586,21 @@ class Agent(nn.Module):
             # initialize action from Guassian noise
             noisy_action_seq = torch.randn((B, self.pred_horizon, self.act_dim), device=obs_seq.device)
 
-            for k in self.noise_scheduler.timesteps:
-                # predict noise
-                noise_pred = self.noise_pred_net(
-                    sample=noisy_action_seq,
-                    timestep=k,
-                    global_cond=obs_cond,
-                )
-
-                # inverse diffusion step (remove noise)
-                noisy_action_seq = self.noise_scheduler.step(
-                    model_output=noise_pred,
-                    timestep=k,
-                    sample=noisy_action_seq,
-                ).prev_sample
+            first_step, warm_start_steps = 0, 0
+            if warm_start is not None and warm_start.valid.any():
+                noisy_action_seq, first_step, warm_start_steps = warm_start_sample(
+                    self.denoise_fn, self.sampler, obs_cond, noisy_action_seq, warm_start, fixed_batch=self.denoise_fn != self.denoise) # the compiled graph has static shapes
+            if self.early_exit_tol > 0:
+                noisy_action_seq, num_steps = denoise_early_exit(
+                    self.noise_pred_net, self.sampler, obs_cond, noisy_action_seq, self.early_exit_tol, first_step)
+            else:
+                noisy_action_seq = self.denoise_fn(obs_cond, noisy_action_seq, first_step)
+                num_steps = np.full(B, self.sampler.num_steps - first_step)
+            num_steps = num_steps + warm_start_steps # the UNet steps run for each env before first_step
+            if warm_start is not None:
+                warm_start.update(noisy_action_seq)
+            if denoise_steps is not None:
+                denoise_steps.append(num_steps) # number of UNet steps actually run for each env, for logging
 
         # only take act_horizon number of actions
         start = self.obs_horizon - 1
@@ -379,9 +628,16 @@ def collect_episode_info(infos, result=None):
 
 def evaluate(n, agent, eval_envs, device):
     agent.eval()
+    agent.prepare_inference() # the weights changed since the last evaluation
+    if args.quantize_policy: # evaluate an int8 copy, the trained weights stay fp32
+        assert device.type == 'cpu', '--quantize-policy is only supported on CPU (--cuda False)'
+        agent = copy.deepcopy(agent)
+        quantize_int8(agent.noise_pred_net)
     print('======= Evaluation Starts =========')
     result = defaultdict(list)
     obs, info = eval_envs.reset() # don't seed here
+    warm_start = WarmStart(args.num_eval_envs, args.act_horizon, args.warm_start_steps) if args.warm_start_steps > 0 else None
+    denoise_steps = []
 
     # DEBUG: Check observation and action shapes/values
     print(f'[DEBUG] Initial obs shape: {obs.shape}, dtype: {obs.dtype}')
@@ -391,9 +647,11 @@ def evaluate(n, agent, eval_envs, device):
     step_count = 0
     action_stats = []
     while len(result['return']) < n:
+        query_start = time.perf_counter()
         with torch.no_grad():
             obs_tensor = torch.Tensor(obs).to(device)
-            action = agent.get_eval_action(obs_tensor)
+            action = agent.get_eval_action(obs_tensor, warm_start=warm_start, denoise_steps=denoise_steps).cpu() # the query is over once the action is on the host
+        result['query_latency_ms'].append((time.perf_counter() - query_start) * 1000)
 
         # DEBUG: Log first few actions
         if step_count < 3:
@@ -409,6 +667,8 @@ def evaluate(n, agent, eval_envs, device):
         })
 
         obs, rew, terminated, truncated, info = eval_envs.step(action.cpu().numpy())
+        if warm_start is not None:
+            warm_start.reset(terminated | truncated)
         collect_episode_info(info, result)
         step_count += 1
 
@@ -421,6 +681,12 @@ def evaluate(n, agent, eval_envs, device):
         if avg_abs_mean < 0.01:
             print(f'[DEBUG] ⚠️  WARNING: Actions are very small! Model may be predicting near-zero.')
 
+    result['denoise_steps_per_query'] = np.concatenate(denoise_steps)
+    latency = result['query_latency_ms']
+    print(f'{agent.sampler.mode} sampler, {agent.sampler.num_steps} steps: '
+          f'{np.mean(latency):.2f} ms per query (median {np.median(latency):.2f} ms)')
+    steps, counts = np.unique(result['denoise_steps_per_query'], return_counts=True)
+    print('UNet steps run per env query: ' + ', '.join(f'{k}: {c / counts.sum():.1%}' for k, c in zip(steps, counts)))
     print('======= Evaluation Ends =========')
     agent.train()
     return result
@@ -431,6 +697,7 @@ def save_ckpt(tag):
     torch.save({
         'agent': agent.state_dict(),
         'ema_agent': ema_agent.state_dict(),
+        'sampler_config': ema_agent.sampler.config, # for a distilled policy, the sampler it was distilled for
     }, f'{log_path}/checkpoints/{tag}.pt')
 
 if __name__ == "__main__":
@@ -489,32 +756,53 @@ if __name__ == "__main__":
 
     # dataloader setup
     print('[INIT] Loading demo dataset...')
-    dataset = SmallDemoDataset_DiffusionPolicy(args.demo_path, device, num_traj=args.num_demo_traj)
+    if args.demo_stream:
+        dataset = StreamingDemoDataset_DiffusionPolicy(args.demo_path, args.shuffle_buffer_size, seed=args.seed)
+    else:
+        dataset = SmallDemoDataset_DiffusionPolicy(args.demo_path, device, num_traj=args.num_demo_traj,
+                                                   lazy=args.lazy_demo, cache=args.demo_cache, num_workers=args.num_demo_load_workers)
     print(f'[INIT] Dataset loaded: {len(dataset)} samples')
-    sampler = RandomSampler(dataset, replacement=False)
-    batch_sampler = BatchSampler(sampler, batch_size=args.batch_size, drop_last=True)
-    batch_sampler = IterationBasedBatchSampler(batch_sampler, args.total_iters)
-    train_dataloader = DataLoader(
-        dataset,
-        batch_sampler=batch_sampler,
-        num_workers=args.num_dataload_workers,
-        worker_init_fn=lambda worker_id: worker_init_fn(worker_id, base_seed=args.seed),
-    )
+    if args.batched_sampling: # whole batches are gathered on the device, no DataLoader
+        dataset.build_batched_storage()
+        train_dataloader = dataset.iter_batches(args.batch_size, args.total_iters, seed=args.seed)
+    elif args.demo_stream: # the dataset is endless and shuffles itself
+        train_dataloader = DataLoader(
+            dataset,
+            batch_size=args.batch_size,
+            num_workers=args.num_dataload_workers,
+            worker_init_fn=lambda worker_id: worker_init_fn(worker_id, base_seed=args.seed),
+            pin_memory=device.type == 'cuda',
+        )
+        train_dataloader = itertools.islice(train_dataloader, args.total_iters)
+    else:
+        sampler = RandomSampler(dataset, replacement=False)
+        batch_sampler = BatchSampler(sampler, batch_size=args.batch_size, drop_last=True)
+        batch_sampler = IterationBasedBatchSampler(batch_sampler, args.total_iters)
+        train_dataloader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=args.num_dataload_workers,
+            worker_init_fn=lambda worker_id: worker_init_fn(worker_id, base_seed=args.seed),
+            pin_memory=args.lazy_demo and device.type == 'cuda',
+        )
 
     # agent setup
     print('[INIT] Creating agent...')
-    agent = Agent(envs, args, action_mean=dataset.action_mean, action_std=dataset.action_std).to(device)
+    agent = Agent(envs, args, action_mean=dataset.action_mean.to(device), action_std=dataset.action_std.to(device)).to(device)
     print('[INIT] Creating optimizer...')
     optimizer = optim.AdamW(params=agent.parameters(),
         lr=args.lr, betas=(0.95, 0.999), weight_decay=1e-6)
 
     # Cosine LR schedule with linear warmup
     print('[INIT] Creating LR scheduler...')
+    # with --distill-from, one schedule per distillation round
+    num_distill_rounds = int(np.log2(args.distill_teacher_steps)) if args.distill_from else 1
+    iters_per_round = args.total_iters // num_distill_rounds
     lr_scheduler = get_scheduler(
         name='cosine',
         optimizer=optimizer,
         num_warmup_steps=500,
-        num_training_steps=args.total_iters,
+        num_training_steps=iters_per_round,
     )
 
     # Exponential Moving Average
@@ -522,7 +810,9 @@ if __name__ == "__main__":
     # holds a copy of the model weights
     print('[INIT] Creating EMA model...')
     ema = EMAModel(parameters=agent.parameters(), power=0.75)
-    ema_agent = Agent(envs, args, action_mean=dataset.action_mean, action_std=dataset.action_std).to(device)
+    ema_agent = Agent(envs, args, action_mean=dataset.action_mean.to(device), action_std=dataset.action_std.to(device)).to(device)
+    if args.compile_policy:
+        ema_agent.compile_inference(args.compile_cache_dir)
 
     # Load pretrained checkpoint if provided
     if args.load_ckpt:
@@ -552,6 +842,23 @@ if __name__ == "__main__":
         ema = EMAModel(parameters=agent.parameters(), power=0.75)
         print('[INIT] Pretrained checkpoint loaded successfully!')
 
+    # Progressive distillation: the teacher and the student start from the trained checkpoint,
+    # every round halves the number of DDIM steps of the student
+    if args.distill_from:
+        print(f'[INIT] Loading the distillation teacher from {args.distill_from}...')
+        ckpt = torch.load(args.distill_from, map_location=device)
+        teacher = Agent(envs, args).to(device)
+        teacher.load_state_dict(ckpt['ema_agent'] if 'ema_agent' in ckpt else ckpt['agent'])
+        teacher.eval()
+        teacher.requires_grad_(False)
+        teacher.set_sampler(make_sampler(teacher.noise_scheduler, 'ddim', args.distill_teacher_steps))
+        agent.load_state_dict(teacher.state_dict()) # also the action stats of the teacher
+        ema_agent.load_state_dict(teacher.state_dict())
+        ema = EMAModel(parameters=agent.parameters(), power=0.75)
+        agent.set_sampler(teacher.sampler.distillation_student())
+        ema_agent.set_sampler(teacher.sampler.distillation_student())
+        print(f'[INIT] Distillation round 1/{num_distill_rounds}: {teacher.sampler.num_steps} -> {agent.sampler.num_steps} steps')
+
     print('[INIT] Initialization complete!')
     print('=' * 70)
 
@@ -566,13 +873,31 @@ if __name__ == "__main__":
 
     for iteration, data_batch in enumerate(train_dataloader):
         cur_iter = iteration + 1
+        if args.distill_from and iteration > 0 and iteration % iters_per_round == 0 and agent.sampler.num_steps > 1:
+            # next distillation round: the student (EMA weights) is the teacher of a student with half as many steps
+            save_ckpt(f'distill_{agent.sampler.num_steps}_steps') # also copies the EMA weights to ema_agent
+            teacher.load_state_dict(ema_agent.state_dict())
+            teacher.set_sampler(agent.sampler)
+            agent.load_state_dict(ema_agent.state_dict())
+            ema = EMAModel(parameters=agent.parameters(), power=0.75)
+            agent.set_sampler(teacher.sampler.distillation_student())
+            ema_agent.set_sampler(teacher.sampler.distillation_student())
+            lr_scheduler = get_scheduler(name='cosine', optimizer=optimizer, num_warmup_steps=500, num_training_steps=iters_per_round)
+            best_success_rate = -1 # the best checkpoint is the one of the last round
+            print(f'Distillation round {iteration // iters_per_round + 1}/{num_distill_rounds}: '
+                  f'{teacher.sampler.num_steps} -> {agent.sampler.num_steps} steps')
+        if args.lazy_demo or args.demo_stream: # lazy / streaming datasets yield CPU tensors
+            data_batch = {k: v.to(device, non_blocking=True) for k, v in data_batch.items()}
         timer.end('data')
 
         # forward and compute loss
-        total_loss = agent.compute_loss(
-            obs_seq=data_batch['observations'], # (B, L, obs_dim)
-            action_seq=data_batch['actions'], # (B, L, act_dim)
-        )
+        if args.distill_from:
+            total_loss = agent.compute_distill_loss(teacher, data_batch['observations'], data_batch['actions'])
+        else:
+            total_loss = agent.compute_loss(
+                obs_seq=data_batch['observations'], # (B, L, obs_dim)
+                action_seq=data_batch['actions'], # (B, L, act_dim)
+            )
         timer.end('forward')
 
         # backward
@@ -611,5 +936,7 @@ if __name__ == "__main__":
         if args.save_freq and cur_iter % args.save_freq == 0:
             save_ckpt(str(cur_iter))
 
+    if args.distill_from:
+        save_ckpt(f'distill_{agent.sampler.num_steps}_steps')
     envs.close()
     writer.close()
@@ -3,6 +3,7 @@ ALGO_NAME = 'Offline-DiffusionPolicy-UNet-RGBD'
 import argparse
 import os
 import random
+import time
 from distutils.util import strtobool
 import json
 
@@ -14,6 +15,7 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torch.utils.tensorboard import SummaryWriter
 
+import copy
 import datetime
 from collections import defaultdict, deque
 from utils.profiling import NonOverlappingTimeProfiler
@@ -28,6 +30,8 @@ from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
 from diffusers.training_utils import EMAModel
 from diffusers.optimization import get_scheduler
 from nets.diffusion_policy.conditional_unet1d_colab import ConditionalUnet1D
+from nets.diffusion_policy.diffusion_sampler import WarmStart, denoise_early_exit, make_sampler, warm_start_sample
+from utils.torch_utils import compile_inference_fn, quantize_int8
 from nets.cnn.plain_conv import PlainConv, PlainConv_MS1
 
 from online.pi_dec_diffusion_maniskill2_rgbd import make_env, MS2_RGBDObsWrapper
@@ -77,6 +81,20 @@ def parse_args():
     parser.add_argument("--diffusion-step-embed-dim", type=int, default=64) # not very important
     parser.add_argument("--unet-dims", metavar='N', type=int, nargs='+', default=[64, 128, 256]) # ~4.5M params
     parser.add_argument("--n-groups", type=int, default=8)
+    parser.add_argument("--eval-sampler", type=str, choices=['ddpm', 'ddim', 'dpmpp'], default='ddpm',
+        help="sampler used for evaluation, the policy is always trained with DDPM")
+    parser.add_argument("--eval-steps", type=int, default=None,
+        help="number of denoising steps of --eval-sampler, default: all training timesteps (100)")
+    parser.add_argument("--warm-start-steps", type=int, default=0,
+        help="if > 0, start each evaluation query from the previous action chunk of the env (shifted and noised) and only run this many of the --eval-steps denoising steps, the first query of an episode runs all of them")
+    parser.add_argument("--early-exit-tol", type=float, default=0.0,
+        help="if > 0, stop denoising a sample once its predicted clean action sequence changes by less than this (max abs, in the normalized action space) between two steps, the other samples continue in a smaller batch")
+    parser.add_argument("--compile-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, torch.compile the whole denoising loop of the evaluated policy (one graph per batch size, also on CPU)")
+    parser.add_argument("--quantize-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, run the UNet of the evaluated policy with dynamic int8 quantized convolutions (CPU only, see check_quantized_policy.py for the action error)")
+    parser.add_argument("--compile-cache-dir", type=str, default=None,
+        help="where to keep the compiled kernels across runs, default: $TORCHINDUCTOR_CACHE_DIR or /tmp/torchinductor_$USER")
     # it seems 4 and 8 are similar
 
     # Eval, logging, and others
@@ -87,31 +105,40 @@ def parse_args():
     parser.add_argument("--num-eval-episodes", type=int, default=100)
     parser.add_argument("--num-eval-envs", type=int, default=10) # NOTE: should not be too large, otherwise bias to short episodes
     parser.add_argument("--num-dataload-workers", type=int, default=0)
+    parser.add_argument("--lazy-demo", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, read demo windows lazily from the h5 file instead of loading everything into memory")
+    parser.add_argument("--demo-cache", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, convert the demo h5 into a flat .npy cache next to it on first use, and load from the cache afterwards")
+    parser.add_argument("--demo-shm", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, put the demo cache (implies --demo-cache) in /dev/shm, so that concurrent runs on the same demo share one copy in memory")
+    parser.add_argument("--prefetch", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, assemble batches in a background thread into pinned buffers and copy them to the device ahead of time, instead of using a DataLoader")
+    parser.add_argument("--num-demo-load-workers", type=int, default=0,
+        help="number of processes used to read and pre-process the demo trajectories, 0 means in the main process")
     parser.add_argument("--control-mode", type=str, default='pd_ee_delta_pose')
     parser.add_argument("--obj-ids", metavar='N', type=str, nargs='+', default=[])
     parser.add_argument("--random-shift", type=int, default=0)
 
     args = parser.parse_args()
+    args.demo_cache = args.demo_cache or args.demo_shm
     args.algo_name = ALGO_NAME
     args.script = __file__
     args.num_eval_envs = min(args.num_eval_envs, args.num_eval_episodes)
     assert args.num_eval_episodes % args.num_eval_envs == 0
     if args.demo_path.endswith('.h5'):
-        json_file = args.demo_path[:-2] + 'json'
-        with open(json_file, 'r') as f:
-            demo_info = json.load(f)
-            if 'control_mode' in demo_info['env_info']['env_kwargs']:
-                control_mode = demo_info['env_info']['env_kwargs']['control_mode']
-            elif 'control_mode' in demo_info['episodes'][0]:
-                control_mode = demo_info['episodes'][0]['control_mode']
-            else:
-                raise Exception('Control mode not found in json')
-            assert control_mode == args.control_mode, 'Control mode mismatched'
+        from utils.ms_data import expand_demo_paths
+        from utils.demo_manifest import load_demo_manifest
+        # all shards are assumed to share the env config
+        demo_manifest = load_demo_manifest(expand_demo_paths(args.demo_path)[0])
+        assert demo_manifest.control_mode == args.control_mode, 'Control mode mismatched'
     else:
         raise NotImplementedError(f"Demo path {args.demo_path} is not supported, only .h5 files are supported")
+    assert not (args.lazy_demo and args.demo_cache), '--lazy-demo and --demo-cache are exclusive'
+    assert not (args.prefetch and args.lazy_demo), '--prefetch needs the demos in memory'
     assert args.obs_horizon + args.act_horizon - 1 <= args.pred_horizon
+    assert not (args.quantize_policy and args.compile_policy), '--quantize-policy and --compile-policy are exclusive'
     assert args.obs_horizon >= 1 and args.act_horizon >= 1 and args.pred_horizon >= 1
-    demo_cam_cfgs = demo_info['env_info']['env_kwargs']['camera_cfgs']
+    demo_cam_cfgs = demo_manifest.env_kwargs['camera_cfgs']
     args.image_size = (demo_cam_cfgs['height'], demo_cam_cfgs['width'])
     # fmt: on
     return args
@@ -120,34 +147,61 @@ def parse_args():
 def reorder_keys(d, ref_dict):
     out = dict()
     for k, v in ref_dict.items():
+        if k not in d: # not loaded from the demo, see DEMO_OBS_KEYS
+            continue
         if isinstance(v, dict) or isinstance(v, spaces.Dict):
             out[k] = reorder_keys(d[k], ref_dict[k])
         else:
             out[k] = d[k]
     return out
 
+# only these parts of the demo obs are used by MS2_RGBDObsWrapper.convert_obs, the rest (camera params, etc.) is never read
+DEMO_OBS_KEYS = ['agent', 'extra', 'rgb', 'depth']
+
+def process_obs_traj_np(obs_traj_dict, obs_process_fn, obs_space):
+    # make the demo obs align with the obs returned by the obs_wrapper
+    _obs_traj_dict = reorder_keys(obs_traj_dict, obs_space) # key order in demo is different from key order in env obs
+    _obs_traj_dict = obs_process_fn(_obs_traj_dict)
+    _obs_traj_dict['depth'] = (_obs_traj_dict['depth'].astype(np.float32) / 1024).astype(np.float16)
+    return _obs_traj_dict # rgb is still uint8
+
+def process_obs_traj(obs_traj_dict, obs_process_fn, obs_space):
+    _obs_traj_dict = process_obs_traj_np(obs_traj_dict, obs_process_fn, obs_space)
+    return {k: torch.from_numpy(v) for k, v in _obs_traj_dict.items()}
+
 class SmallDemoDataset_DiffusionPolicy(Dataset): # Load everything into memory
-    def __init__(self, data_path, obs_process_fn, obs_space, num_traj):
-        from utils.ms_data import load_demo_dataset
-        trajectories = load_demo_dataset(data_path, num_traj=num_traj, concat=False)
+    def __init__(self, data_path, obs_process_fn, obs_space, num_traj, lazy=False, cache=False, num_workers=0):
+        from utils.ms_data import load_demo_dataset, expand_demo_paths
+        from utils.demo_manifest import load_demo_manifest
+        # the windows are read from the manifest, they are only computed here for sharded demos
+        manifest = load_demo_manifest(data_path) if len(expand_demo_paths(data_path)) == 1 else None
+        if cache: # the cache stores the pre-processed obs, trajectories are zero-copy views of it
+            from utils.demo_cache import load_demo_cache, SHM_CACHE_ROOT
+            demo_cache = load_demo_cache(data_path, args.control_mode, obs_keys=DEMO_OBS_KEYS, variant=f'rgbd_{args.env_id}',
+                obs_process_fn=partial(process_obs_traj_np, obs_process_fn=obs_process_fn, obs_space=obs_space),
+                root=SHM_CACHE_ROOT if args.demo_shm else None)
+            trajectories = demo_cache.load_trajectories(num_traj=num_traj, device=torch.device('cpu'))
+        elif lazy:
+            trajectories = load_demo_dataset(data_path, num_traj=num_traj, concat=False, lazy=True, obs_keys=DEMO_OBS_KEYS)
+        else: # the obs are pre-processed right after each trajectory is read, in parallel if num_workers > 0
+            trajectories = load_demo_dataset(data_path, num_traj=num_traj, concat=False, obs_keys=DEMO_OBS_KEYS,
+                num_workers=num_workers, obs_process_fn=partial(process_obs_traj_np, obs_process_fn=obs_process_fn, obs_space=obs_space))
         # trajectories['observations'] is a list of dict, each dict is a traj, with keys in obs_space, values with length L+1
         # trajectories['actions'] is a list of np.ndarray (L, act_dim)
-        print('Raw trajectory loaded, start to pre-process the observations...')
-
-        # Pre-process the observations, make them align with the obs returned by the obs_wrapper
-        obs_traj_dict_list = []
-        for obs_traj_dict in trajectories['observations']:
-            _obs_traj_dict = reorder_keys(obs_traj_dict, obs_space) # key order in demo is different from key order in env obs
-            _obs_traj_dict = obs_process_fn(_obs_traj_dict)
-            _obs_traj_dict['depth'] = torch.Tensor(_obs_traj_dict['depth'].astype(np.float32) / 1024).to(torch.float16)
-            _obs_traj_dict['rgb'] = torch.from_numpy(_obs_traj_dict['rgb']) # still uint8
-            _obs_traj_dict['state'] = torch.from_numpy(_obs_traj_dict['state'])
-            obs_traj_dict_list.append(_obs_traj_dict)
-        trajectories['observations'] = obs_traj_dict_list
-        self.obs_keys = list(_obs_traj_dict.keys())
+        # if lazy, trajectories is a TrajectoryStore, and obs windows are read and pre-processed in __getitem__
+        self.lazy = lazy
+        self.obs_process_fn, self.obs_space = obs_process_fn, obs_space
+        if lazy:
+            self.store = trajectories
+            trajectories = {'actions': self.store.load('actions')} # actions are small, keep them in memory
+        elif not cache:
+            trajectories['observations'] = [
+                {k: torch.from_numpy(v) for k, v in obs_traj_dict.items()} for obs_traj_dict in trajectories['observations']
+            ]
         # Pre-process the actions
         for i in range(len(trajectories['actions'])):
-            trajectories['actions'][i] = torch.Tensor(trajectories['actions'][i])
+            if not cache:
+                trajectories['actions'][i] = torch.Tensor(trajectories['actions'][i])
         print('Obs/action pre-processing is done, start to pre-compute the slice indices...')
 
         # Pre-compute all possible (traj_idx, start, end) tuples, this is very specific to Diffusion Policy
@@ -158,28 +212,31 @@ class SmallDemoDataset_DiffusionPolicy(Dataset): # Load everything into memory
         else:
             raise NotImplementedError(f'Control Mode {args.control_mode} not supported')
         self.obs_horizon, self.pred_horizon = obs_horizon, pred_horizon = args.obs_horizon, args.pred_horizon
-        self.slices = []
-        num_traj = len(trajectories['actions'])
-        total_transitions = 0
-        for traj_idx in range(num_traj):
-            L = trajectories['actions'][traj_idx].shape[0]
-            assert trajectories['observations'][traj_idx]['state'].shape[0] == L + 1
-            total_transitions += L
-
-            # |o|o|                             observations: 2
-            # | |a|a|a|a|a|a|a|a|               actions executed: 8
-            # |p|p|p|p|p|p|p|p|p|p|p|p|p|p|p|p| actions predicted: 16
-            pad_before = obs_horizon - 1
-            # Pad before the trajectory, so the first action of an episode is in "actions executed"
-            # obs_horizon - 1 is the number of "not used actions"
-            pad_after = pred_horizon - obs_horizon
-            # Pad after the trajectory, so all the observations are utilized in training
-            # Note that in the original code, pad_after = act_horizon - 1, but I think this is not the best choice
-            self.slices += [
-                (traj_idx, start, start + pred_horizon) for start in range(-pad_before, L - pred_horizon + pad_after)
-            ]  # slice indices follow convention [start, end)
+        lengths = [a.shape[0] for a in trajectories['actions']]
+        if not lazy:
+            for obs_traj_dict, L in zip(trajectories['observations'], lengths):
+                assert obs_traj_dict['state'].shape[0] == L + 1
+        if manifest is not None:
+            traj_keys = manifest.select_traj_keys(num_traj)
+            assert np.array_equal(manifest.lengths[manifest.traj_indices(traj_keys)], lengths)
+            self.slices = manifest.windows(('dp', obs_horizon, pred_horizon), traj_keys)
+        else:
+            self.slices = []
+            for traj_idx, L in enumerate(lengths):
+                # |o|o|                             observations: 2
+                # | |a|a|a|a|a|a|a|a|               actions executed: 8
+                # |p|p|p|p|p|p|p|p|p|p|p|p|p|p|p|p| actions predicted: 16
+                pad_before = obs_horizon - 1
+                # Pad before the trajectory, so the first action of an episode is in "actions executed"
+                # obs_horizon - 1 is the number of "not used actions"
+                pad_after = pred_horizon - obs_horizon
+                # Pad after the trajectory, so all the observations are utilized in training
+                # Note that in the original code, pad_after = act_horizon - 1, but I think this is not the best choice
+                self.slices += [
+                    (traj_idx, start, start + pred_horizon) for start in range(-pad_before, L - pred_horizon + pad_after)
+                ]  # slice indices follow convention [start, end)
         
-        print(f"Total transitions: {total_transitions}, Total obs sequences: {len(self.slices)}")
+        print(f"Total transitions: {sum(lengths)}, Total obs sequences: {len(self.slices)}")
 
         self.trajectories = trajectories
 
@@ -187,10 +244,14 @@ class SmallDemoDataset_DiffusionPolicy(Dataset): # Load everything into memory
         traj_idx, start, end = self.slices[index]
         L, act_dim = self.trajectories['actions'][traj_idx].shape
 
-        obs_traj = self.trajectories['observations'][traj_idx]
+        if self.lazy:
+            obs_traj = self.store.read(traj_idx, 'observations', max(0, start), start+self.obs_horizon)
+            obs_traj = process_obs_traj(obs_traj, self.obs_process_fn, self.obs_space) # already windowed
+        else:
+            obs_traj = {k: v[max(0, start):start+self.obs_horizon] for k, v in self.trajectories['observations'][traj_idx].items()}
         obs_seq = {}
         for k, v in obs_traj.items():
-            obs_seq[k] = v[max(0, start):start+self.obs_horizon] # start+self.obs_horizon is at least 1
+            obs_seq[k] = v # v is already obs_traj[max(0, start):start+self.obs_horizon], start+self.obs_horizon is at least 1
             if start < 0: # pad before the trajectory
                 pad_obs_seq = torch.stack([obs_seq[k][0]]*abs(start), dim=0)
                 obs_seq[k] = torch.cat((pad_obs_seq, obs_seq[k]), dim=0)
@@ -213,6 +274,50 @@ class SmallDemoDataset_DiffusionPolicy(Dataset): # Load everything into memory
     def __len__(self):
         return len(self.slices)
 
+    def build_batched_storage(self):
+        """
+        Storage for `gather_batch`: the trajectories pre-padded as in __getitem__ and concatenated in one CPU tensor
+        per key (uint8 rgb / float16 depth are kept), and every window as the flat start rows of its obs / actions.
+        """
+        assert not self.lazy
+        obs_trajs, act_trajs = self.trajectories['observations'], self.trajectories['actions']
+        slices = torch.as_tensor(np.asarray(self.slices, dtype=np.int64).reshape(-1, 3))
+        lengths = torch.tensor([len(a) for a in act_trajs])
+        pad_before = self.obs_horizon - 1
+        pad_after = max(int((slices[:, 2] - lengths[slices[:, 0]]).max()), 0)
+        self.obs_flat = {
+            k: torch.cat([v for obs_traj in obs_trajs for v in (obs_traj[k][:1].expand(pad_before, *obs_traj[k].shape[1:]), obs_traj[k])])
+            for k in obs_trajs[0]
+        }
+        act_flat = []
+        for act_traj in act_trajs:
+            pad_action = torch.cat((self.pad_action_arm, act_traj[-1, -1:]), dim=0) # stay still, see __getitem__
+            act_flat += [act_traj[:1].expand(pad_before, -1), act_traj, pad_action.expand(pad_after, -1)]
+        self.act_flat = torch.cat(act_flat)
+        obs_offsets = torch.cumsum(lengths + 1 + pad_before, 0) - (lengths + 1 + pad_before)
+        act_offsets = torch.cumsum(lengths + pad_before + pad_after, 0) - (lengths + pad_before + pad_after)
+        self.window_starts = torch.stack([obs_offsets[slices[:, 0]], act_offsets[slices[:, 0]]], dim=1) + pad_before + slices[:, 1:2]
+        self.obs_arange, self.act_arange = torch.arange(self.obs_horizon), torch.arange(self.pred_horizon)
+
+    def alloc_batch(self, batch_size, pin_memory=False):
+        return {
+            'observations': {
+                k: torch.empty((batch_size, self.obs_horizon) + v.shape[1:], dtype=v.dtype, pin_memory=pin_memory)
+                for k, v in self.obs_flat.items()
+            },
+            'actions': torch.empty((batch_size, self.pred_horizon, self.act_flat.shape[1]), dtype=self.act_flat.dtype, pin_memory=pin_memory),
+        }
+
+    def gather_batch(self, indices, out):
+        # write the windows `indices` into the batch `out` (see alloc_batch), same values as stacking `self[i]`
+        starts = self.window_starts[indices]
+        obs_rows = (starts[:, :1] + self.obs_arange).flatten()
+        act_rows = (starts[:, 1:] + self.act_arange).flatten()
+        for k, v in self.obs_flat.items():
+            torch.index_select(v, 0, obs_rows, out=out['observations'][k].view(-1, *v.shape[1:]))
+        torch.index_select(self.act_flat, 0, act_rows, out=out['actions'].view(-1, self.act_flat.shape[1]))
+        return out
+
 class Agent(nn.Module):
     def __init__(self, env, args):
         super().__init__()
@@ -244,11 +349,20 @@ class Agent(nn.Module):
             clip_sample=True, # clip output to [-1,1] to improve stability
             prediction_type='epsilon' # predict noise (instead of denoised action)
         )
+        # sampler for inference (native, without the per-step overhead of noise_scheduler.step)
+        self.sampler = make_sampler(self.noise_scheduler, args.eval_sampler, args.eval_steps)
+        assert args.warm_start_steps <= self.sampler.num_steps
+        self.denoise_fn = self.denoise
+        self.early_exit_tol = args.early_exit_tol
 
         if args.random_shift > 0:
             from utils.torch_utils import RandomShiftsAug
             self.aug = RandomShiftsAug(args.random_shift)
 
+    def prepare_inference(self):
+        # precompute the diffusion step embeddings of the inference timesteps, call again after the weights change
+        self.noise_pred_net.set_inference_timesteps(self.sampler.timesteps)
+
     def encode_obs(self, obs_seq, eval_mode):
         rgb = obs_seq['rgb'].float() / 255.0 # (B, obs_horizon, 3*k, H, W)
         depth = obs_seq['depth'].float() # (B, obs_horizon, 1*k, H, W)
@@ -287,7 +401,29 @@ class Agent(nn.Module):
 
         return F.mse_loss(noise_pred, noise)
     
-    def get_eval_action(self, obs_seq):
+    def denoise(self, obs_cond, noisy_action_seq, first_step=0, last_step=None):
+        # the denoising loop, from Gaussian noise to the action sequence (one graph with --compile-policy)
+        # runs the steps [first_step, last_step), all of them by default
+        # obs part of the FiLM conditioning, the same for all denoising steps
+        prepared_cond = self.noise_pred_net.prepare_conditioning(obs_cond)
+        solver_state = {} # for multistep solvers (dpmpp)
+        for i in range(first_step, self.sampler.num_steps if last_step is None else last_step):
+            # predict noise
+            noise_pred = self.noise_pred_net(
+                sample=noisy_action_seq,
+                timestep=self.sampler.timesteps[i],
+                prepared_cond=prepared_cond,
+                step_index=self.noise_pred_net.inference_step_indices[i], # precomputed embedding of timesteps[i]
+            )
+
+            # inverse diffusion step (remove noise)
+            noisy_action_seq = self.sampler.step(i, noise_pred, noisy_action_seq, solver_state)
+        return noisy_action_seq
+
+    def compile_inference(self, cache_dir=None):
+        self.denoise_fn = compile_inference_fn(self.denoise, cache_dir)
+
+    def get_eval_action(self, obs_seq, warm_start=None, denoise_steps=None):
         # init scheduler
         # self.noise_scheduler.set_timesteps(self.num_diffusion_iters)
         # set_timesteps will change noise_scheduler.timesteps is only used in noise_scheduler.step()
@@ -302,20 +438,21 @@ class Agent(nn.Module):
             # initialize action from Guassian noise
             noisy_action_seq = torch.randn((B, self.pred_horizon, self.act_dim), device=obs_seq['state'].device)
 
-            for k in self.noise_scheduler.timesteps:
-                # predict noise
-                noise_pred = self.noise_pred_net(
-                    sample=noisy_action_seq,
-                    timestep=k,
-                    global_cond=obs_cond,
-                )
-
-                # inverse diffusion step (remove noise)
-                noisy_action_seq = self.noise_scheduler.step(
-                    model_output=noise_pred,
-                    timestep=k,
-                    sample=noisy_action_seq,
-                ).prev_sample
+            first_step, warm_start_steps = 0, 0
+            if warm_start is not None and warm_start.valid.any():
+                noisy_action_seq, first_step, warm_start_steps = warm_start_sample(
+                    self.denoise_fn, self.sampler, obs_cond, noisy_action_seq, warm_start, fixed_batch=self.denoise_fn != self.denoise) # the compiled graph has static shapes
+            if self.early_exit_tol > 0:
+                noisy_action_seq, num_steps = denoise_early_exit(
+                    self.noise_pred_net, self.sampler, obs_cond, noisy_action_seq, self.early_exit_tol, first_step)
+            else:
+                noisy_action_seq = self.denoise_fn(obs_cond, noisy_action_seq, first_step)
+                num_steps = np.full(B, self.sampler.num_steps - first_step)
+            num_steps = num_steps + warm_start_steps # the UNet steps run for each env before first_step
+            if warm_start is not None:
+                warm_start.update(noisy_action_seq)
+            if denoise_steps is not None:
+                denoise_steps.append(num_steps) # number of UNet steps actually run for each env, for logging
 
         # only take act_horizon number of actions
         start = self.obs_horizon - 1
@@ -345,14 +482,31 @@ def to_tensor(x, device):
 
 def evaluate(n, agent, eval_envs, device):
     agent.eval()
+    agent.prepare_inference() # the weights changed since the last evaluation
+    if args.quantize_policy: # evaluate an int8 copy, the trained weights stay fp32
+        assert device.type == 'cpu', '--quantize-policy is only supported on CPU (--cuda False)'
+        agent = copy.deepcopy(agent)
+        quantize_int8(agent.noise_pred_net)
     print('======= Evaluation Starts =========')
     result = defaultdict(list)
     obs, info = eval_envs.reset() # don't seed here
+    warm_start = WarmStart(args.num_eval_envs, args.act_horizon, args.warm_start_steps) if args.warm_start_steps > 0 else None
+    denoise_steps = []
     while len(result['return']) < n:
+        query_start = time.perf_counter()
         with torch.no_grad():
-            action = agent.get_eval_action(to_tensor(obs, device))
+            action = agent.get_eval_action(to_tensor(obs, device), warm_start=warm_start, denoise_steps=denoise_steps).cpu() # the query is over once the action is on the host
+        result['query_latency_ms'].append((time.perf_counter() - query_start) * 1000)
         obs, rew, terminated, truncated, info = eval_envs.step(action.cpu().numpy())
+        if warm_start is not None:
+            warm_start.reset(terminated | truncated)
         collect_episode_info(info, result)
+    result['denoise_steps_per_query'] = np.concatenate(denoise_steps)
+    latency = result['query_latency_ms']
+    print(f'{agent.sampler.mode} sampler, {agent.sampler.num_steps} steps: '
+          f'{np.mean(latency):.2f} ms per query (median {np.median(latency):.2f} ms)')
+    steps, counts = np.unique(result['denoise_steps_per_query'], return_counts=True)
+    print('UNet steps run per env query: ' + ', '.join(f'{k}: {c / counts.sum():.1%}' for k, c in zip(steps, counts)))
     print('======= Evaluation Ends =========')
     agent.train()
     return result
@@ -425,18 +579,24 @@ if __name__ == "__main__":
         transpose_axes=(0, 3, 1, 2), # (B, H, W, C) -> (B, C, H, W)
     )
     tmp_env = gym.make(args.env_id, obs_mode='rgbd'); orignal_obs_space = tmp_env.observation_space; tmp_env.close()
-    dataset = SmallDemoDataset_DiffusionPolicy(args.demo_path, obs_process_fn, orignal_obs_space, args.num_demo_traj)
+    dataset = SmallDemoDataset_DiffusionPolicy(args.demo_path, obs_process_fn, orignal_obs_space, args.num_demo_traj,
+                                               lazy=args.lazy_demo, cache=args.demo_cache, num_workers=args.num_demo_load_workers)
     sampler = RandomSampler(dataset, replacement=False)
     batch_sampler = BatchSampler(sampler, batch_size=args.batch_size, drop_last=True)
     batch_sampler = IterationBasedBatchSampler(batch_sampler, args.total_iters)
-    train_dataloader = DataLoader(
-        dataset,
-        batch_sampler=batch_sampler,
-        num_workers=args.num_dataload_workers,
-        worker_init_fn=lambda worker_id: worker_init_fn(worker_id, base_seed=args.seed),
-        pin_memory=True,
-        persistent_workers=(args.num_dataload_workers > 0),
-    )
+    if args.prefetch: # batches are gathered in a background thread and copied to the device ahead of time
+        from utils.prefetch import BatchPrefetcher
+        dataset.build_batched_storage()
+        train_dataloader = BatchPrefetcher(batch_sampler, dataset.gather_batch, dataset.alloc_batch, device)
+    else:
+        train_dataloader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=args.num_dataload_workers,
+            worker_init_fn=lambda worker_id: worker_init_fn(worker_id, base_seed=args.seed),
+            pin_memory=device.type == 'cuda',
+            persistent_workers=(args.num_dataload_workers > 0),
+        )
 
     # agent setup
     agent = Agent(envs, args).to(device)
@@ -456,6 +616,8 @@ if __name__ == "__main__":
     # holds a copy of the model weights
     ema = EMAModel(parameters=agent.parameters(), power=0.75)
     ema_agent = Agent(envs, args).to(device)
+    if args.compile_policy:
+        ema_agent.compile_inference(args.compile_cache_dir)
 
 
     # ---------------------------------------------------------------------------- #
@@ -470,10 +632,10 @@ if __name__ == "__main__":
         cur_iter = iteration + 1
         timer.end('data')
 
-        # copy data from cpu to gpu
+        # copy data from cpu to gpu (the prefetcher already did it)
         obs_batch_dict = data_batch['observations']
-        obs_batch_dict = {k: v.cuda(non_blocking=True) for k, v in obs_batch_dict.items()}
-        act_batch = data_batch['actions'].cuda(non_blocking=True)
+        obs_batch_dict = {k: v.to(device, non_blocking=True) for k, v in obs_batch_dict.items()}
+        act_batch = data_batch['actions'].to(device, non_blocking=True)
 
         # forward and compute loss
         total_loss = agent.compute_loss(
@@ -13,12 +13,12 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from stable_baselines3.common.buffers import ReplayBuffer
 from torch.utils.tensorboard import SummaryWriter
 
 import datetime
 from collections import defaultdict
 from utils.profiling import NonOverlappingTimeProfiler
+from utils.replay_buffer import TensorReplayBuffer, CompactReplayBuffer, BUFFER_DTYPES
 
 from nets.behavior_transformer import BehaviorTransformer, GPT, GPTConfig
 
@@ -50,6 +50,10 @@ def parse_args():
         help="total timesteps of the experiments")
     parser.add_argument("--buffer-size", type=int, default=None,
         help="the replay memory buffer size")
+    parser.add_argument("--compact-buffer", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, store each observation once in the replay buffer, the next observations are read from the next transition of the env (boundary slots at episode ends)")
+    parser.add_argument("--buffer-dtype", type=str, choices=['fp32', 'fp16', 'bf16'], default='fp32',
+        help="storage dtype of the observations and actions in the replay buffer, the sampled batches are fp32")
     parser.add_argument("--gamma", type=float, default=0.97,
         help="the discount factor gamma")
     parser.add_argument("--tau", type=float, default=0.01,
@@ -401,14 +405,16 @@ if __name__ == "__main__":
         sac_alpha = args.sac_alpha
 
     dummy_env.single_observation_space.dtype = np.float32
-    rb = ReplayBuffer(
-        args.buffer_size,
-        dummy_env.single_observation_space,
-        envs.single_action_space if args.critic_input == 'res' and args.actor_input == 'obs' else gym.spaces.Box(low=-np.inf, high=np.inf, shape=(act_dim * 3,)),
-        device,
-        n_envs=args.num_envs,
-        handle_timeout_termination=False, # stable-baselines3 has not fully supported Gymnasium's termination signal
-    )
+    rb_action_space = envs.single_action_space if args.critic_input == 'res' and args.actor_input == 'obs' else gym.spaces.Box(low=-np.inf, high=np.inf, shape=(act_dim * 3,))
+    if args.compact_buffer:
+        # only the obs are deduplicated: base_next_actions is a separate query on real_next_obs_seq,
+        # not the base action executed at the next step, so it is stored as is (next_action_dim=0)
+        rb = CompactReplayBuffer(args.buffer_size, dummy_env.single_observation_space, rb_action_space, device, n_envs=args.num_envs,
+                                 dtype=BUFFER_DTYPES[args.buffer_dtype])
+    else:
+        rb = TensorReplayBuffer(args.buffer_size, dummy_env.single_observation_space, rb_action_space, device, n_envs=args.num_envs,
+                                dtype=BUFFER_DTYPES[args.buffer_dtype])
+    print(f'Replay buffer: {type(rb).__name__}, {rb.nbytes() / 2**30:.2f} GiB')
 
     # TRY NOT TO MODIFY: start the game
     obs_seq, info = envs.reset(seed=args.seed) # in Gymnasium, seed is given to reset() instead of seed()
@@ -455,6 +461,7 @@ if __name__ == "__main__":
 
             # TRY NOT TO MODIFY: save data to reply buffer; handle `final_observation`
             real_next_obs_seq = next_obs_seq.copy()
+            final_obs_envs = [] # envs where real_next_obs_seq is not next_obs_seq
             if args.bootstrap_at_done == 'never':
                 stop_bootstrap = truncations | terminations # always stop bootstrap when episode ends
             else:
@@ -467,6 +474,7 @@ if __name__ == "__main__":
                 for idx, _need_final_obs in enumerate(need_final_obs):
                     if _need_final_obs:
                         real_next_obs_seq[idx] = infos["final_observation"][idx]
+                        final_obs_envs.append(idx)
 
             if args.critic_input == 'res' and args.actor_input == 'obs':
                 actions_to_save = res_actions
@@ -474,7 +482,7 @@ if __name__ == "__main__":
                 base_next_actions = base_policy.get_eval_action(torch.Tensor(real_next_obs_seq).to(device)).cpu().numpy()
                 actions_to_save = np.concatenate([res_actions, base_actions, base_next_actions], axis=1)
             
-            rb.add(obs_seq[:, -1], real_next_obs_seq[:, -1], actions_to_save, rewards, stop_bootstrap, infos)
+            rb.add(obs_seq[:, -1], real_next_obs_seq[:, -1], actions_to_save, rewards, stop_bootstrap, infos, boundary=final_obs_envs)
 
             step_in_episodes += 1
             step_in_episodes[terminations | truncations] = 0
@@ -489,9 +497,10 @@ if __name__ == "__main__":
             continue
 
         learning_has_started = True
+        batches = rb.sample_batches(num_updates_per_training, args.batch_size) # one gather for all the updates of the round
         for local_update in range(num_updates_per_training):
             global_update += 1
-            data = rb.sample(args.batch_size)
+            data = batches[local_update]
 
             if args.critic_input != 'res' or args.actor_input == 'obs_base_action':
                 res_actions = data.actions[:, :act_dim]
@@ -13,15 +13,17 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from stable_baselines3.common.buffers import ReplayBuffer
 from torch.utils.tensorboard import SummaryWriter
 
 import datetime
 from collections import defaultdict
 from utils.profiling import NonOverlappingTimeProfiler
+from utils.replay_buffer import TensorReplayBuffer, CompactReplayBuffer, BUFFER_DTYPES
 
 from diffusers.schedulers.scheduling_ddim import DDIMScheduler
 from nets.diffusion_policy.conditional_unet1d_colab import ConditionalUnet1D
+from nets.diffusion_policy.diffusion_sampler import DiffusionSampler, WarmStart, denoise_early_exit, warm_start_sample
+from utils.torch_utils import compile_inference_fn, quantize_int8
 
 
 def parse_args():
@@ -52,6 +54,10 @@ def parse_args():
         help="total timesteps of the experiments")
     parser.add_argument("--buffer-size", type=int, default=None,
         help="the replay memory buffer size")
+    parser.add_argument("--compact-buffer", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, store each observation and base action once in the replay buffer, the next observations and next base actions are read from the next transition of the env (boundary slots at episode ends)")
+    parser.add_argument("--buffer-dtype", type=str, choices=['fp32', 'fp16', 'bf16'], default='fp32',
+        help="storage dtype of the observations and actions in the replay buffer, the sampled batches are fp32")
     parser.add_argument("--gamma", type=float, default=0.97,
         help="the discount factor gamma")
     parser.add_argument("--tau", type=float, default=0.01,
@@ -90,6 +96,20 @@ def parse_args():
     # Diffusion Policy arguments
     parser.add_argument("--ddim-steps", type=int, default=4)
     parser.add_argument("--act-horizon", type=int, default=4) # override the base policy's act_horizon
+    parser.add_argument("--one-step-base-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, --base-policy-ckpt is a one-step student (offline/diffusion_policy_unet_maniskill2.py --distill-from), sampled with the single DDIM step it was distilled for instead of --ddim-steps")
+    parser.add_argument("--warm-start-steps", type=int, default=0,
+        help="if > 0, start each base policy query from the previous action chunk of the env (shifted and noised) and only run this many of the --ddim-steps denoising steps, the first query of an episode runs all of them")
+    parser.add_argument("--early-exit-tol", type=float, default=0.0,
+        help="if > 0, stop denoising a sample once its predicted clean action sequence changes by less than this (max abs, in the normalized action space) between two steps, the other samples continue in a smaller batch")
+    parser.add_argument("--compile-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, torch.compile the whole denoising loop of the base policy (one graph per batch size, also on CPU)")
+    parser.add_argument("--quantize-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, run the UNet of the base policy with dynamic int8 quantized convolutions (CPU only, see check_quantized_policy.py for the action error)")
+    parser.add_argument("--policy-dtype", type=str, choices=['fp32', 'bf16'], default='fp32',
+        help="bf16: run the UNet of the base policy under bfloat16 autocast (e.g. CPUs with AMX / AVX512-BF16), GroupNorm and the denoising steps stay in fp32")
+    parser.add_argument("--compile-cache-dir", type=str, default=None,
+        help="where to keep the compiled kernels across runs, default: $TORCHINDUCTOR_CACHE_DIR or /tmp/torchinductor_$USER")
 
     # Eval, logging, and others
     parser.add_argument("--output-dir", type=str, default='output')
@@ -113,6 +133,11 @@ def parse_args():
     args.num_eval_envs = min(args.num_eval_envs, args.num_eval_episodes)
     assert args.num_eval_episodes % args.num_eval_envs == 0
     assert args.training_freq % args.num_envs == 0
+    assert args.warm_start_steps <= args.ddim_steps
+    assert not (args.quantize_policy and args.compile_policy), '--quantize-policy and --compile-policy are exclusive'
+    assert not (args.quantize_policy and args.policy_dtype != 'fp32'), '--quantize-policy needs --policy-dtype fp32'
+    assert not (args.one_step_base_policy and (args.warm_start_steps > 0 or args.early_exit_tol > 0)), \
+        'a one-step base policy has no denoising steps to skip'
     assert (args.training_freq * args.utd).is_integer()
     # fmt: on
     return args
@@ -233,8 +258,27 @@ class BasePolicy(nn.Module):
             prediction_type='epsilon' # predict noise (instead of denoised action)
         )
         self.noise_scheduler.set_timesteps(num_inference_steps=args.ddim_steps)
+        # same denoising steps as noise_scheduler.step, without its per-step overhead
+        self.sampler = DiffusionSampler.from_scheduler(self.noise_scheduler, mode='ddim')
+        self.denoise_fn = self.denoise
+        self.early_exit_tol = args.early_exit_tol
+        self.autocast_dtype = None # see set_inference_dtype
 
         self.get_eval_action = self.get_action
+
+    def load_sampler(self, config):
+        # e.g. the sampler a distilled policy was trained for, saved in its checkpoint
+        self.sampler = DiffusionSampler.from_config(self.noise_scheduler.alphas_cumprod, config).to(self.sampler.timesteps.device)
+
+    def set_inference_dtype(self, dtype):
+        # 'bf16': the UNet run under bfloat16 autocast,
+        # GroupNorm (GroupNorm32), the obs features and the denoising steps stay in fp32
+        if dtype == 'bf16':
+            self.autocast_dtype = torch.bfloat16
+
+    def prepare_inference(self):
+        # precompute the diffusion step embeddings of the inference timesteps, call again after the weights change
+        self.noise_pred_net.set_inference_timesteps(self.sampler.timesteps)
     
     def compute_loss(self, obs_seq, action_seq):
         B = obs_seq.shape[0]
@@ -262,10 +306,33 @@ class BasePolicy(nn.Module):
 
         return F.mse_loss(noise_pred, noise)
     
-    def get_action(self, obs_seq):
+    def denoise(self, obs_cond, noisy_action_seq, first_step=0, last_step=None):
+        # the denoising loop, from Gaussian noise to the action sequence (one graph with --compile-policy)
+        # runs the steps [first_step, last_step), all of them by default
+        # obs part of the FiLM conditioning, the same for all denoising steps
+        prepared_cond = self.noise_pred_net.prepare_conditioning(obs_cond)
+        for i in range(first_step, self.sampler.num_steps if last_step is None else last_step):
+            # predict noise
+            noise_pred = self.noise_pred_net(
+                sample=noisy_action_seq,
+                timestep=self.sampler.timesteps[i],
+                prepared_cond=prepared_cond,
+                step_index=self.noise_pred_net.inference_step_indices[i], # precomputed embedding of timesteps[i]
+            )
+
+            # inverse diffusion step (remove noise)
+            noisy_action_seq = self.sampler.step(i, noise_pred, noisy_action_seq)
+        return noisy_action_seq
+
+    def compile_inference(self, cache_dir=None):
+        self.denoise_fn = compile_inference_fn(self.denoise, cache_dir)
+
+    def get_action(self, obs_seq, warm_start=None, denoise_steps=None, eager=False):
         # obs_seq: (B, obs_horizon, obs_dim)
+        # eager: denoise without --compile-policy, for batches of varying sizes (the compiled graph has static shapes)
         B = obs_seq.shape[0]
-        with torch.no_grad():
+        denoise_fn = self.denoise if eager else self.denoise_fn
+        with torch.no_grad(), torch.autocast(obs_seq.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None):
             obs_cond = obs_seq.flatten(start_dim=1) # (B, obs_horizon * obs_dim)
 
             # initialize action from Guassian noise
@@ -273,20 +340,21 @@ class BasePolicy(nn.Module):
             # print(obs_cond.cpu().numpy()); exit()
             # print(list(self.noise_pred_net.parameters())[-1].cpu().numpy()); exit()
 
-            for k in self.noise_scheduler.timesteps:
-                # predict noise
-                noise_pred = self.noise_pred_net(
-                    sample=noisy_action_seq,
-                    timestep=k,
-                    global_cond=obs_cond,
-                )
-
-                # inverse diffusion step (remove noise)
-                noisy_action_seq = self.noise_scheduler.step(
-                    model_output=noise_pred,
-                    timestep=k,
-                    sample=noisy_action_seq,
-                ).prev_sample
+            first_step, warm_start_steps = 0, 0
+            if warm_start is not None and warm_start.valid.any():
+                noisy_action_seq, first_step, warm_start_steps = warm_start_sample(
+                    denoise_fn, self.sampler, obs_cond, noisy_action_seq, warm_start, fixed_batch=denoise_fn != self.denoise) # the compiled graph has static shapes
+            if self.early_exit_tol > 0:
+                noisy_action_seq, num_steps = denoise_early_exit(
+                    self.noise_pred_net, self.sampler, obs_cond, noisy_action_seq, self.early_exit_tol, first_step)
+            else:
+                noisy_action_seq = denoise_fn(obs_cond, noisy_action_seq, first_step)
+                num_steps = np.full(B, self.sampler.num_steps - first_step)
+            num_steps = num_steps + warm_start_steps # the UNet steps run for each env before first_step
+            if warm_start is not None:
+                warm_start.update(noisy_action_seq)
+            if denoise_steps is not None:
+                denoise_steps.append(num_steps) # number of UNet steps actually run for each env, for logging
 
         # only take act_horizon number of actions
         start = self.obs_horizon - 1
@@ -398,10 +466,12 @@ def evaluate(n, base_policy, res_actor, eval_envs, device):
     res_actor.eval()
     result = defaultdict(list)
     obs_seq, info = eval_envs.reset() # don't seed here
+    warm_start = WarmStart(args.num_eval_envs, args.act_horizon, args.warm_start_steps) if args.warm_start_steps > 0 else None
+    denoise_steps = []
     while len(result['return']) < n:
         obs_seq_tensor = torch.Tensor(obs_seq).to(device)
         with torch.no_grad():
-            base_act_seq_tensor = base_policy.get_eval_action(obs_seq_tensor).detach()
+            base_act_seq_tensor = base_policy.get_eval_action(obs_seq_tensor, warm_start=warm_start, denoise_steps=denoise_steps).detach()
             base_act_seq = base_act_seq_tensor.cpu().numpy()
             actor_input = obs_seq_tensor[:, -1] if args.actor_input == 'obs' else torch.cat([obs_seq_tensor[:, -1], base_act_seq_tensor.reshape(-1, total_act_dim)], dim=1)
             res_actions = res_actor.get_eval_action(actor_input).detach().cpu().numpy()
@@ -409,7 +479,10 @@ def evaluate(n, base_policy, res_actor, eval_envs, device):
         scaled_res_seq = args.res_scale * res_act_seq
         final_act_seq = base_act_seq + scaled_res_seq
         obs_seq, rew, terminated, truncated, info = eval_envs.step(final_act_seq)
+        if warm_start is not None:
+            warm_start.reset(terminated | truncated)
         collect_episode_info(info, result)
+    result['denoise_steps_per_query'] = np.concatenate(denoise_steps)
     print('======= Evaluation Ends =========')
     res_actor.train()
     return result
@@ -514,8 +587,20 @@ if __name__ == "__main__":
                 print(f'  Failed to load checkpoint[{key}]: {e}')
                 continue
     assert loaded, 'Failed to load base policy from any key in checkpoint'
+    if args.one_step_base_policy:
+        assert 'sampler_config' in checkpoint, 'No sampler_config in the checkpoint, is it a distilled policy?'
+        base_policy.load_sampler(checkpoint['sampler_config'])
+        assert base_policy.sampler.num_steps == 1, f'{base_policy.sampler.num_steps} steps, expected a one-step policy'
+        print(f'Loaded a one-step base policy (timestep {base_policy.sampler.config["timesteps"][0]})')
     base_policy.eval()
     base_policy.requires_grad_(False)
+    if args.quantize_policy:
+        assert device.type == 'cpu', '--quantize-policy is only supported on CPU (--cuda False)'
+        quantize_int8(base_policy.noise_pred_net)
+    base_policy.set_inference_dtype(args.policy_dtype)
+    base_policy.prepare_inference()
+    if args.compile_policy:
+        base_policy.compile_inference(args.compile_cache_dir)
     
     # Residual agent setup
     class DummyObject: pass
@@ -551,17 +636,22 @@ if __name__ == "__main__":
         sac_alpha = args.sac_alpha
 
     dummy_env.single_observation_space.dtype = np.float32
-    rb = ReplayBuffer(
-        args.buffer_size,
-        dummy_env.single_observation_space,
-        dummy_env.single_action_space if args.critic_input == 'res' and args.actor_input == 'obs' else gym.spaces.Box(low=-np.inf, high=np.inf, shape=(total_act_dim * 3,)),
-        device,
-        n_envs=args.num_envs,
-        handle_timeout_termination=False, # stable-baselines3 has not fully supported Gymnasium's termination signal
-    )
+    rb_action_space = dummy_env.single_action_space if args.critic_input == 'res' and args.actor_input == 'obs' else gym.spaces.Box(low=-np.inf, high=np.inf, shape=(total_act_dim * 3,))
+    if args.compact_buffer:
+        # base_next_actions (the last total_act_dim action columns) is the base action executed at the next step, except
+        # at the final_obs_envs passed as boundary, so it is read from the base actions of the next transition
+        rb = CompactReplayBuffer(args.buffer_size, dummy_env.single_observation_space, rb_action_space, device, n_envs=args.num_envs,
+                                 dtype=BUFFER_DTYPES[args.buffer_dtype], next_action_dim=0 if args.critic_input == 'res' and args.actor_input == 'obs' else total_act_dim)
+    else:
+        rb = TensorReplayBuffer(args.buffer_size, dummy_env.single_observation_space, rb_action_space, device, n_envs=args.num_envs,
+                                dtype=BUFFER_DTYPES[args.buffer_dtype])
+    print(f'Replay buffer: {type(rb).__name__}, {rb.nbytes() / 2**30:.2f} GiB')
 
     # TRY NOT TO MODIFY: start the game
     obs_seq, info = envs.reset(seed=args.seed) # in Gymnasium, seed is given to reset() instead of seed()
+    warm_start = WarmStart(args.num_envs, args.act_horizon, args.warm_start_steps) if args.warm_start_steps > 0 else None
+    denoise_steps = []
+    next_base_act_seq_tensor = None # sum / concat: the base actions of the next step, computed for s'
     global_step = 0
     global_update = 0
     learning_has_started = False
@@ -577,7 +667,10 @@ if __name__ == "__main__":
             global_step += 1 * args.num_envs
 
             obs_seq_tensor = torch.Tensor(obs_seq).to(device)
-            base_act_seq_tensor = base_policy.get_eval_action(obs_seq_tensor)
+            if next_base_act_seq_tensor is not None: # computed from obs_seq at the previous step
+                base_act_seq_tensor = next_base_act_seq_tensor
+            else:
+                base_act_seq_tensor = base_policy.get_eval_action(obs_seq_tensor, warm_start=warm_start, denoise_steps=denoise_steps)
             base_act_seq = base_act_seq_tensor.cpu().numpy() # (B, act_horizon, act_dim)
             base_actions = base_act_seq.reshape(-1, total_act_dim)
             res_ratio = min(global_step / args.prog_explore, 1)
@@ -603,9 +696,12 @@ if __name__ == "__main__":
 
             # TRY NOT TO MODIFY: record rewards for plotting purposes
             result = collect_episode_info(infos, result)
+            if warm_start is not None:
+                warm_start.reset(terminations | truncations)
 
             # TRY NOT TO MODIFY: save data to reply buffer; handle `final_observation`
             real_next_obs_seq = next_obs_seq.copy()
+            final_obs_envs = [] # envs where real_next_obs_seq is not next_obs_seq
             if args.bootstrap_at_done == 'never':
                 stop_bootstrap = truncations | terminations # always stop bootstrap when episode ends
             else:
@@ -618,15 +714,21 @@ if __name__ == "__main__":
                 for idx, _need_final_obs in enumerate(need_final_obs):
                     if _need_final_obs:
                         real_next_obs_seq[idx] = infos["final_observation"][idx]
+                        final_obs_envs.append(idx)
 
             if args.critic_input == 'res' and args.actor_input == 'obs':
                 actions_to_save = res_actions
             else: # sum or concat both need base actions for s and s'
-                base_next_act_seq = base_policy.get_eval_action(torch.Tensor(real_next_obs_seq).to(device)).cpu().numpy()
+                # the query of the next step, made now: the same sample is executed at the next step and saved here,
+                # only the envs with a final observation need a separate query for s'
+                next_base_act_seq_tensor = base_policy.get_eval_action(torch.Tensor(next_obs_seq).to(device), warm_start=warm_start, denoise_steps=denoise_steps)
+                base_next_act_seq = next_base_act_seq_tensor.cpu().numpy().copy() # the tensor is executed next step, keep it
+                if len(final_obs_envs) > 0:
+                    base_next_act_seq[final_obs_envs] = base_policy.get_eval_action(torch.Tensor(real_next_obs_seq[final_obs_envs]).to(device), eager=True).cpu().numpy()
                 base_next_actions = base_next_act_seq.reshape(-1, total_act_dim)
                 actions_to_save = np.concatenate([res_actions, base_actions, base_next_actions], axis=1)
             
-            rb.add(obs_seq[:, -1], real_next_obs_seq[:, -1], actions_to_save, rewards, stop_bootstrap, infos)
+            rb.add(obs_seq[:, -1], real_next_obs_seq[:, -1], actions_to_save, rewards, stop_bootstrap, infos, boundary=final_obs_envs)
 
             step_in_episodes += args.act_horizon
             step_in_episodes[terminations | truncations] = 0
@@ -641,9 +743,10 @@ if __name__ == "__main__":
             continue
 
         learning_has_started = True
+        batches = rb.sample_batches(num_updates_per_training, args.batch_size) # one gather for all the updates of the round
         for local_update in range(num_updates_per_training):
             global_update += 1
-            data = rb.sample(args.batch_size)
+            data = batches[local_update]
 
             if args.critic_input != 'res' or args.actor_input == 'obs_base_action':
                 res_actions = data.actions[:, :total_act_dim]
@@ -751,6 +854,11 @@ if __name__ == "__main__":
             writer.add_scalar("losses/actor_grad_norm", actor_grad_norm.item(), global_step)
             # print("SPS:", int(global_step / (time.time() - start_time)))
             timer.dump_to_writer(writer, global_step)
+            if len(denoise_steps) > 0:
+                steps = np.concatenate(denoise_steps)
+                writer.add_scalar("charts/denoise_steps_per_query", steps.mean(), global_step)
+                writer.add_histogram("charts/denoise_steps", steps, global_step)
+                denoise_steps.clear()
             if args.autotune:
                 writer.add_scalar("losses/sac_alpha_loss", sac_alpha_loss.item(), global_step)
 
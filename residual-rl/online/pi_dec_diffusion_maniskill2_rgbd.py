@@ -13,15 +13,17 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from stable_baselines3.common.buffers import ReplayBuffer
 from torch.utils.tensorboard import SummaryWriter
 
 import datetime
 from collections import defaultdict, deque
 from utils.profiling import NonOverlappingTimeProfiler
+from utils.replay_buffer import TensorReplayBuffer, CompactReplayBuffer, BUFFER_DTYPES
 
 from diffusers.schedulers.scheduling_ddim import DDIMScheduler
 from nets.diffusion_policy.conditional_unet1d_colab import ConditionalUnet1D
+from nets.diffusion_policy.diffusion_sampler import DiffusionSampler, WarmStart, denoise_early_exit, warm_start_sample
+from utils.torch_utils import compile_inference_fn, quantize_int8
 from nets.cnn.plain_conv import PlainConv, PlainConv_MS1
 
 
@@ -53,6 +55,10 @@ def parse_args():
         help="total timesteps of the experiments")
     parser.add_argument("--buffer-size", type=int, default=None,
         help="the replay memory buffer size")
+    parser.add_argument("--compact-buffer", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, store each observation embedding once in the replay buffer, the next ones are read from the next transition of the env (boundary slots at episode ends)")
+    parser.add_argument("--buffer-dtype", type=str, choices=['fp32', 'fp16', 'bf16'], default='fp32',
+        help="storage dtype of the observations and actions in the replay buffer, the sampled batches are fp32")
     parser.add_argument("--gamma", type=float, default=0.97,
         help="the discount factor gamma")
     parser.add_argument("--tau", type=float, default=0.01,
@@ -91,6 +97,20 @@ def parse_args():
     # Diffusion Policy arguments
     parser.add_argument("--ddim-steps", type=int, default=4)
     parser.add_argument("--act-horizon", type=int, default=4) # override the base policy's act_horizon
+    parser.add_argument("--warm-start-steps", type=int, default=0,
+        help="if > 0, start each base policy query from the previous action chunk of the env (shifted and noised) and only run this many of the --ddim-steps denoising steps, the first query of an episode runs all of them")
+    parser.add_argument("--early-exit-tol", type=float, default=0.0,
+        help="if > 0, stop denoising a sample once its predicted clean action sequence changes by less than this (max abs, in the normalized action space) between two steps, the other samples continue in a smaller batch")
+    parser.add_argument("--compile-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, torch.compile the whole denoising loop of the base policy (one graph per batch size, also on CPU)")
+    parser.add_argument("--quantize-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, run the UNet of the base policy with dynamic int8 quantized convolutions (CPU only, see check_quantized_policy.py for the action error)")
+    parser.add_argument("--policy-dtype", type=str, choices=['fp32', 'bf16'], default='fp32',
+        help="bf16: run the visual encoder (in channels-last) and the UNet of the base policy under bfloat16 autocast (e.g. CPUs with AMX / AVX512-BF16), GroupNorm and the denoising steps stay in fp32")
+    parser.add_argument("--cache-visual-features", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
+        help="if toggled, cache the visual features of each frame in the frame stacks of the envs, so that every frame is encoded once (the results are the same)")
+    parser.add_argument("--compile-cache-dir", type=str, default=None,
+        help="where to keep the compiled kernels across runs, default: $TORCHINDUCTOR_CACHE_DIR or /tmp/torchinductor_$USER")
 
     # Eval, logging, and others
     parser.add_argument("--output-dir", type=str, default='output')
@@ -111,6 +131,9 @@ def parse_args():
     args.num_eval_envs = min(args.num_eval_envs, args.num_eval_episodes)
     assert args.num_eval_episodes % args.num_eval_envs == 0
     assert args.training_freq % args.num_envs == 0
+    assert args.warm_start_steps <= args.ddim_steps
+    assert not (args.quantize_policy and args.compile_policy), '--quantize-policy and --compile-policy are exclusive'
+    assert not (args.quantize_policy and args.policy_dtype != 'fp32'), '--quantize-policy needs --policy-dtype fp32'
     assert (args.training_freq * args.utd).is_integer()
     # fmt: on
     return args
@@ -268,6 +291,57 @@ def make_env(env_id, seed, control_mode=None, image_size=None, video_dir=None, o
 
     return thunk
 
+class FrameFeatureCache(object):
+    """
+    Visual features of the frames in the current frame stack of each env, keyed by the episode step of the frame,
+    so that every rendered frame goes through the visual encoder once: the frames of s' are encoded for the replay
+    buffer and reused by the next query, the first frame repeated by DictFrameStack at reset is encoded once, and
+    the frames still in the stack after an env step (act_horizon < obs_horizon) are not encoded again.
+    DictFrameStack is inside SeqActionWrapper, so the stack moves by `shift` = act_horizon frames per env step.
+    """
+    def __init__(self, num_envs, obs_horizon, shift):
+        self.obs_horizon = obs_horizon
+        self.shift = shift
+        self.episode_steps = np.zeros(num_envs, dtype=np.int64) # episode step of the newest frame of each stack
+        self.keys = np.full((num_envs, obs_horizon), -1, dtype=np.int64) # episode steps of the cached frames, -1: none
+        self.features = None # (num_envs, obs_horizon, D), allocated at the first query
+        self.num_queried, self.num_encoded = 0, 0 # number of frames in the queries / run through the encoder, for logging
+
+    def step(self, done):
+        # call after every env step with terminations | truncations, the envs that were reset start a new episode
+        self.episode_steps += self.shift
+        self.episode_steps[done] = 0
+        self.keys[done] = -1
+
+    def encode(self, encode_fn, rgb, depth, envs):
+        # visual features (len(envs), obs_horizon, D) of the current frame stacks `rgb` / `depth` of `envs`,
+        # encode_fn(rgb, depth) is only run on the frames that are not cached
+        H = self.obs_horizon
+        self.num_queried += len(envs) * H
+        keys = np.maximum(self.episode_steps[envs, None] - np.arange(H)[::-1], 0) # (n, H), padded stacks repeat step 0
+        hit = self.keys[envs][:, None, :] == keys[:, :, None] # (n, H, H)
+        found = hit.any(axis=2)
+        repeated = np.zeros_like(found)
+        repeated[:, 1:] = keys[:, 1:] == keys[:, :-1] # same frame as the previous one in the stack
+        new_i, new_j = np.nonzero(~found & ~repeated)
+        device = rgb.device
+        if len(new_i) > 0:
+            new_features = encode_fn(rgb[new_i, new_j], depth[new_i, new_j])
+            self.num_encoded += len(new_i)
+            if self.features is None:
+                self.features = torch.zeros((len(self.keys), H, new_features.shape[1]), device=device)
+        features = torch.empty((len(envs), H, self.features.shape[2]), device=device)
+        if len(new_i) > 0:
+            features[new_i, new_j] = new_features
+        hit_i, hit_j = np.nonzero(found)
+        features[hit_i, hit_j] = self.features[envs[hit_i], hit.argmax(axis=2)[hit_i, hit_j]]
+        for j in range(1, H):
+            rows = np.flatnonzero(repeated[:, j] & ~found[:, j])
+            features[rows, j] = features[rows, j - 1]
+        self.features[envs] = features
+        self.keys[envs] = keys
+        return features
+
 class BasePolicy(nn.Module):
     def __init__(self, env, args):
         super().__init__()
@@ -283,6 +357,7 @@ class BasePolicy(nn.Module):
         _, C, H, W = env.single_observation_space['rgb'].shape
 
         visual_feature_dim = 256
+        self.visual_feature_dim = visual_feature_dim
         self.obs_embedding_dim = obs_state_dim + visual_feature_dim
         CNN_class = PlainConv if C == 6 else PlainConv_MS1
         self.visual_encoder = CNN_class(in_channels=int(C/3*4), out_dim=visual_feature_dim)
@@ -301,40 +376,97 @@ class BasePolicy(nn.Module):
             prediction_type='epsilon' # predict noise (instead of denoised action)
         )
         self.noise_scheduler.set_timesteps(num_inference_steps=args.ddim_steps)
-
-    def encode_obs(self, obs_seq):
-        rgb = obs_seq['rgb'].float() / 255.0 # (B, obs_horizon, 3*k, H, W)
-        depth = obs_seq['depth'].float() # (B, obs_horizon, 1*k, H, W)
-        img_seq = torch.cat([rgb, depth], dim=2) # (B, obs_horizon, C, H, W), C=4*k
-        img_seq = img_seq.flatten(end_dim=1) # (B*obs_horizon, C, H, W)
-        visual_feature = self.visual_encoder(img_seq) # (B*obs_horizon, D)
-        visual_feature = visual_feature.reshape(rgb.shape[0], self.obs_horizon, visual_feature.shape[1]) # (B, obs_horizon, D)
+        # same denoising steps as noise_scheduler.step, without its per-step overhead
+        self.sampler = DiffusionSampler.from_scheduler(self.noise_scheduler, mode='ddim')
+        self.denoise_fn = self.denoise
+        self.early_exit_tol = args.early_exit_tol
+        self.autocast_dtype = None # see set_inference_dtype
+
+    def set_inference_dtype(self, dtype):
+        # 'bf16': the visual encoder (in channels-last) and the UNet run under bfloat16 autocast,
+        # GroupNorm (GroupNorm32), the obs features and the denoising steps stay in fp32
+        if dtype == 'bf16':
+            self.autocast_dtype = torch.bfloat16
+            self.visual_encoder.to(memory_format=torch.channels_last)
+
+    def prepare_inference(self):
+        # precompute the diffusion step embeddings of the inference timesteps, call again after the weights change
+        self.noise_pred_net.set_inference_timesteps(self.sampler.timesteps)
+
+    def encode_frames(self, rgb, depth):
+        rgb = rgb.float() / 255.0 # (N, 3*k, H, W)
+        depth = depth.float() # (N, 1*k, H, W)
+        img = torch.cat([rgb, depth], dim=1) # (N, C, H, W), C=4*k
+        if self.autocast_dtype is not None:
+            img = img.contiguous(memory_format=torch.channels_last)
+        return self.visual_encoder(img).float() # (N, D)
+
+    def encode_obs(self, obs_seq, frame_cache=None, uncached_envs=None):
+        # frame_cache: FrameFeatureCache of the envs, then obs_seq has to be the current frame stacks of the envs,
+        # except for uncached_envs (e.g. substituted final observations), which are encoded without the cache
+        B = obs_seq['rgb'].shape[0]
+        if frame_cache is None:
+            visual_feature = self.encode_frames(obs_seq['rgb'].flatten(end_dim=1), obs_seq['depth'].flatten(end_dim=1)) # (B*obs_horizon, D)
+            visual_feature = visual_feature.reshape(B, self.obs_horizon, visual_feature.shape[1]) # (B, obs_horizon, D)
+        else:
+            cached = np.ones(B, dtype=bool)
+            if uncached_envs is not None:
+                cached[uncached_envs] = False
+            envs, uncached = np.flatnonzero(cached), np.flatnonzero(~cached)
+            visual_feature = torch.empty((B, self.obs_horizon, self.visual_feature_dim), device=obs_seq['rgb'].device)
+            if len(envs) > 0:
+                visual_feature[envs] = frame_cache.encode(self.encode_frames, obs_seq['rgb'][envs], obs_seq['depth'][envs], envs)
+            if len(uncached) > 0:
+                uncached_feature = self.encode_frames(obs_seq['rgb'][uncached].flatten(end_dim=1), obs_seq['depth'][uncached].flatten(end_dim=1))
+                visual_feature[uncached] = uncached_feature.reshape(len(uncached), self.obs_horizon, -1)
         feature = torch.cat((visual_feature, obs_seq['state']), dim=-1) # (B, obs_horizon, D+obs_state_dim)
         return feature.flatten(start_dim=1) # (B, obs_horizon * (D+obs_state_dim))
     
-    def get_eval_action(self, obs_seq, return_obs_embedding=False):
+    def denoise(self, obs_cond, noisy_action_seq, first_step=0, last_step=None):
+        # the denoising loop, from Gaussian noise to the action sequence (one graph with --compile-policy)
+        # runs the steps [first_step, last_step), all of them by default
+        # obs part of the FiLM conditioning, the same for all denoising steps
+        prepared_cond = self.noise_pred_net.prepare_conditioning(obs_cond)
+        for i in range(first_step, self.sampler.num_steps if last_step is None else last_step):
+            # predict noise
+            noise_pred = self.noise_pred_net(
+                sample=noisy_action_seq,
+                timestep=self.sampler.timesteps[i],
+                prepared_cond=prepared_cond,
+                step_index=self.noise_pred_net.inference_step_indices[i], # precomputed embedding of timesteps[i]
+            )
+
+            # inverse diffusion step (remove noise)
+            noisy_action_seq = self.sampler.step(i, noise_pred, noisy_action_seq)
+        return noisy_action_seq
+
+    def compile_inference(self, cache_dir=None):
+        self.denoise_fn = compile_inference_fn(self.denoise, cache_dir)
+
+    def get_eval_action(self, obs_seq, return_obs_embedding=False, warm_start=None, denoise_steps=None, frame_cache=None, uncached_envs=None):
         # obs_seq['state']: (B, obs_horizon, obs_dim)
         B = obs_seq['state'].shape[0]
-        with torch.no_grad():
-            obs_cond = self.encode_obs(obs_seq) # (B, obs_horizon * self.obs_embedding_dim)
+        with torch.no_grad(), torch.autocast(obs_seq['state'].device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None):
+            obs_cond = self.encode_obs(obs_seq, frame_cache, uncached_envs) # (B, obs_horizon * self.obs_embedding_dim)
 
             # initialize action from Guassian noise
             noisy_action_seq = torch.randn((B, self.pred_horizon, self.act_dim), device=obs_seq['state'].device)
 
-            for k in self.noise_scheduler.timesteps:
-                # predict noise
-                noise_pred = self.noise_pred_net(
-                    sample=noisy_action_seq,
-                    timestep=k,
-                    global_cond=obs_cond,
-                )
-
-                # inverse diffusion step (remove noise)
-                noisy_action_seq = self.noise_scheduler.step(
-                    model_output=noise_pred,
-                    timestep=k,
-                    sample=noisy_action_seq,
-                ).prev_sample
+            first_step, warm_start_steps = 0, 0
+            if warm_start is not None and warm_start.valid.any():
+                noisy_action_seq, first_step, warm_start_steps = warm_start_sample(
+                    self.denoise_fn, self.sampler, obs_cond, noisy_action_seq, warm_start, fixed_batch=self.denoise_fn != self.denoise) # the compiled graph has static shapes
+            if self.early_exit_tol > 0:
+                noisy_action_seq, num_steps = denoise_early_exit(
+                    self.noise_pred_net, self.sampler, obs_cond, noisy_action_seq, self.early_exit_tol, first_step)
+            else:
+                noisy_action_seq = self.denoise_fn(obs_cond, noisy_action_seq, first_step)
+                num_steps = np.full(B, self.sampler.num_steps - first_step)
+            num_steps = num_steps + warm_start_steps # the UNet steps run for each env before first_step
+            if warm_start is not None:
+                warm_start.update(noisy_action_seq)
+            if denoise_steps is not None:
+                denoise_steps.append(num_steps) # number of UNet steps actually run for each env, for logging
 
         # only take act_horizon number of actions
         start = self.obs_horizon - 1
@@ -455,10 +587,13 @@ def evaluate(n, base_policy, res_actor, eval_envs, device):
     res_actor.eval()
     result = defaultdict(list)
     obs_seq, info = eval_envs.reset() # don't seed here
+    warm_start = WarmStart(args.num_eval_envs, args.act_horizon, args.warm_start_steps) if args.warm_start_steps > 0 else None
+    frame_cache = FrameFeatureCache(args.num_eval_envs, args.obs_horizon, args.act_horizon) if args.cache_visual_features else None
+    denoise_steps = []
     while len(result['return']) < n:
         obs_seq_tensor = to_tensor(obs_seq, device)
         with torch.no_grad():
-            base_act_seq_tensor, obs_seq_embedding_tensor = base_policy.get_eval_action(obs_seq_tensor, return_obs_embedding=True)
+            base_act_seq_tensor, obs_seq_embedding_tensor = base_policy.get_eval_action(obs_seq_tensor, warm_start=warm_start, denoise_steps=denoise_steps, return_obs_embedding=True, frame_cache=frame_cache)
             obs_embedding_tensor = obs_seq_embedding_tensor[:, -base_policy.obs_embedding_dim:].detach() # most recent obs
             base_act_seq = base_act_seq_tensor.cpu().numpy()
             actor_input = obs_embedding_tensor if args.actor_input == 'obs' else torch.cat([obs_embedding_tensor, base_act_seq_tensor.reshape(-1, total_act_dim)], dim=1)
@@ -467,7 +602,12 @@ def evaluate(n, base_policy, res_actor, eval_envs, device):
         scaled_res_seq = args.res_scale * res_act_seq
         final_act_seq = base_act_seq + scaled_res_seq
         obs_seq, rew, terminated, truncated, info = eval_envs.step(final_act_seq)
+        if warm_start is not None:
+            warm_start.reset(terminated | truncated)
+        if frame_cache is not None:
+            frame_cache.step(terminated | truncated)
         collect_episode_info(info, result)
+    result['denoise_steps_per_query'] = np.concatenate(denoise_steps)
     print('======= Evaluation Ends =========')
     res_actor.train()
     return result
@@ -554,6 +694,13 @@ if __name__ == "__main__":
             break
     base_policy.eval()
     base_policy.requires_grad_(False)
+    if args.quantize_policy:
+        assert device.type == 'cpu', '--quantize-policy is only supported on CPU (--cuda False)'
+        quantize_int8(base_policy.noise_pred_net)
+    base_policy.set_inference_dtype(args.policy_dtype)
+    base_policy.prepare_inference()
+    if args.compile_policy:
+        base_policy.compile_inference(args.compile_cache_dir)
     
     # Residual agent setup
     class DummyObject: pass
@@ -589,17 +736,22 @@ if __name__ == "__main__":
         sac_alpha = args.sac_alpha
 
     dummy_env.single_observation_space.dtype = np.float32
-    rb = ReplayBuffer(
-        args.buffer_size,
-        dummy_env.single_observation_space,
-        dummy_env.single_action_space if args.critic_input == 'res' and args.actor_input == 'obs' else gym.spaces.Box(low=-np.inf, high=np.inf, shape=(total_act_dim * 3,)),
-        device,
-        n_envs=args.num_envs,
-        handle_timeout_termination=False, # stable-baselines3 has not fully supported Gymnasium's termination signal
-    )
+    rb_action_space = dummy_env.single_action_space if args.critic_input == 'res' and args.actor_input == 'obs' else gym.spaces.Box(low=-np.inf, high=np.inf, shape=(total_act_dim * 3,))
+    if args.compact_buffer:
+        # only the obs embeddings are deduplicated: base_next_actions is a separate query on real_next_obs_seq,
+        # not the base action executed at the next step, so it is stored as is (next_action_dim=0)
+        rb = CompactReplayBuffer(args.buffer_size, dummy_env.single_observation_space, rb_action_space, device, n_envs=args.num_envs,
+                                 dtype=BUFFER_DTYPES[args.buffer_dtype])
+    else:
+        rb = TensorReplayBuffer(args.buffer_size, dummy_env.single_observation_space, rb_action_space, device, n_envs=args.num_envs,
+                                dtype=BUFFER_DTYPES[args.buffer_dtype])
+    print(f'Replay buffer: {type(rb).__name__}, {rb.nbytes() / 2**30:.2f} GiB')
 
     # TRY NOT TO MODIFY: start the game
     obs_seq, info = envs.reset(seed=args.seed) # in Gymnasium, seed is given to reset() instead of seed()
+    warm_start = WarmStart(args.num_envs, args.act_horizon, args.warm_start_steps) if args.warm_start_steps > 0 else None
+    frame_cache = FrameFeatureCache(args.num_envs, args.obs_horizon, args.act_horizon) if args.cache_visual_features else None
+    denoise_steps = []
     global_step = 0
     global_update = 0
     learning_has_started = False
@@ -615,7 +767,7 @@ if __name__ == "__main__":
             global_step += 1 * args.num_envs
 
             obs_seq_tensor = to_tensor(obs_seq, device)
-            base_act_seq_tensor, obs_seq_embedding_tensor = base_policy.get_eval_action(obs_seq_tensor, return_obs_embedding=True)
+            base_act_seq_tensor, obs_seq_embedding_tensor = base_policy.get_eval_action(obs_seq_tensor, warm_start=warm_start, denoise_steps=denoise_steps, return_obs_embedding=True, frame_cache=frame_cache)
             obs_embedding_tensor = obs_seq_embedding_tensor[:, -base_policy.obs_embedding_dim:].detach() # most recent obs
             base_act_seq = base_act_seq_tensor.cpu().numpy() # (B, act_horizon, act_dim)
             base_actions = base_act_seq.reshape(-1, total_act_dim)
@@ -642,11 +794,14 @@ if __name__ == "__main__":
 
             # TRY NOT TO MODIFY: record rewards for plotting purposes
             result = collect_episode_info(infos, result)
+            if frame_cache is not None:
+                frame_cache.step(terminations | truncations)
 
             # TRY NOT TO MODIFY: save data to reply buffer; handle `final_observation`
             real_next_obs_seq = {
                 k: v.copy() for k, v in next_obs_seq.items()
             }
+            final_obs_envs = [] # envs where real_next_obs_seq is not next_obs_seq
             if args.bootstrap_at_done == 'never':
                 stop_bootstrap = truncations | terminations # always stop bootstrap when episode ends
             else:
@@ -660,21 +815,23 @@ if __name__ == "__main__":
                     if _need_final_obs:
                         for k in next_obs_seq.keys():
                             real_next_obs_seq[k][idx] = infos["final_observation"][idx][k] # info saves np object
+                        final_obs_envs.append(idx)
 
             if args.critic_input == 'res' and args.actor_input == 'obs':
                 raise NotImplementedError('need to get obs embedding for real_next_obs here')
             else: # sum or concat both need base actions for s and s'
-                base_next_act_seq_tensor, real_next_obs_seq_embedding_tensor = base_policy.get_eval_action(to_tensor(real_next_obs_seq, device), return_obs_embedding=True)
+                base_next_act_seq_tensor, real_next_obs_seq_embedding_tensor = base_policy.get_eval_action(to_tensor(real_next_obs_seq, device), return_obs_embedding=True, frame_cache=frame_cache, uncached_envs=final_obs_envs)
                 base_next_act_seq = base_next_act_seq_tensor.cpu().numpy()
-                real_next_obs_embedding = real_next_obs_seq_embedding_tensor[:, -base_policy.obs_embedding_dim:].detach().cpu().numpy() # most recent obs
+                real_next_obs_embedding_tensor = real_next_obs_seq_embedding_tensor[:, -base_policy.obs_embedding_dim:].detach() # most recent obs
                 base_next_actions = base_next_act_seq.reshape(-1, total_act_dim)
                 actions_to_save = np.concatenate([res_actions, base_actions, base_next_actions], axis=1)
             
-            obs_embedding = obs_embedding_tensor.cpu().numpy()
-            rb.add(obs_embedding, real_next_obs_embedding, actions_to_save, rewards, stop_bootstrap, infos)
+            rb.add(obs_embedding_tensor, real_next_obs_embedding_tensor, actions_to_save, rewards, stop_bootstrap, infos, boundary=final_obs_envs) # the embeddings stay on the device
 
             step_in_episodes += args.act_horizon
             step_in_episodes[terminations | truncations] = 0
+            if warm_start is not None:
+                warm_start.reset(terminations | truncations)
 
             # TRY NOT TO MODIFY: CRUCIAL step easy to overlook
             obs_seq = next_obs_seq
@@ -686,9 +843,10 @@ if __name__ == "__main__":
             continue
 
         learning_has_started = True
+        batches = rb.sample_batches(num_updates_per_training, args.batch_size) # one gather for all the updates of the round
         for local_update in range(num_updates_per_training):
             global_update += 1
-            data = rb.sample(args.batch_size)
+            data = batches[local_update]
 
             if args.critic_input != 'res' or args.actor_input == 'obs_base_action':
                 res_actions = data.actions[:, :total_act_dim]
@@ -796,6 +954,14 @@ if __name__ == "__main__":
             writer.add_scalar("losses/actor_grad_norm", actor_grad_norm.item(), global_step)
             # print("SPS:", int(global_step / (time.time() - start_time)))
             timer.dump_to_writer(writer, global_step)
+            if len(denoise_steps) > 0:
+                steps = np.concatenate(denoise_steps)
+                writer.add_scalar("charts/denoise_steps_per_query", steps.mean(), global_step)
+                writer.add_histogram("charts/denoise_steps", steps, global_step)
+                denoise_steps.clear()
+            if frame_cache is not None and frame_cache.num_queried > 0:
+                writer.add_scalar("charts/encoded_frame_ratio", frame_cache.num_encoded / frame_cache.num_queried, global_step)
+                frame_cache.num_queried, frame_cache.num_encoded = 0, 0
             if args.autotune:
                 writer.add_scalar("losses/sac_alpha_loss", sac_alpha_loss.item(), global_step)
 
@@ -0,0 +1,67 @@
+"""Test CompactReplayBuffer against TensorReplayBuffer on random rollouts with episode ends"""
+import numpy as np
+import torch
+from gymnasium import spaces
+
+from utils.replay_buffer import TensorReplayBuffer, CompactReplayBuffer
+
+
+def rollout(buffer_size, n_envs, obs_dim, k, dtype, steps, p_done, final_obs, mask=True, seed=0):
+    # fills both buffers with the same transitions, like the online scripts: the obs of a step is the next obs
+    # of the previous step, the base actions (k columns) executed at a step are base_next_actions of the previous step,
+    # except for the envs where `final_observation` is substituted (passed as boundary)
+    rng = np.random.default_rng(seed)
+    act_dim = 2 * k + 5 if k else 7
+    args = (buffer_size, spaces.Box(-1, 1, (obs_dim,)), spaces.Box(-1, 1, (act_dim,)), 'cpu', n_envs)
+    ref = TensorReplayBuffer(*args, dtype=dtype)
+    rb = CompactReplayBuffer(*args, dtype=dtype, next_action_dim=k)
+    obs = rng.standard_normal((n_envs, obs_dim)).astype(np.float32)
+    base = rng.standard_normal((n_envs, k)).astype(np.float32)
+    for _ in range(steps):
+        res = rng.standard_normal((n_envs, act_dim - 2 * k)).astype(np.float32)
+        done = rng.random(n_envs) < p_done
+        next_obs = rng.standard_normal((n_envs, obs_dim)).astype(np.float32) # after the reset for the done envs
+        next_base = rng.standard_normal((n_envs, k)).astype(np.float32)
+        real_next_obs, base_next = next_obs.copy(), next_base.copy()
+        boundary = done & (rng.random(n_envs) < 0.8) if final_obs else np.zeros(n_envs, dtype=bool)
+        real_next_obs[boundary] = rng.standard_normal((boundary.sum(), obs_dim))
+        base_next[boundary] = rng.standard_normal((boundary.sum(), k))
+        actions = np.concatenate([res, base, base_next], axis=1) if k else res
+        rewards, stop_bootstrap = rng.random(n_envs), done & (rng.random(n_envs) < 0.5)
+        ref.add(obs, real_next_obs, actions, rewards, stop_bootstrap)
+        rb.add(obs, real_next_obs, actions, rewards, stop_bootstrap, boundary=boundary if mask else list(np.flatnonzero(boundary)))
+        obs, base = next_obs, next_base
+    return ref, rb
+
+
+def check_equal(ref, rb):
+    # every transition CompactReplayBuffer samples is stored exactly like in TensorReplayBuffer
+    E = rb.n_envs
+    if rb.full: # all rows but pos
+        rows = (rb.pos + 1 + torch.arange(rb.buffer_size - 1)) % rb.buffer_size
+    else:
+        rows = torch.arange(rb.pos)
+    idx = (rows.unsqueeze(1) * E + torch.arange(E)).flatten()
+    assert set(rb.sample_indices(20 * len(idx)).tolist()) == set(idx.tolist())
+    expected, got = ref.get(idx), rb.get(idx)
+    for field in expected._fields:
+        assert torch.equal(getattr(expected, field), getattr(got, field)), field
+
+
+def test_compact_replay_buffer():
+    for config in [
+        dict(buffer_size=50, n_envs=4, obs_dim=6, k=3, dtype=torch.float32, steps=10, p_done=0.1, final_obs=True), # not full
+        dict(buffer_size=50, n_envs=4, obs_dim=6, k=3, dtype=torch.float32, steps=237, p_done=0.1, final_obs=True), # wrapped around
+        dict(buffer_size=50, n_envs=4, obs_dim=6, k=0, dtype=torch.float32, steps=237, p_done=0.3, final_obs=True), # no next actions
+        dict(buffer_size=50, n_envs=4, obs_dim=6, k=3, dtype=torch.float16, steps=500, p_done=0.5, final_obs=True, mask=False),
+        dict(buffer_size=50, n_envs=4, obs_dim=6, k=3, dtype=torch.float32, steps=500, p_done=0.5, final_obs=False), # --bootstrap-at-done never
+        dict(buffer_size=40, n_envs=4, obs_dim=6, k=3, dtype=torch.bfloat16, steps=13, p_done=0.9, final_obs=True), # boundary slots grow
+    ]:
+        for seed in range(3):
+            ref, rb = rollout(**config, seed=seed)
+            check_equal(ref, rb)
+
+
+if __name__ == '__main__':
+    test_compact_replay_buffer()
+    print('CompactReplayBuffer matches TensorReplayBuffer')
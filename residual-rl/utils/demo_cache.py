@@ -0,0 +1,235 @@
+"""
+Flat columnar cache of a ManiSkill demo file (trajectory.h5 + .json).
+
+Every field (e.g. 'actions', 'observations', or 'observations/image/base_camera/rgb' for nested obs)
+is stored as one contiguous .npy file with all trajectories concatenated, plus an int64 offset table.
+The .npy files are memory-mapped when loading, so repeat runs start without parsing the h5 tree.
+
+The cache can also be placed in shared memory (`root=SHM_CACHE_ROOT`, i.e. /dev/shm): concurrent runs on the same demo
+then build it once and all map the same pages, so memory does not grow with the number of runs.
+
+Layout of a cache dir (`<demo>.cache/<control_mode>[-<variant>]/`, or `<root>/<demo name>-<key>/...`):
+    meta.json           fingerprint of the source file, traj keys, fields (shape/dtype), extra rows per key
+    traj_offsets.npy    int64 (N+1,), offsets of the transitions (actions) of each trajectory
+    <field>.npy         one per field, '/' in field names replaced by '.'
+"""
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+from utils.ms_data import TrajectoryStore, expand_demo_paths, load_json, order_traj_keys, read_control_mode
+
+CACHE_VERSION = 1
+SHM_CACHE_ROOT = '/dev/shm/demo-cache'
+
+
+def file_fingerprint(path, with_hash=True):
+    stat = os.stat(path)
+    fp = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if with_hash:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                h.update(block)
+        fp['sha1'] = h.hexdigest()
+    return fp
+
+def fingerprint_matches(path, fp):
+    # size + mtime is enough in the common case, only hash the file if the mtime changed (e.g. copied file)
+    cur = file_fingerprint(path, with_hash=False)
+    if cur['size'] != fp['size']:
+        return False
+    return cur['mtime'] == fp['mtime'] or file_fingerprint(path)['sha1'] == fp['sha1']
+
+def get_cache_dir(h5_path, control_mode, variant=None, root=None):
+    name = control_mode if variant is None else f'{control_mode}-{variant}'
+    if root is None:
+        return os.path.join(h5_path[:-len('.h5')] + '.cache', name)
+    # outside of the demo dir, the key tells apart demo files with the same name (cheap, no hashing of the content)
+    stat = os.stat(h5_path)
+    key = hashlib.sha1(f'{os.path.abspath(h5_path)}:{stat.st_size}:{stat.st_mtime}'.encode()).hexdigest()[:16]
+    return os.path.join(root, f'{os.path.basename(h5_path)[:-len(".h5")]}-{key}', name)
+
+def _flatten(d, prefix):
+    if not isinstance(d, dict):
+        return {prefix: d}
+    out = {}
+    for k, v in d.items():
+        out.update(_flatten(v, f'{prefix}/{k}'))
+    return out
+
+def _unflatten(flat, prefix):
+    if prefix in flat:
+        return flat[prefix]
+    out = {}
+    for name, v in flat.items():
+        if not name.startswith(prefix + '/'):
+            continue
+        node = out
+        parts = name[len(prefix)+1:].split('/')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = v
+    return out
+
+
+def build_demo_cache(h5_path, cache_dir, keys=['observations', 'actions'], obs_keys=None, obs_process_fn=None):
+    """
+    Convert a demo h5 into a flat cache, one trajectory at a time (memory is bounded by the largest trajectory).
+    obs_process_fn: optional per-trajectory obs transform (numpy in, numpy out),
+        its output is cached instead of the raw obs, so make sure `cache_dir` reflects it (see `variant`).
+    """
+    print(f'Building demo cache for {h5_path} in {cache_dir}')
+    fingerprint = file_fingerprint(h5_path)
+    store = TrajectoryStore(h5_path, keys, obs_keys=obs_keys)
+    # store the trajectories sorted by index, so that num_traj selects a contiguous prefix
+    traj_keys = order_traj_keys(list(store.traj_keys), num_traj=len(store))
+    order = [store.traj_keys.index(k) for k in traj_keys]
+    lengths = store.lengths[order]
+    traj_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    def read_traj(i):
+        traj = {k: store.read(i, k) for k in keys}
+        if obs_process_fn is not None and 'observations' in traj:
+            traj['observations'] = obs_process_fn(traj['observations'])
+        return traj
+
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    files, fields, extra_rows = {}, {}, {}
+    for j, i in enumerate(order):
+        traj = read_traj(i)
+        if j == 0: # allocate the output files from the first trajectory
+            for k in keys:
+                flat = _flatten(traj[k], k)
+                extra_rows[k] = next(iter(flat.values())).shape[0] - int(lengths[0])
+                for name, v in flat.items():
+                    total = int(traj_offsets[-1]) + extra_rows[k] * len(order)
+                    files[name] = np.lib.format.open_memmap(
+                        os.path.join(tmp_dir, name.replace('/', '.') + '.npy'), mode='w+',
+                        dtype=v.dtype, shape=(total,) + v.shape[1:])
+                    fields[name] = {'dtype': v.dtype.str, 'shape': list(files[name].shape)}
+        for k in keys:
+            start = int(traj_offsets[j]) + extra_rows[k] * j
+            for name, v in _flatten(traj[k], k).items():
+                assert v.shape[0] == lengths[j] + extra_rows[k], (name, v.shape, lengths[j])
+                files[name][start:start+v.shape[0]] = v
+    for f in files.values():
+        f.flush()
+    np.save(os.path.join(tmp_dir, 'traj_offsets.npy'), traj_offsets)
+    meta = {
+        'version': CACHE_VERSION,
+        'source': os.path.abspath(h5_path),
+        'fingerprint': fingerprint,
+        'traj_keys': traj_keys,
+        'keys': list(keys),
+        'obs_keys': obs_keys,
+        'fields': fields,
+        'extra_rows': extra_rows,
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+    print(f'Demo cache built: {len(order)} trajectories, {traj_offsets[-1]} transitions')
+
+
+class DemoCache(object):
+    def __init__(self, cache_dir, mmap_mode='c'):
+        # mmap_mode='c' (copy-on-write) so that torch.from_numpy does not complain about read-only arrays
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.cache_dir = cache_dir
+        self.traj_keys = self.meta['traj_keys']
+        self.traj_offsets = np.load(os.path.join(cache_dir, 'traj_offsets.npy'))
+        self.lengths = np.diff(self.traj_offsets)
+        self.fields = {
+            name: np.load(os.path.join(cache_dir, name.replace('/', '.') + '.npy'), mmap_mode=mmap_mode)
+            for name in self.meta['fields']
+        }
+
+    def __len__(self):
+        return len(self.traj_keys)
+
+    def offsets(self, key):
+        # row offsets of each trajectory in the fields of `key`, obs have one more row (L+1) per trajectory
+        return self.traj_offsets + self.meta['extra_rows'][key] * np.arange(len(self) + 1)
+
+    def field_names(self, key):
+        # 'observations' for state obs, 'observations/...' for every leaf of nested obs
+        return [name for name in self.fields if name == key or name.startswith(key + '/')]
+
+    def get(self, key):
+        # the whole flat array, or a nested dict of flat arrays for nested obs
+        return _unflatten({name: self.fields[name] for name in self.field_names(key)}, key)
+
+    def traj_indices(self, num_traj=None):
+        # same trajectory order as `load_traj_hdf5`
+        index = {k: i for i, k in enumerate(self.traj_keys)}
+        keys = order_traj_keys(sorted(self.traj_keys), num_traj)
+        if num_traj is not None:
+            assert num_traj <= len(keys), f"num_traj: {num_traj} > len(keys): {len(keys)}"
+            keys = keys[:num_traj]
+        return [index[k] for k in keys]
+
+    def load_trajectories(self, keys=['observations', 'actions'], num_traj=None, device=None):
+        """
+        Returns the same structure as `load_demo_dataset(..., concat=False)`, but every trajectory is a view
+        of the flat arrays, so nothing is parsed or copied. If device is given, each field is uploaded once
+        as a single tensor and the trajectories are views of it.
+        """
+        traj_indices = self.traj_indices(num_traj)
+        last = max(traj_indices) + 1
+        ret = {}
+        for key in keys:
+            offsets = self.offsets(key)
+            arrays = {}
+            for name in self.field_names(key):
+                v = self.fields[name][:offsets[last]]
+                arrays[name] = torch.from_numpy(v).to(device) if device is not None else v
+            ret[key] = [
+                _unflatten({name: v[offsets[i]:offsets[i+1]] for name, v in arrays.items()}, key)
+                for i in traj_indices
+            ]
+        print(f'Loaded {len(traj_indices)} trajectories from demo cache {self.cache_dir}')
+        return ret
+
+
+def load_demo_cache(h5_path, control_mode=None, keys=['observations', 'actions'], obs_keys=None,
+                    obs_process_fn=None, variant=None, root=None):
+    """
+    Load the flat cache of `h5_path`, (re)building it first if missing or stale.
+    The cache is keyed on the control mode (+ `variant`, which must describe `obs_process_fn` if it is given)
+    and invalidated when the source file changes (size / mtime / sha1).
+    root: where to put the cache instead of next to the demo file, e.g. SHM_CACHE_ROOT.
+    Concurrent runs wait for the first one to build the cache, then all of them map it.
+    """
+    assert len(expand_demo_paths(h5_path)) == 1, 'The demo cache only supports a single demo file'
+    demo_info = load_json(h5_path[:-len('.h5')] + '.json')
+    demo_control_mode = read_control_mode(demo_info)
+    if control_mode is not None:
+        assert demo_control_mode == control_mode, 'Control mode mismatched'
+    cache_dir = get_cache_dir(h5_path, demo_control_mode, variant, root)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+    with open(cache_dir + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX) # released when the file is closed
+        valid = False
+        if os.path.exists(meta_path):
+            meta = load_json(meta_path)
+            valid = meta['version'] == CACHE_VERSION and set(keys) <= set(meta['keys']) \
+                and meta['obs_keys'] == obs_keys and fingerprint_matches(h5_path, meta['fingerprint'])
+            if not valid:
+                print(f'Demo cache {cache_dir} is stale, rebuilding')
+            elif meta['fingerprint']['mtime'] != os.stat(h5_path).st_mtime: # same content, remember the new mtime
+                meta['fingerprint']['mtime'] = os.stat(h5_path).st_mtime
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f, indent=2)
+        if not valid:
+            build_demo_cache(h5_path, cache_dir, keys, obs_keys, obs_process_fn)
+    return DemoCache(cache_dir)
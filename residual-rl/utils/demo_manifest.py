@@ -0,0 +1,283 @@
+"""
+Manifest sidecar of a ManiSkill demo file (trajectory.h5 + .json), with everything the trainers need at startup
+besides the data itself: control mode, env kwargs (camera config), trajectory lengths, action statistics
+and the training windows. Reading it takes milliseconds, instead of parsing the json and the actions of the h5.
+
+Layout of `<demo>.manifest/`:
+    manifest.json       fingerprints of the h5 / json, control mode, env info, traj keys (manifest order),
+                        sha1 of the actions of these trajectories
+    lengths.npy         int64 (N,), number of transitions of each trajectory
+    action_stats.npz    per trajectory sum / sum of squares / min / max of the actions, float64 (N, act_dim)
+    windows-<spec>.npy  int64 (M, 3), (traj_idx, start, end) windows of all trajectories, see `get_windows`
+
+Per-trajectory stats are stored, so that the stats of any subset (e.g. num_traj) are cheap to get.
+The manifest order is append-only: if trajectories were appended to the h5 and the known ones still have
+the same actions (lengths, then sha1) and control mode, only the new ones are read and appended (windows files included).
+Any other change of the h5 rebuilds the manifest. Concurrent runs share it through a lock file (`<demo>.manifest.lock`).
+"""
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import numpy as np
+from h5py import File
+
+from utils.ms_data import load_json, order_traj_keys, read_control_mode
+from utils.demo_cache import file_fingerprint, fingerprint_matches
+
+MANIFEST_VERSION = 2
+
+
+def get_manifest_dir(h5_path):
+    return h5_path[:-len('.h5')] + '.manifest'
+
+def _window_params(spec):
+    # (first start, last start relative to the trajectory length (exclusive), window size)
+    if spec[0] == 'dp': # Diffusion Policy: ('dp', obs_horizon, pred_horizon), padded before and after the trajectory
+        _, obs_horizon, pred_horizon = spec
+        return -(obs_horizon - 1), -obs_horizon, pred_horizon
+    if spec[0] == 'seq': # plain windows inside the trajectory: ('seq', history_len), e.g. BeT
+        _, history_len = spec
+        return 0, -history_len, history_len
+    raise NotImplementedError(f'Unknown window spec {spec}')
+
+def get_windows(lengths, spec):
+    # all (traj_idx, start, end) windows of trajectories with these lengths, same order as the python loops of the datasets
+    first, last, size = _window_params(spec)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    counts = np.maximum(lengths + last - first, 0)
+    traj_idx = np.repeat(np.arange(len(lengths)), counts)
+    starts = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + first
+    return np.stack([traj_idx, starts, starts + size], axis=1).astype(np.int64)
+
+def _gather_ranges(offsets, counts):
+    # concatenation of arange(offsets[i], offsets[i] + counts[i])
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - offsets, counts)
+
+def _hash_actions(file, traj_keys, h):
+    for traj_key in traj_keys:
+        h.update(traj_key.encode())
+        h.update(np.ascontiguousarray(file[traj_key]['actions'][()]).tobytes())
+
+def _read_action_stats(file, traj_keys, h):
+    # per trajectory lengths and action stats, h: sha1 of the actions, updated with these trajectories
+    stats = {'sum': [], 'sq_sum': [], 'min': [], 'max': []}
+    lengths = []
+    for traj_key in traj_keys:
+        actions = file[traj_key]['actions'][()]
+        h.update(traj_key.encode())
+        h.update(np.ascontiguousarray(actions).tobytes())
+        actions = actions.astype(np.float64)
+        lengths.append(len(actions))
+        stats['sum'].append(actions.sum(axis=0))
+        stats['sq_sum'].append((actions ** 2).sum(axis=0))
+        stats['min'].append(actions.min(axis=0))
+        stats['max'].append(actions.max(axis=0))
+    return np.array(lengths, dtype=np.int64), stats
+
+def _write_json(path, obj):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def compute_demo_manifest(h5_path, manifest_dir=None, meta=None):
+    """
+    Everything in the manifest of `h5_path`, in memory: (meta, lengths, action stats, {spec name: windows}).
+    If `meta` (the stale manifest.json in `manifest_dir`) is given and the h5 only got new trajectories, i.e.
+    same control mode and the known trajectories still have the same actions (sha1), only the new ones are read
+    and appended to the stats and windows. Otherwise (e.g. a regenerated demo) everything is recomputed.
+    """
+    json_path = h5_path[:-len('.h5')] + '.json'
+    demo_info = load_json(json_path)
+    control_mode = read_control_mode(demo_info)
+    with File(h5_path, 'r') as file:
+        all_keys = order_traj_keys(list(file.keys()), num_traj=len(file.keys())) # sorted by index
+        incremental = meta is not None and meta['version'] == MANIFEST_VERSION \
+            and meta['control_mode'] == control_mode and set(meta['traj_keys']) <= set(all_keys)
+        if incremental:
+            old_lengths = np.load(os.path.join(manifest_dir, 'lengths.npy'))
+            incremental = all(file[k]['actions'].shape[0] == L for k, L in zip(meta['traj_keys'], old_lengths))
+        if incremental: # an appended file, not a regenerated one
+            h = hashlib.sha1()
+            _hash_actions(file, meta['traj_keys'], h)
+            incremental = h.hexdigest() == meta['actions_sha1']
+        if incremental:
+            known = set(meta['traj_keys'])
+            traj_keys = meta['traj_keys'] + [k for k in all_keys if k not in known]
+            print(f'Updating demo manifest {manifest_dir}: {len(traj_keys) - len(known)} new trajectories')
+            new_lengths, new_stats = _read_action_stats(file, traj_keys[len(known):], h)
+            with np.load(os.path.join(manifest_dir, 'action_stats.npz')) as f:
+                old_stats = dict(f)
+            stats = {k: np.concatenate([old_stats[k], np.array(v).reshape(-1, old_stats[k].shape[1])]) for k, v in new_stats.items()}
+            lengths = np.concatenate([old_lengths, new_lengths])
+            windows = {}
+            for spec_name, spec in meta['window_specs'].items():
+                path = os.path.join(manifest_dir, f'windows-{spec_name}.npy')
+                if os.path.exists(path):
+                    new_windows = get_windows(new_lengths, spec)
+                    new_windows[:, 0] += len(old_lengths)
+                    windows[spec_name] = np.concatenate([np.load(path), new_windows])
+        else:
+            if meta is not None:
+                print(f'Demo manifest of {h5_path} is stale, rebuilding')
+            print(f'Building demo manifest for {h5_path}')
+            h = hashlib.sha1()
+            traj_keys = all_keys
+            lengths, stats = _read_action_stats(file, traj_keys, h)
+            stats = {k: np.array(v) for k, v in stats.items()}
+            windows = {}
+    meta = {
+        'version': MANIFEST_VERSION,
+        'fingerprint': file_fingerprint(h5_path),
+        'json_fingerprint': file_fingerprint(json_path),
+        'control_mode': control_mode,
+        'env_info': demo_info['env_info'],
+        'traj_keys': traj_keys,
+        'actions_sha1': h.hexdigest(),
+        'window_specs': {name: meta['window_specs'][name] for name in windows},
+    }
+    return meta, lengths, stats, windows
+
+def write_demo_manifest(manifest_dir, meta, lengths, stats, windows):
+    # written to a tmp dir and moved in place, call with the lock of the manifest held
+    tmp_dir = manifest_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, 'lengths.npy'), lengths)
+    np.savez(os.path.join(tmp_dir, 'action_stats.npz'), **stats)
+    for spec_name, w in windows.items():
+        np.save(os.path.join(tmp_dir, f'windows-{spec_name}.npy'), w)
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(manifest_dir, ignore_errors=True)
+    os.replace(tmp_dir, manifest_dir)
+
+
+class DemoManifest(object):
+    def __init__(self, manifest_dir, meta=None, lengths=None, stats=None):
+        # manifest_dir=None: a manifest computed in memory (read-only demo dir, see load_demo_manifest)
+        self.manifest_dir = manifest_dir
+        if manifest_dir is not None:
+            meta = load_json(os.path.join(manifest_dir, 'manifest.json'))
+            lengths = np.load(os.path.join(manifest_dir, 'lengths.npy'))
+        self.meta = meta
+        self.control_mode = self.meta['control_mode']
+        self.env_kwargs = self.meta['env_info']['env_kwargs']
+        self.traj_keys = self.meta['traj_keys']
+        self.lengths = lengths
+        self._stats = stats
+        self._windows = {} # of an in-memory manifest
+
+    def __len__(self):
+        return len(self.traj_keys)
+
+    def select_traj_keys(self, num_traj=None):
+        # same trajectories, in the same order, as `load_traj_hdf5` (without traj_filter)
+        keys = order_traj_keys(sorted(self.traj_keys), num_traj)
+        if num_traj is not None:
+            assert num_traj <= len(keys), f"num_traj: {num_traj} > len(keys): {len(keys)}"
+            keys = keys[:num_traj]
+        return keys
+
+    def traj_indices(self, traj_keys):
+        index = {k: i for i, k in enumerate(self.traj_keys)}
+        return np.array([index[k] for k in traj_keys], dtype=np.int64)
+
+    def action_stats(self, traj_keys=None):
+        # mean / std / min / max of the actions of these trajectories (all of them by default)
+        if self._stats is None:
+            with np.load(os.path.join(self.manifest_dir, 'action_stats.npz')) as f:
+                self._stats = dict(f)
+        idx = self.traj_indices(traj_keys) if traj_keys is not None else slice(None)
+        n = int(self.lengths[idx].sum())
+        act_sum, act_sq_sum = self._stats['sum'][idx].sum(axis=0), self._stats['sq_sum'][idx].sum(axis=0)
+        mean = act_sum / n
+        var = np.maximum(act_sq_sum / n - mean ** 2, 0)
+        return {
+            'mean': mean, 'std': np.sqrt(var),
+            'min': self._stats['min'][idx].min(axis=0), 'max': self._stats['max'][idx].max(axis=0),
+            'n': n, 'sum': act_sum, 'sq_sum': act_sq_sum, # to merge the stats of several demo files
+        }
+
+    def _save_windows(self, spec_name, spec, path):
+        # under the lock of the manifest, the file is written to a tmp file and moved in place
+        with open(self.manifest_dir + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(path): # or another run saved it meanwhile
+                np.save(path[:-len('.npy')] + '.tmp.npy', get_windows(self.lengths, spec))
+                os.replace(path[:-len('.npy')] + '.tmp.npy', path)
+            meta_path = os.path.join(self.manifest_dir, 'manifest.json')
+            meta = load_json(meta_path)
+            if spec_name not in meta['window_specs']:
+                meta['window_specs'][spec_name] = spec
+                _write_json(meta_path, meta)
+        self.meta['window_specs'][spec_name] = spec
+
+    def windows(self, spec, traj_keys=None):
+        """
+        Windows of `get_windows(lengths of traj_keys, spec)`, i.e. traj_idx is the position in `traj_keys`.
+        The windows of all trajectories are computed once per spec and saved in the manifest.
+        """
+        spec = list(spec)
+        spec_name = '-'.join(map(str, spec))
+        if self.manifest_dir is not None:
+            path = os.path.join(self.manifest_dir, f'windows-{spec_name}.npy')
+            if not os.path.exists(path):
+                try:
+                    self._save_windows(spec_name, spec, path)
+                except OSError as e: # e.g. the demo dir became read-only, keep them in memory
+                    print(f'[WARN] Cannot save the windows in the demo manifest ({e})')
+                    self._windows[spec_name] = get_windows(self.lengths, spec)
+            windows = self._windows[spec_name] if spec_name in self._windows else np.load(path, mmap_mode='r')
+        else:
+            if spec_name not in self._windows:
+                self._windows[spec_name] = get_windows(self.lengths, spec)
+            windows = self._windows[spec_name]
+        if traj_keys is None:
+            return np.array(windows)
+        idx = self.traj_indices(traj_keys)
+        first, last, _ = _window_params(spec)
+        counts = np.maximum(self.lengths + last - first, 0)
+        if np.array_equal(idx, np.arange(len(idx))): # a prefix of the manifest, the common case
+            return np.array(windows[:counts[:len(idx)].sum()])
+        offsets = np.cumsum(counts) - counts
+        out = windows[_gather_ranges(offsets[idx], counts[idx])]
+        out[:, 0] = np.repeat(np.arange(len(idx)), counts[idx])
+        return out
+
+
+def load_demo_manifest(h5_path):
+    """
+    Load the manifest of `h5_path`, building or updating it first if missing or stale.
+    Concurrent runs wait for the first one to build it (flock on `<manifest dir>.lock`), and every file is written
+    to a tmp file / dir and moved in place, so a manifest is never read half-written.
+    If the demo dir is not writable, the manifest is computed in memory instead (the actions are read every run).
+    """
+    manifest_dir = get_manifest_dir(h5_path)
+    json_path = h5_path[:-len('.h5')] + '.json'
+    try:
+        lock = open(manifest_dir + '.lock', 'w')
+    except OSError as e:
+        print(f'[WARN] Cannot write the demo manifest of {h5_path} ({e}), computing it in memory')
+        return DemoManifest(None, *compute_demo_manifest(h5_path)[:3])
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX) # released when the file is closed
+        meta_path = os.path.join(manifest_dir, 'manifest.json')
+        meta = load_json(meta_path) if os.path.exists(meta_path) else None
+        if meta is None or meta['version'] != MANIFEST_VERSION \
+                or not fingerprint_matches(h5_path, meta['fingerprint']) \
+                or not fingerprint_matches(json_path, meta['json_fingerprint']):
+            manifest = compute_demo_manifest(h5_path, manifest_dir, meta)
+            try:
+                write_demo_manifest(manifest_dir, *manifest)
+            except OSError as e:
+                print(f'[WARN] Cannot write the demo manifest of {h5_path} ({e}), using it in memory')
+                return DemoManifest(None, *manifest[:3])
+        elif meta['fingerprint']['mtime'] != os.stat(h5_path).st_mtime \
+                or meta['json_fingerprint']['mtime'] != os.stat(json_path).st_mtime: # same content, remember the new mtime
+            meta['fingerprint']['mtime'] = os.stat(h5_path).st_mtime
+            meta['json_fingerprint']['mtime'] = os.stat(json_path).st_mtime
+            _write_json(meta_path, meta)
+        return DemoManifest(manifest_dir)
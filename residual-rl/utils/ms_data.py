@@ -1,10 +1,36 @@
+import os
+import re
+import glob
+import multiprocessing as mp
+from collections import OrderedDict
+from multiprocessing import shared_memory, resource_tracker
 from h5py import File, Group, Dataset
 import numpy as np
 
-def load_content_from_h5_file(file):
+def match_sub_keys(path, sub_keys):
+    # a sub key like 'extra', 'rgb' or 'image/base_camera' matches if it is a contiguous part of the path
+    for sub_key in sub_keys:
+        parts = tuple(sub_key.split('/'))
+        n = len(parts)
+        if any(path[i:i+n] == parts for i in range(len(path) - n + 1)):
+            return True
+    return False
+
+def load_content_from_h5_file(file, sub_keys=None, path=()):
+    """
+    sub_keys: if given, only the datasets inside `file` whose path matches one of them are read,
+        e.g. ['extra', 'rgb'] reads obs/extra/* and obs/image/*/rgb. Groups left empty are dropped.
+    """
     if isinstance(file, (File, Group)):
-        return {key: load_content_from_h5_file(file[key]) for key in list(file.keys())}
+        ret = {}
+        for key in list(file.keys()):
+            v = load_content_from_h5_file(file[key], sub_keys, path + (key,))
+            if v is not None:
+                ret[key] = v
+        return ret if ret or sub_keys is None or not path else None
     elif isinstance(file, Dataset):
+        if sub_keys is not None and path and not match_sub_keys(path, sub_keys):
+            return None # never touched
         return file[()]
     else:
         raise NotImplementedError(f"Unspported h5 file type: {type(file)}")
@@ -17,21 +43,159 @@ def load_hdf5(path, ):
     print('Loaded')
     return ret
 
-def load_traj_hdf5(path, num_traj=None):
-    print('Loading HDF5 file', path)
-    file = File(path, 'r')
-    keys = list(file.keys())
+def order_traj_keys(keys, num_traj=None):
+    # h5 keys are sorted alphabetically (traj_0, traj_1, traj_10, ...), they are only sorted by index if num_traj is given
     if num_traj is not None:
-        assert num_traj <= len(keys), f"num_traj: {num_traj} > len(keys): {len(keys)}"
         keys = sorted(keys, key=lambda x: int(x.split('_')[-1]))
+    return keys
+
+def select_traj_keys(file, num_traj=None, traj_filter=None, strict=True):
+    """
+    traj_filter: optional predicate on the h5 group of a trajectory, evaluated before any obs is read,
+        e.g. `is_success_traj` or `lambda traj: traj['actions'].shape[0] <= 200`.
+        num_traj is applied after filtering.
+    strict: if False, num_traj is an upper bound (used for shards, see `load_traj_shards`).
+    """
+    keys = order_traj_keys(list(file.keys()), num_traj)
+    if traj_filter is not None:
+        n_before = len(keys)
+        keys = [key for key in keys if traj_filter(file[key])]
+        print(f'Trajectory filter kept {len(keys)} / {n_before} trajectories')
+    if num_traj is not None:
+        assert num_traj <= len(keys) or not strict, f"num_traj: {num_traj} > len(keys): {len(keys)}"
         keys = keys[:num_traj]
+    return keys
+
+def is_success_traj(traj):
+    # only reads the last element of `success`
+    return bool(traj['success'][-1])
+
+def load_traj_from_h5_group(traj, keys=None, obs_keys=None, obs_process_fn=None):
+    source_keys = list(traj.keys()) if keys is None else keys
+    for source_key in source_keys:
+        assert source_key in traj, f"key: {source_key} not in {traj.name}: {traj.keys()}"
     ret = {
-        key: load_content_from_h5_file(file[key]) for key in keys
+        k: load_content_from_h5_file(traj[k], obs_keys if k == 'obs' else None) for k in source_keys
     }
-    file.close()
+    if obs_process_fn is not None and 'obs' in ret:
+        ret['obs'] = obs_process_fn(ret['obs'])
+    return ret
+
+def to_shared_memory(tree):
+    # pack all arrays of a (nested) dict into one shared memory segment, returns what is needed to rebuild it
+    leaves = []
+    def collect(node, path):
+        if isinstance(node, dict):
+            for k, v in node.items():
+                collect(v, path + (k,))
+        else:
+            leaves.append((path, node))
+    collect(tree, ())
+    layout, size = [], 0
+    for path, v in leaves:
+        if isinstance(v, np.ndarray) and not v.dtype.hasobject:
+            layout.append((path, size, v.shape, v.dtype.str))
+            size += (v.nbytes + 63) // 64 * 64 # keep every array 64-byte aligned
+        else:
+            layout.append((path, None, v, None)) # not an array, just pickle it
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    resource_tracker.unregister(shm._name, 'shared_memory') # the reading process unlinks it
+    for (path, offset, shape, dtype), (_, v) in zip(layout, leaves):
+        if offset is not None:
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = v
+    name = shm.name
+    shm.close()
+    return name, layout
+
+def from_shared_memory(name, layout):
+    shm = shared_memory.SharedMemory(name=name)
+    tree = {}
+    for path, offset, shape, dtype in layout:
+        node = tree
+        for k in path[:-1]:
+            node = node.setdefault(k, {})
+        if offset is None:
+            node[path[-1]] = shape
+        else:
+            node[path[-1]] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset).copy()
+    shm.close()
+    shm.unlink()
+    return tree
+
+_load_worker = {}
+
+def _init_load_worker(path, keys, obs_keys, obs_process_fn):
+    _load_worker.update(file=File(path, 'r'), keys=keys, obs_keys=obs_keys, obs_process_fn=obs_process_fn)
+
+def _load_traj_worker(traj_key):
+    w = _load_worker
+    traj = load_traj_from_h5_group(w['file'][traj_key], w['keys'], w['obs_keys'], w['obs_process_fn'])
+    return to_shared_memory(traj)
+
+def load_traj_hdf5(path, num_traj=None, keys=None, obs_keys=None, traj_filter=None, num_workers=0, obs_process_fn=None,
+                   strict=True):
+    """
+    keys: source keys to read from every trajectory group (e.g. ['obs', 'actions']), None reads all of them.
+    obs_keys: sub key filter applied inside nested obs dicts (rgbd), see `load_content_from_h5_file`.
+    traj_filter: per-trajectory predicate, see `select_traj_keys`.
+    num_workers: if > 0, trajectories are read (and processed) by a pool of forked processes,
+        which hand the arrays back through shared memory. The trajectory order is the same as with 0 workers.
+    obs_process_fn: optional function applied to the obs of every trajectory right after it is read.
+        With num_workers > 0 it runs in the workers, it does not need to be picklable (fork).
+    strict: see `select_traj_keys`.
+    """
+    print('Loading HDF5 file', path)
+    file = File(path, 'r')
+    traj_keys = select_traj_keys(file, num_traj, traj_filter, strict)
+    ret = {}
+    if num_workers > 0:
+        file.close() # don't fork with an open h5 file, each worker opens its own
+        ctx = mp.get_context('fork')
+        with ctx.Pool(num_workers, initializer=_init_load_worker, initargs=(path, keys, obs_keys, obs_process_fn)) as pool:
+            for traj_key, shm in zip(traj_keys, pool.imap(_load_traj_worker, traj_keys)):
+                ret[traj_key] = from_shared_memory(*shm)
+    else:
+        for traj_key in traj_keys:
+            ret[traj_key] = load_traj_from_h5_group(file[traj_key], keys, obs_keys, obs_process_fn)
+        file.close()
     print('Loaded')
     return ret
 
+def _natural_key(s):
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', s)]
+
+def expand_demo_paths(path):
+    """
+    `path` is a single .h5 file, a glob (e.g. 'data/PickCube/shard_*.h5'), a comma separated list of those,
+    or a python list of those. Returns the list of shard files, globs are sorted naturally (shard_2 < shard_10).
+    """
+    if isinstance(path, (list, tuple)):
+        return [p for x in path for p in expand_demo_paths(x)]
+    paths = []
+    for pattern in path.split(','):
+        matched = sorted(glob.glob(pattern), key=_natural_key) if glob.has_magic(pattern) else [pattern]
+        assert len(matched) > 0, f'No demo file matches {pattern}'
+        paths += matched
+    for p in paths:
+        assert p.endswith('.h5'), f'Demo path {p} is not supported, only .h5 files are supported'
+    return paths
+
+def load_traj_shards(paths, num_traj=None, **kwargs):
+    """
+    `load_traj_hdf5` over several shards, num_traj is the total number of trajectories, taken from the shards in order.
+    The keys of the result are '<path>:<traj_key>', as trajectory keys repeat across shards.
+    """
+    ret = {}
+    for path in paths:
+        remaining = None if num_traj is None else num_traj - len(ret)
+        if remaining == 0:
+            break
+        shard = load_traj_hdf5(path, remaining, strict=False, **kwargs)
+        ret.update({f'{path}:{traj_key}': traj for traj_key, traj in shard.items()})
+    if num_traj is not None:
+        assert num_traj <= len(ret), f"num_traj: {num_traj} > number of trajectories in all shards: {len(ret)}"
+    return ret
+
 TARGET_KEY_TO_SOURCE_KEY = {
     'states': 'env_states',
     'observations': 'obs',
@@ -42,15 +206,209 @@ TARGET_KEY_TO_SOURCE_KEY = {
     'actions': 'actions',
 }
 
-def load_demo_dataset(path, keys=['observations', 'actions'], num_traj=None, concat=True):
+def get_source_keys(keys):
+    # 'actions' is always needed to know the trajectory lengths
+    source_keys = [TARGET_KEY_TO_SOURCE_KEY[k] for k in keys] + ['actions']
+    return list(dict.fromkeys(source_keys))
+
+class _DatasetRef(object):
+    __slots__ = ('name', 'shape', 'dtype', 'offset')
+
+    def __init__(self, dataset):
+        self.name = dataset.name
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.offset = None
+        if dataset.chunks is None and dataset.compression is None and dataset.size > 0:
+            self.offset = dataset.id.get_offset() # None if the storage is not allocated
+
+def index_h5_node(node, sub_keys=None, path=()):
+    # same traversal as `load_content_from_h5_file`, but only records where the data is
+    if isinstance(node, (File, Group)):
+        ret = {}
+        for key in list(node.keys()):
+            v = index_h5_node(node[key], sub_keys, path + (key,))
+            if v is not None:
+                ret[key] = v
+        return ret if ret or sub_keys is None or not path else None
+    elif isinstance(node, Dataset):
+        if sub_keys is not None and path and not match_sub_keys(path, sub_keys):
+            return None
+        return _DatasetRef(node)
+    else:
+        raise NotImplementedError(f"Unspported h5 file type: {type(node)}")
+
+def _num_rows(node):
+    while isinstance(node, dict):
+        node = next(iter(node.values()))
+    return node.shape[0]
+
+class TrajectoryStore(object):
+    """
+    Lazy view over a ManiSkill trajectory file, used in place of the lists returned by `load_demo_dataset`.
+    The file is only indexed at construction (trajectory lengths + where every dataset lives),
+    no data is read until `read` is called. Contiguous datasets are served from a single read-only
+    memory map of the file, chunked/compressed ones fall back to `Dataset.read_direct`.
+    Only the rows of the requested window are touched, so demo sets larger than memory are fine.
+    """
+    ROW_OFFSET = {'next_observations': 1, 'next_states': 1}
+
+    def __init__(self, path, keys=['observations', 'actions'], num_traj=None, obs_keys=None, traj_filter=None, strict=True):
+        self.path = path
+        self.keys = list(keys)
+        self._file, self._mmap, self._pid = None, None, None
+        traj_keys = select_traj_keys(self.file, num_traj, traj_filter, strict)
+        source_keys = get_source_keys(self.keys)
+        self.index = []
+        for traj_key in traj_keys:
+            traj = self.file[traj_key]
+            for source_key in source_keys:
+                assert source_key in traj, f"key: {source_key} not in {traj_key}: {traj.keys()}"
+            self.index.append({k: index_h5_node(traj[k], obs_keys if k == 'obs' else None) for k in source_keys})
+        self.traj_keys = traj_keys
+        self.lengths = np.array([t['actions'].shape[0] for t in self.index], dtype=np.int64)
+        print(f'Indexed {len(self)} trajectories ({self.lengths.sum()} transitions) in', path)
+
+    @property
+    def file(self):
+        # h5py handles can not be shared across processes, reopen in each dataloader worker
+        if self._pid != os.getpid():
+            self._file = File(self.path, 'r')
+            self._mmap = np.memmap(self.path, dtype=np.uint8, mode='r')
+            self._pid = os.getpid()
+        return self._file
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_file=None, _mmap=None, _pid=None)
+        return state
+
+    def close(self):
+        # drop the handles, they are reopened by the next read
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file, self._mmap, self._pid = None, None, None
+
+    def __len__(self):
+        return len(self.index)
+
+    def _read_node(self, node, start, end, out):
+        if isinstance(node, dict):
+            out = out if out is not None else {}
+            for k, v in node.items():
+                out[k] = self._read_node(v, start, end, out.get(k))
+            return out
+        n = end - start
+        if out is None:
+            out = np.empty((n,) + node.shape[1:], dtype=node.dtype)
+        assert out.shape[0] == n, (out.shape, start, end)
+        if n == 0:
+            return out
+        file = self.file
+        if node.offset is not None:
+            src = np.ndarray(node.shape, dtype=node.dtype, buffer=self._mmap, offset=node.offset)
+            out[...] = src[start:end]
+        else:
+            file[node.name].read_direct(out, source_sel=np.s_[start:end], dest_sel=np.s_[0:n])
+        return out
+
+    def read(self, traj_idx, key, start=0, end=None, out=None):
+        """
+        Read rows [start, end) of `key` (a target key, e.g. 'observations') of trajectory `traj_idx`.
+        Nested obs (rgbd) are returned as nested dicts. If `out` is given, rows are written into it.
+        """
+        node = self.index[traj_idx][TARGET_KEY_TO_SOURCE_KEY[key]]
+        offset = self.ROW_OFFSET.get(key, 0)
+        if end is None:
+            end = _num_rows(node) - offset
+        return self._read_node(node, start + offset, end + offset, out)
+
+    def load(self, key):
+        # materialize one key for all trajectories, only use it for small keys such as actions
+        return [self.read(i, key) for i in range(len(self))]
+
+class ShardedTrajectoryStore(object):
+    """
+    `TrajectoryStore` over several demo files (shards), with one global trajectory index:
+    trajectory i is trajectory local_idx[i] of shard shard_idx[i]. num_traj is taken from the shards in order.
+    Every shard keeps its own lazily opened handles, at most `max_open_shards` of them are open at a time.
+    """
+    ROW_OFFSET = TrajectoryStore.ROW_OFFSET
+
+    def __init__(self, paths, keys=['observations', 'actions'], num_traj=None, obs_keys=None, traj_filter=None,
+                 max_open_shards=32):
+        self.paths = list(paths)
+        self.keys = list(keys)
+        self.max_open_shards = max_open_shards
+        self.shards = []
+        n = 0
+        for path in self.paths:
+            remaining = None if num_traj is None else num_traj - n
+            if remaining == 0:
+                break
+            shard = TrajectoryStore(path, keys, remaining, obs_keys, traj_filter, strict=False)
+            shard.close()
+            self.shards.append(shard)
+            n += len(shard)
+        if num_traj is not None:
+            assert num_traj <= n, f"num_traj: {num_traj} > number of trajectories in all shards: {n}"
+        self.shard_idx = np.concatenate([np.full(len(s), i, dtype=np.int64) for i, s in enumerate(self.shards)])
+        self.local_idx = np.concatenate([np.arange(len(s), dtype=np.int64) for s in self.shards])
+        self.traj_keys = [f'{s.path}:{k}' for s in self.shards for k in s.traj_keys]
+        self.lengths = np.concatenate([s.lengths for s in self.shards])
+        self._open = OrderedDict() # LRU of the shards with open handles
+        print(f'Indexed {len(self)} trajectories ({self.lengths.sum()} transitions) in {len(self.shards)} shards')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_open'] = OrderedDict() # the shards drop their handles when pickled
+        return state
+
+    def __len__(self):
+        return len(self.shard_idx)
+
+    def _get_shard(self, i):
+        self._open[i] = None
+        self._open.move_to_end(i)
+        if len(self._open) > self.max_open_shards:
+            self.shards[self._open.popitem(last=False)[0]].close()
+        return self.shards[i]
+
+    def read(self, traj_idx, key, start=0, end=None, out=None):
+        shard = self._get_shard(self.shard_idx[traj_idx])
+        return shard.read(self.local_idx[traj_idx], key, start, end, out)
+
+    def load(self, key):
+        return [self.read(i, key) for i in range(len(self))]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self._open.clear()
+
+def load_demo_dataset(path, keys=['observations', 'actions'], num_traj=None, concat=True, lazy=False,
+                      obs_keys=None, traj_filter=None, num_workers=0, obs_process_fn=None):
+    """
+    path: one .h5 file, or several shards (glob / list, see `expand_demo_paths`) loaded as one dataset.
+    Only the source keys of `keys` (plus 'actions') are read from the h5 file,
+    `obs_keys`, `traj_filter`, `num_workers` and `obs_process_fn` are passed to `load_traj_hdf5`.
+    """
     # assert num_traj is None
-    raw_data = load_traj_hdf5(path, num_traj)
+    paths = expand_demo_paths(path)
+    if lazy:
+        if len(paths) > 1:
+            return ShardedTrajectoryStore(paths, keys, num_traj, obs_keys=obs_keys, traj_filter=traj_filter)
+        return TrajectoryStore(paths[0], keys, num_traj, obs_keys=obs_keys, traj_filter=traj_filter)
+    load_kwargs = dict(keys=get_source_keys(keys), obs_keys=obs_keys, traj_filter=traj_filter,
+                       num_workers=num_workers, obs_process_fn=obs_process_fn)
+    if len(paths) > 1:
+        raw_data = load_traj_shards(paths, num_traj, **load_kwargs)
+    else:
+        raw_data = load_traj_hdf5(paths[0], num_traj, **load_kwargs)
     # raw_data has keys like: ['traj_0', 'traj_1', ...]
-    # raw_data['traj_0'] has keys like: ['actions', 'dones', 'env_states', 'infos', ...]
-    _traj = raw_data['traj_0']
-    for key in keys:
-        source_key = TARGET_KEY_TO_SOURCE_KEY[key]
-        assert source_key in _traj, f"key: {source_key} not in traj_0: {_traj.keys()}"
+    # raw_data['traj_0'] has keys like: ['actions', 'obs'], only the requested ones are loaded
+    assert len(raw_data) > 0, f'No trajectory loaded from {path}'
+    _traj = next(iter(raw_data.values())) # traj_0 may have been filtered out
     dataset = {}
     for target_key in keys:
         # if 'next' in target_key:
@@ -59,12 +417,12 @@ def load_demo_dataset(path, keys=['observations', 'actions'], num_traj=None, con
         dataset[target_key] = [ raw_data[idx][source_key] for idx in raw_data ]
         if isinstance(dataset[target_key][0], np.ndarray) and concat:
             if target_key in ['observations', 'states'] and \
-                    len(dataset[target_key][0]) > len(raw_data['traj_0']['actions']):
+                    len(dataset[target_key][0]) > len(_traj['actions']):
                 dataset[target_key] = np.concatenate([
                     t[:-1] for t in dataset[target_key]
                 ], axis=0)
             elif target_key in ['next_observations', 'next_states'] and \
-                    len(dataset[target_key][0]) > len(raw_data['traj_0']['actions']):
+                    len(dataset[target_key][0]) > len(_traj['actions']):
                 dataset[target_key] = np.concatenate([
                     t[1:] for t in dataset[target_key]
                 ], axis=0)
@@ -76,6 +434,40 @@ def load_demo_dataset(path, keys=['observations', 'actions'], num_traj=None, con
             print('Load', target_key, len(dataset[target_key]), type(dataset[target_key][0]))
     return dataset
 
+def shuffle_buffer(iterable, buffer_size, rng):
+    # approximate shuffle with bounded memory: once the buffer is full, every new item replaces a random one that is yielded
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.integers(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+def stream_demo_windows(paths, make_windows, buffer_size, seed=0, worker_id=0, num_workers=1, **kwargs):
+    """
+    Endless stream of training windows read shard by shard, only one shard is loaded at a time
+    and the windows are shuffled through a buffer of `buffer_size` windows.
+    The shard order is reshuffled every pass, with the same permutation in every worker,
+    and worker `worker_id` reads every `num_workers`-th shard of it.
+    make_windows: (trajectories of one shard, as returned by `load_demo_dataset(..., concat=False)`, rng)
+        -> iterable of windows. It should not return views of the shard, otherwise the buffer keeps it alive.
+    kwargs are passed to `load_demo_dataset`.
+    """
+    assert len(paths) >= num_workers, f'{len(paths)} shards can not be split across {num_workers} workers'
+    rng = np.random.default_rng([seed, worker_id])
+    def windows():
+        epoch = 0
+        while True:
+            order = np.random.default_rng([seed, epoch]).permutation(len(paths))
+            for i in order[worker_id::num_workers]:
+                yield from make_windows(load_demo_dataset(paths[i], concat=False, **kwargs), rng)
+            epoch += 1
+    return shuffle_buffer(windows(), buffer_size, rng)
+
 def load_trajecories(path):
     raw_data = load_hdf5(path)
     # raw_data has keys like: ['traj_0', 'traj_1', ...]
@@ -93,6 +485,14 @@ def load_json(filename):
     f.close()
     return ret
 
+def read_control_mode(demo_info):
+    if 'control_mode' in demo_info['env_info']['env_kwargs']:
+        return demo_info['env_info']['env_kwargs']['control_mode']
+    elif 'control_mode' in demo_info['episodes'][0]:
+        return demo_info['episodes'][0]['control_mode']
+    else:
+        raise Exception('Control mode not found in json')
+
 def load_trajecories_and_json(path):
     raw_data = load_hdf5(path)
     # raw_data has keys like: ['traj_0', 'traj_1', ...]
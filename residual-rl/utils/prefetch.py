@@ -0,0 +1,80 @@
+import queue
+import threading
+import torch
+
+
+def _map_tensors(fn, x):
+    if isinstance(x, dict):
+        return {k: _map_tensors(fn, v) for k, v in x.items()}
+    return fn(x)
+
+def _iter_tensors(x):
+    if isinstance(x, dict):
+        for v in x.values():
+            yield from _iter_tensors(v)
+    else:
+        yield x
+
+
+class BatchPrefetcher(object):
+    """
+    Replaces the DataLoader for in-memory datasets: batches are assembled in a background thread and moved to
+    `device` while the training loop works on the previous batch.
+    batch_sampler: iterable of index lists, e.g. IterationBasedBatchSampler(BatchSampler(RandomSampler(dataset), ...))
+    gather_fn(indices, out): writes the batch `indices` (a LongTensor) into `out` and returns it
+    alloc_fn(batch_size, pin_memory): allocates a batch (nested dict of CPU tensors) for gather_fn
+    On CUDA, batches are gathered into `num_buffers` reusable pinned staging buffers and copied to the device
+    on a separate stream, so the copy overlaps with the compute of the previous step.
+    On other devices, every batch is gathered into a new buffer and moved with `.to(device)`.
+    Dtypes are kept as they are (e.g. uint8 rgb), convert them on the device.
+    """
+    def __init__(self, batch_sampler, gather_fn, alloc_fn, device, num_buffers=2):
+        self.batch_sampler = batch_sampler
+        self.gather_fn, self.alloc_fn = gather_fn, alloc_fn
+        self.device = torch.device(device)
+        self.num_buffers = num_buffers
+
+    def _produce(self, q):
+        try:
+            if self.device.type == 'cuda':
+                copy_stream = torch.cuda.Stream(self.device)
+                staging, copy_done = [None] * self.num_buffers, [None] * self.num_buffers
+            for i, indices in enumerate(self.batch_sampler):
+                indices = torch.as_tensor(indices, dtype=torch.int64)
+                if self.device.type != 'cuda':
+                    batch = self.gather_fn(indices, self.alloc_fn(len(indices), False))
+                    q.put((_map_tensors(lambda t: t.to(self.device), batch), None))
+                    continue
+                slot = i % self.num_buffers
+                if staging[slot] is None or len(indices) != len(next(_iter_tensors(staging[slot]))):
+                    staging[slot] = self.alloc_fn(len(indices), True)
+                elif copy_done[slot] is not None:
+                    copy_done[slot].synchronize() # the previous copy from this buffer has to be finished
+                self.gather_fn(indices, staging[slot])
+                with torch.cuda.stream(copy_stream):
+                    batch = _map_tensors(lambda t: t.to(self.device, non_blocking=True), staging[slot])
+                    copy_done[slot] = torch.cuda.Event()
+                    copy_done[slot].record(copy_stream)
+                q.put((batch, copy_done[slot]))
+        except Exception as e: # re-raised in the training loop
+            q.put(e)
+        q.put(None)
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.num_buffers)
+        thread = threading.Thread(target=self._produce, args=(q,), daemon=True)
+        thread.start()
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            batch, copy_done = item
+            if copy_done is not None:
+                stream = torch.cuda.current_stream(self.device)
+                stream.wait_event(copy_done)
+                for t in _iter_tensors(batch):
+                    t.record_stream(stream) # allocated on the copy stream, used on this one
+            yield batch
+        thread.join()
@@ -0,0 +1,205 @@
+"""
+Ring replay buffers in preallocated torch tensors on the training device, in place of stable-baselines3's ReplayBuffer
+(with handle_timeout_termination=False) in the online scripts: same constructor, `add` / `sample` / `size`,
+and the same fields in the samples, but transitions are written with one copy per field for all envs,
+and sampled with `torch.randint` and one gather per field, without going through numpy
+(`sample_batches` draws all the minibatches of a training round with one gather per field).
+
+TensorReplayBuffer stores every field of every transition. CompactReplayBuffer stores each observation
+(and base action) once and reads the next-state fields from the next transition of the same env, see its docstring.
+Both can store the observations and actions in float16 / bfloat16 (`dtype`), the samples are always float32.
+"""
+from collections import namedtuple
+import numpy as np
+import torch
+
+ReplayBufferSamples = namedtuple('ReplayBufferSamples', ['observations', 'actions', 'next_observations', 'dones', 'rewards'])
+
+BUFFER_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class TensorReplayBuffer(object):
+    """
+    Stores (buffer_size // n_envs, n_envs, ...) tensors like stable-baselines3, i.e. `size()` is the number of
+    vectorized env steps. `dones` is what the scripts pass to `add`, i.e. the stop_bootstrap of `--bootstrap-at-done`
+    (stable-baselines3 with handle_timeout_termination=False stores it as is too).
+    """
+    def __init__(self, buffer_size, observation_space, action_space, device, n_envs=1, dtype=torch.float32):
+        self.buffer_size = max(buffer_size // n_envs, 1)
+        self.n_envs = n_envs
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.pos = 0
+        self.full = False
+        self.obs_shape, self.action_shape = tuple(observation_space.shape), tuple(action_space.shape)
+        self.observations = self.alloc(self.obs_shape, dtype)
+        self.next_observations = self.alloc(self.obs_shape, dtype)
+        self.actions = self.alloc(self.action_shape, dtype)
+        self.rewards = self.alloc(())
+        self.dones = self.alloc(())
+
+    def alloc(self, shape, dtype=torch.float32):
+        return torch.zeros((self.buffer_size, self.n_envs) + shape, dtype=dtype, device=self.device)
+
+    def nbytes(self):
+        return sum(x.numel() * x.element_size() for x in vars(self).values() if torch.is_tensor(x))
+
+    def add(self, obs, next_obs, action, reward, done, infos=None, boundary=None):
+        # one transition for each env, (n_envs, ...) numpy arrays from the envs or tensors already on the device
+        # (e.g. obs embeddings), copy_ converts the dtype and moves them in one go
+        # infos is only there for the stable-baselines3 signature, boundary for the one of CompactReplayBuffer
+        for buf, x in [(self.observations, obs), (self.next_observations, next_obs), (self.actions, action),
+                       (self.rewards, reward), (self.dones, done)]:
+            buf[self.pos].copy_(torch.as_tensor(x).reshape(buf.shape[1:]))
+        self.pos += 1
+        if self.pos == self.buffer_size:
+            self.full = True
+            self.pos = 0
+
+    def size(self):
+        return self.buffer_size if self.full else self.pos
+
+    def sample_indices(self, batch_size):
+        # flat (step * n_envs + env) indices, uniform over the stored transitions
+        return torch.randint(0, self.size() * self.n_envs, (batch_size,), device=self.device)
+
+    def get(self, idx):
+        # the transitions at flat indices idx, rewards and dones are (len(idx), 1) like in stable-baselines3
+        def gather(x):
+            return x.view((-1,) + x.shape[2:]).index_select(0, idx)
+        return ReplayBufferSamples(
+            observations=gather(self.observations).float(),
+            actions=gather(self.actions).float(),
+            next_observations=gather(self.next_observations).float(),
+            dones=gather(self.dones).unsqueeze(1),
+            rewards=gather(self.rewards).unsqueeze(1),
+        )
+
+    def sample(self, batch_size):
+        return self.get(self.sample_indices(batch_size))
+
+    def sample_batches(self, num_batches, batch_size):
+        # the minibatches of a whole training round, drawn and gathered at once into (num_batches, batch_size, ...) slabs,
+        # returned as a list of per-update ReplayBufferSamples (views of the slabs), each distributed like sample(batch_size)
+        slab = self.get(self.sample_indices(num_batches * batch_size))
+        slab = [x.view((num_batches, batch_size) + x.shape[1:]) for x in slab]
+        return [ReplayBufferSamples(*(x[i] for x in slab)) for i in range(num_batches)]
+
+
+class CompactReplayBuffer(TensorReplayBuffer):
+    """
+    Episode-aware storage for the transitions of the online scripts, where the obs of a step is the next obs of the
+    previous step of the same env (obs_seq = next_obs_seq), except where the episode ended and `final_observation`
+    was substituted in the next obs. Each obs is stored once: the next obs of a transition is read from the obs of the
+    next row of its env, except for the envs the caller passes as `boundary` to `add`, whose next obs goes to a
+    boundary slot. The boundary slots are a ring in the order of the rows, which grows if there are more episode ends
+    in the buffer than slots.
+
+    With next_action_dim = k > 0, the last k action columns are the next-state counterpart of the k columns before them
+    (base_next_actions of base_actions for the sum / concat critics): only the first A - k columns are stored, and
+    the last k are read from the base actions of the next row, i.e. the base actions executed at the next step,
+    or from the boundary slot. This only holds if base_next_actions is the sample executed at the next step
+    (pi_dec_diffusion_maniskill2.py), the scripts that query it separately store it as is (next_action_dim = 0).
+
+    The next obs of the last transition is the obs of the next row, so one row is not sampled once the buffer is full.
+    """
+    def __init__(self, buffer_size, observation_space, action_space, device, n_envs=1, dtype=torch.float32, next_action_dim=0):
+        self.buffer_size = max(buffer_size // n_envs, 2)
+        self.n_envs = n_envs
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.pos = 0
+        self.full = False
+        self.obs_shape, self.action_shape = tuple(observation_space.shape), tuple(action_space.shape)
+        self.next_action_dim = next_action_dim
+        assert len(self.action_shape) == 1 and self.action_shape[0] >= 2 * next_action_dim
+        self.stored_action_dim = self.action_shape[0] - next_action_dim
+        self.observations = self.alloc(self.obs_shape, dtype)
+        self.actions = self.alloc((self.stored_action_dim,), dtype)
+        self.rewards = self.alloc(())
+        self.dones = self.alloc(())
+        self.boundary_index = self.alloc((), torch.int32) - 1 # boundary slot of each transition, -1: none
+        self.num_boundaries = [0] * self.buffer_size # number of boundary slots of each row
+        capacity = 4 * n_envs # grows when needed
+        self.boundary_next_observations = torch.zeros((capacity,) + self.obs_shape, dtype=dtype, device=self.device)
+        self.boundary_next_actions = torch.zeros((capacity, next_action_dim), dtype=dtype, device=self.device)
+        self.boundary_start, self.boundary_count = 0, 0
+
+    def _alloc_boundaries(self, n):
+        capacity = len(self.boundary_next_observations)
+        if self.boundary_count + n > capacity: # grow, keeping the live slots in order at the start
+            order = (self.boundary_start + torch.arange(self.boundary_count, device=self.device)) % capacity
+            new_capacity = max(2 * capacity, self.boundary_count + n)
+            for name in ['boundary_next_observations', 'boundary_next_actions']:
+                old = getattr(self, name)
+                new = old.new_zeros((new_capacity,) + old.shape[1:])
+                new[:self.boundary_count] = old[order]
+                setattr(self, name, new)
+            used = self.boundary_index >= 0
+            self.boundary_index[used] = (self.boundary_index[used] - self.boundary_start) % capacity
+            self.boundary_start, capacity = 0, new_capacity
+        slots = (self.boundary_start + self.boundary_count + torch.arange(n, device=self.device)) % capacity
+        self.boundary_count += n
+        return slots
+
+    def add(self, obs, next_obs, action, reward, done, infos=None, boundary=None):
+        # boundary: the envs whose next_obs is not the obs of their next transition (`final_observation` substituted),
+        # as a bool mask or a list of indices, their next obs (and next base actions) are stored in boundary slots
+        p, q = self.pos, (self.pos + 1) % self.buffer_size
+        A = self.stored_action_dim
+        obs = torch.as_tensor(obs).to(self.device, self.dtype).reshape(self.observations.shape[1:])
+        next_obs = torch.as_tensor(next_obs).to(self.device, self.dtype).reshape(self.observations.shape[1:])
+        action = torch.as_tensor(action).to(self.device, self.dtype).reshape(self.n_envs, -1)
+        if self.full: # row p is the oldest transition, its boundary slots are the oldest ones
+            self.boundary_start = (self.boundary_start + self.num_boundaries[p]) % len(self.boundary_next_observations)
+            self.boundary_count -= self.num_boundaries[p]
+        self.observations[p] = obs
+        self.actions[p] = action[:, :A]
+        self.rewards[p].copy_(torch.as_tensor(reward).reshape(self.n_envs))
+        self.dones[p].copy_(torch.as_tensor(done).reshape(self.n_envs))
+        self.boundary_index[p] = -1
+        envs = np.arange(self.n_envs)[boundary] if boundary is not None else []
+        if len(envs) > 0:
+            envs = torch.from_numpy(envs).to(self.device)
+            slots = self._alloc_boundaries(len(envs))
+            self.boundary_next_observations[slots] = next_obs[envs]
+            self.boundary_next_actions[slots] = action[envs, A:]
+            self.boundary_index[p, envs] = slots.int()
+        self.num_boundaries[p] = len(envs)
+        # write the next obs (and next base actions) ahead in row q, the next transition overwrites them with its own
+        # (row q is the oldest transition if the buffer is full, it is not sampled from now on)
+        self.observations[q] = next_obs
+        if self.next_action_dim > 0:
+            self.actions[q, :, A-self.next_action_dim:] = action[:, A:]
+        self.pos = q
+        if self.pos == 0:
+            self.full = True
+
+    def sample_indices(self, batch_size):
+        # flat indices of the transitions whose next obs is known: all rows but pos (written ahead) when full
+        if self.full:
+            i = torch.randint(0, (self.buffer_size - 1) * self.n_envs, (batch_size,), device=self.device)
+            return (i + (self.pos + 1) * self.n_envs) % (self.buffer_size * self.n_envs)
+        return torch.randint(0, self.pos * self.n_envs, (batch_size,), device=self.device)
+
+    def get(self, idx):
+        def gather(x, i=idx):
+            return x.view((-1,) + x.shape[2:]).index_select(0, i)
+        next_idx = (idx + self.n_envs) % (self.buffer_size * self.n_envs) # same env, next row
+        slot = gather(self.boundary_index)
+        has_slot = slot >= 0
+        slot = slot.clamp(min=0).long()
+        next_obs = torch.where(has_slot.view((-1,) + (1,) * len(self.obs_shape)),
+                               self.boundary_next_observations.index_select(0, slot), gather(self.observations, next_idx))
+        actions = gather(self.actions)
+        if self.next_action_dim > 0:
+            next_actions = torch.where(has_slot.unsqueeze(1), self.boundary_next_actions.index_select(0, slot),
+                                       gather(self.actions, next_idx)[:, -self.next_action_dim:])
+            actions = torch.cat([actions, next_actions], dim=1)
+        return ReplayBufferSamples(
+            observations=gather(self.observations).float(),
+            actions=actions.float(),
+            next_observations=next_obs.float(),
+            dones=gather(self.dones).unsqueeze(1),
+            rewards=gather(self.rewards).unsqueeze(1),
+        )
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import torch
 
@@ -13,6 +14,40 @@ def worker_init_fn(worker_id, base_seed=None):
     # print(worker_id, base_seed)
     np.random.seed(base_seed + worker_id)
 
+def compile_inference_fn(fn, cache_dir=None):
+    """
+    torch.compile `fn` (e.g. a whole denoising loop) as a single graph with static shapes,
+    i.e. one specialized graph per input shape (batch size). Works on CPU (needs a C++ compiler) and CUDA.
+    The compiled kernels go to inductor's on-disk cache (`cache_dir`, default: $TORCHINDUCTOR_CACHE_DIR
+    or /tmp/torchinductor_$USER), so a restart only re-traces the function and does not compile again.
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+    return torch.compile(fn, dynamic=False, fullgraph=True)
+
+def quantize_int8(module):
+    """
+    Dynamic int8 quantization (CPU only) of the convolutions of `module`, in place, e.g. the ConditionalUnet1D of a
+    diffusion policy: weights are quantized once (per output channel for Conv1d), activations on the fly at every call,
+    so there is nothing to calibrate. Linear layers are kept in fp32, they are not in the denoising hot path
+    (precomputed step embeddings and obs conditioning) and their weights are read directly.
+    """
+    import warnings
+    import torch.nn as nn
+    import torch.ao.nn.quantized.dynamic as nnqd
+    from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig, default_dynamic_qconfig
+    with warnings.catch_warnings(): # torch.ao.quantization is deprecated in favor of torchao, but still works
+        warnings.simplefilter('ignore')
+        return quantize_dynamic(
+            module,
+            {nn.Conv1d: per_channel_dynamic_qconfig, nn.ConvTranspose1d: default_dynamic_qconfig},
+            mapping={nn.Conv1d: nnqd.Conv1d, nn.ConvTranspose1d: nnqd.ConvTranspose1d},
+            inplace=True,
+        )
+
 import torch.nn as nn
 import torch.nn.functional as F
 class RandomShiftsAug(nn.Module):